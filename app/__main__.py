@@ -1,34 +1,120 @@
 import asyncio
 import logging
+from .startup import startup  # первым: от его импорта считается время старта
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
 from .config import config
-from .db import init_models
+from .db import engine, read_engine, read_stats
+from .schema import ensure_schema, SCHEMA_VERSION
+from .antispam import limiter
+from .chats import chat_cache
+from .pending import pending
+from .routing import routes
+from .sender import scheduler
+from .writer import writer
+from .outbox import outbox
+from .maintenance import maintenance
 from .handlers import channel as channel_handlers
 from .handlers import user as user_handlers
+from .webhook import run_webhook
+from .middlewares import CommitBeforeApiMiddleware, DbSessionMiddleware, FirstUpdateMiddleware, UserMailboxMiddleware, mailbox
+from . import digest, metrics
 
-async def main():
+async def on_startup(bot: Bot):
+    # прогрев (каналы, пользователи, pending, действующие лимиты) шёл, пока создавалась Bot-сессия
+    await startup.wait_warmup()
+    limiter.start()
+    outbox.start(bot)
+    if config.cluster_worker_index == 0:  # в кластере чистит один воркер
+        maintenance.start()
+    startup.mark("ready")
 
-    # Создаём таблицы в БД (если ещё нет)
-    await init_models()
-    print("✅ DB init: tables ensured")
+async def on_shutdown():
+    await user_handlers.u2a_albums.flush_all()
+    await user_handlers.a2u_albums.flush_all()
+    await channel_handlers.decorations.stop()
+    await maintenance.stop()
+    await outbox.stop()
+    await writer.stop()
+    await limiter.stop()
+    await scheduler.stop()
 
-    bot = Bot(
-        token=config.bot_token,
-        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-    )
+def setup_metrics(dp: Dispatcher, bot: Bot):
+    metrics.instrument_engine(engine)
+    if read_engine is not engine:
+        metrics.instrument_engine(read_engine, "db_pool_read")
+    metrics.register_stats("db_reads", read_stats.stats)
+    metrics.instrument_dispatcher(dp)
+    metrics.instrument_bot(bot)
+    metrics.register_stats("scheduler", scheduler.stats)
+    metrics.register_stats("writer", writer.stats)
+    metrics.register_stats("outbox", outbox.stats)
+    metrics.register_stats("ratelimit", limiter.stats)
+    metrics.register_stats("decorate", channel_handlers.decorations.stats)
+    metrics.register_stats("albums_u2a", user_handlers.u2a_albums.stats)
+    metrics.register_stats("albums_a2u", user_handlers.a2u_albums.stats)
+    metrics.register_stats("routes", routes.stats)
+    metrics.register_stats("pending", pending.stats)
+    metrics.register_stats("chat_cache", chat_cache.stats)
+    metrics.register_stats("mailbox", mailbox.stats)
+    metrics.register_stats("startup", startup.stats)
+    metrics.register_stats("maintenance", maintenance.stats)
+    metrics.register_stats("digest", digest.gate.stats)
+
+def build_dispatcher(bot: Bot, with_metrics: bool) -> Dispatcher:
     dp = Dispatcher()
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    # метрики — снаружи, чтобы время апдейта включало и коммит сессии
+    if with_metrics:
+        setup_metrics(dp, bot)
+    dp.update.outer_middleware(FirstUpdateMiddleware(startup.first_update))
+    # очередь пользователя — до сессии БД: ожидающий апдейт не держит соединение
+    dp.update.outer_middleware(UserMailboxMiddleware(mailbox))
+    dp.update.outer_middleware(DbSessionMiddleware())
+    bot.session.middleware(CommitBeforeApiMiddleware())
 
     # ✅ Роутеры должны быть добавлены до старта polling
     dp.include_router(user_handlers.router)      # user — первым
     dp.include_router(channel_handlers.router)   # channel — вторым
+    return dp
+
+def make_bot() -> Bot:
+    # свой Bot API сервер (локальный telegram-bot-api или заглушка для нагрузочных тестов)
+    session = AiohttpSession(api=TelegramAPIServer.from_base(config.telegram_api_base)) if config.telegram_api_base else None
+    return Bot(
+        token=config.bot_token,
+        session=session,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+
+async def main():
+
+    # схема: один SELECT версии; create_all и миграции — только если версия в БД отстала
+    applied = await ensure_schema()
+    startup.mark("schema")
+    print(f"✅ DB schema v{SCHEMA_VERSION}" + (f": применено миграций {applied}" if applied else ""))
+
+    # прогрев кэшей — параллельно с Bot-сессией, сервером метрик и (де)регистрацией вебхука
+    startup.start_warmup()
+    bot = make_bot()
+    dp = build_dispatcher(bot, with_metrics=bool(config.metrics_port))
+    if config.metrics_port:
+        await metrics.start_metrics_server(config.metrics_host, config.metrics_port)
 
-    await dp.start_polling(bot)
+    if config.delivery_mode == "webhook":
+        await run_webhook(dp, bot)
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
-        pass
\ No newline at end of file
+        pass
@@ -0,0 +1,121 @@
+import asyncio, contextvars
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+from aiogram.types import Message
+
+ALBUM_MAX_ITEMS = 10  # лимит Telegram на media group
+
+
+@dataclass
+class _Group:
+    ctx: dict
+    started: float
+    parts: list[Message] = field(default_factory=list)
+    timer: asyncio.TimerHandle | None = None
+
+
+class MediaGroupAggregator:
+    """
+    Собирает части альбома по media_group_id и отдаёт их в on_flush(parts, ctx).
+    Дебаунс перезапускается с каждой новой частью (но не дольше max_wait от первой),
+    на 10-й части альбом уходит сразу. Число открытых альбомов ограничено max_groups.
+    """
+
+    def __init__(self, on_flush: Callable[[list[Message], dict], Awaitable], debounce: float,
+                 max_wait: float, max_groups: int, name: str = "album"):
+        self.on_flush = on_flush
+        self.debounce = debounce
+        self.max_wait = max(debounce, max_wait)
+        self.max_groups = max(1, max_groups)
+        self.name = name
+        self._groups: dict[str, _Group] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # недавно отправленные альбомы: опоздавшая часть получает тот же ctx и уходит хвостом
+        self._recent: OrderedDict[str, dict] = OrderedDict()
+        self.flushed = 0
+        self.flushed_full = 0
+        self.late_parts = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.fallbacks = 0
+        self.fallback_calls = 0
+
+    def ctx(self, mgid: str) -> dict | None:
+        """ctx открытого или только что отправленного альбома."""
+        g = self._groups.get(mgid)
+        return g.ctx if g else self._recent.get(mgid)
+
+    def add(self, mgid: str, msg: Message, ctx: dict):
+        """ctx учитывается только для первой части; дальше используется сохранённый."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        g = self._groups.get(mgid)
+        if g is None:
+            if mgid in self._recent:
+                self.late_parts += 1
+                ctx = self._recent[mgid]
+            while len(self._groups) >= self.max_groups:
+                self._fire(next(iter(self._groups)))
+            g = self._groups[mgid] = _Group(ctx=ctx, started=now)
+
+        g.parts.append(msg)
+        if g.timer:
+            g.timer.cancel()
+            g.timer = None
+
+        if len(g.parts) >= ALBUM_MAX_ITEMS:
+            self.flushed_full += 1
+            self._fire(mgid)
+            return
+        delay = min(self.debounce, g.started + self.max_wait - now)
+        g.timer = loop.call_later(max(0.0, delay), self._fire, mgid)
+
+    def _fire(self, mgid: str):
+        g = self._groups.pop(mgid, None)
+        if g is None:
+            return
+        if g.timer:
+            g.timer.cancel()
+        self._recent[mgid] = g.ctx
+        if len(self._recent) > 256:
+            self._recent.popitem(last=False)
+        # пустой контекст: сборка идёт вне апдейта, даже если её запустила часть изнутри хендлера
+        task = asyncio.create_task(self._flush(g), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, g: _Group):
+        latency = asyncio.get_running_loop().time() - g.started
+        self.flushed += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        parts = sorted(g.parts, key=lambda p: p.message_id)
+        try:
+            await self.on_flush(parts, g.ctx)
+        except Exception as e:
+            print(f"⚠️ Не удалось отправить альбом ({self.name}):", e)
+
+    def count_fallback(self, calls: int):
+        """Альбом ушёл не sendMediaGroup, а копиями: calls вызовов Bot API на копии."""
+        self.fallbacks += 1
+        self.fallback_calls += calls
+
+    async def flush_all(self):
+        for mgid in list(self._groups):
+            self._fire(mgid)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "open": len(self._groups),
+            "buffered_parts": sum(len(g.parts) for g in self._groups.values()),
+            "flushed": self.flushed,
+            "flushed_full": self.flushed_full,
+            "late_parts": self.late_parts,
+            "fallbacks": self.fallbacks,
+            "fallback_calls": self.fallback_calls,
+            "latency_avg_ms": round(self.latency_sum / self.flushed * 1000, 1) if self.flushed else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 1),
+        }
@@ -1,15 +1,164 @@
-from datetime import datetime
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
-from .models import RateLimit
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import and_, func, select, or_
 from .config import config
+from .db import SessionLocal, upsert
+from .models import RateLimit
+
+_FLUSH_CHUNK = 500
+
+
+class _Bucket:
+    """Компактное состояние пользователя: те же поля и та же логика, что у RateLimit."""
+    __slots__ = ("last_ts", "hour_bucket_start", "hour_count")
+    hit = RateLimit.hit
+
+    def __init__(self, last_ts=None, hour_bucket_start=None, hour_count=0):
+        self.last_ts = last_ts
+        self.hour_bucket_start = hour_bucket_start
+        self.hour_count = hour_count
+
+    def is_stale(self, now: datetime, window_sec: int) -> bool:
+        """Состояние уже ни на что не влияет — эквивалентно новому пользователю (то же, что stale_clause)."""
+        fresh_window = self.last_ts and (now - self.last_ts).total_seconds() < window_sec
+        hb = self.hour_bucket_start or self.last_ts
+        fresh_hour = self.hour_count and hb and (now - hb) < timedelta(hours=1)
+        return not fresh_window and not fresh_hour
+
+
+def stale_clause(now: datetime, window_sec: int):
+    """SQL-версия _Bucket.is_stale: строки rate_limits, которые можно удалить/не поднимать."""
+    hb = func.coalesce(RateLimit.hour_bucket_start, RateLimit.last_ts)
+    return and_(
+        or_(RateLimit.last_ts.is_(None), RateLimit.last_ts < now - timedelta(seconds=window_sec)),
+        or_(func.coalesce(RateLimit.hour_count, 0) == 0, hb.is_(None), hb < now - timedelta(hours=1)),
+    )
+
+
+class RateLimiter:
+    """
+    In-memory антиспам: проверка без обращения к БД,
+    изменения сбрасываются в rate_limits пачками раз в flush_interval.
+    """
+
+    def __init__(self, window_sec: int, per_hour: int, maxsize: int, flush_interval: float):
+        self.window_sec = window_sec
+        self.per_hour = per_hour
+        self.maxsize = max(1, maxsize)
+        self.flush_interval = flush_interval
+        self._state: OrderedDict[int, _Bucket] = OrderedDict()
+        self._dirty: set[int] = set()
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self.evictions = 0
+        self.flushed_rows = 0
+
+    def hit(self, user_tg_id: int, now: datetime | None = None) -> tuple[bool, int]:
+        now = now or datetime.utcnow()
+        b = self._state.get(user_tg_id)
+        if b is None:
+            b = self._state[user_tg_id] = _Bucket()
+        else:
+            self._state.move_to_end(user_tg_id)
+        ok, left = b.hit(now, self.window_sec, self.per_hour)
+        if ok:
+            self._dirty.add(user_tg_id)
+        self._evict(now)
+        return ok, left
+
+    def _evict(self, now: datetime):
+        # выкидываем только отжившие записи: промах в hit() начинает с чистого _Bucket без чтения БД,
+        # поэтому действующий лимит из памяти терять нельзя — таблица временно растёт сверх maxsize
+        while len(self._state) > self.maxsize:
+            uid, b = next(iter(self._state.items()))
+            if not b.is_stale(now, self.window_sec):
+                break  # дальше по LRU — писавшие позже; остальное подчистит flush()
+            del self._state[uid]
+            self._dirty.discard(uid)
+            self.evictions += 1
+
+    async def load(self):
+        """Поднимаем из БД только тех, у кого лимиты ещё действуют."""
+        now = datetime.utcnow()
+        async with SessionLocal() as session:
+            rows = (await session.execute(
+                select(RateLimit).where(~stale_clause(now, self.window_sec))
+            )).scalars().all()
+        for r in rows:
+            self._state[r.user_tg_id] = _Bucket(r.last_ts, r.hour_bucket_start, r.hour_count or 0)
+        self._evict(now)
+        return len(rows)
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._dirty:
+                return 0
+            dirty, self._dirty = self._dirty, set()
+            rows = []
+            for uid in dirty:
+                b = self._state.get(uid)
+                if b is not None:
+                    rows.append({
+                        "user_tg_id": uid,
+                        "last_ts": b.last_ts,
+                        "hour_bucket_start": b.hour_bucket_start,
+                        "hour_count": b.hour_count,
+                    })
+            try:
+                async with SessionLocal() as session:
+                    for i in range(0, len(rows), _FLUSH_CHUNK):
+                        await session.execute(upsert(
+                            RateLimit, rows[i:i + _FLUSH_CHUNK],
+                            keys=["user_tg_id"],
+                            update=["last_ts", "hour_bucket_start", "hour_count"],
+                        ))
+                    await session.commit()
+            except Exception:
+                self._dirty |= dirty  # повторим в следующий раз
+                raise
+            self.flushed_rows += len(rows)
+
+            # заодно чистим память от отживших записей
+            now = datetime.utcnow()
+            for uid in [u for u, b in self._state.items() if u not in self._dirty and b.is_stale(now, self.window_sec)]:
+                del self._state[uid]
+            return len(rows)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print("⚠️ Не удалось сохранить rate_limits:", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._state),
+            "dirty": len(self._dirty),
+            "evictions": self.evictions,
+            "flushed_rows": self.flushed_rows,
+        }
+
+
+limiter = RateLimiter(
+    window_sec=config.rate_window_sec,
+    per_hour=config.rate_per_hour,
+    maxsize=config.rate_cache_size,
+    flush_interval=config.rate_flush_interval_sec,
+)
+
 
-async def check_and_hit(session: AsyncSession, user_tg_id: int) -> tuple[bool, int]:
-    now = datetime.utcnow()
-    rl = (await session.execute(select(RateLimit).where(RateLimit.user_tg_id == user_tg_id))).scalar_one_or_none()
-    if not rl:
-        rl = RateLimit(user_tg_id=user_tg_id)
-        session.add(rl)
-    ok, left = rl.hit(now, config.rate_window_sec, config.rate_per_hour)
-    await session.commit()
-    return ok, left
\ No newline at end of file
+def check_and_hit(user_tg_id: int) -> tuple[bool, int]:
+    return limiter.hit(user_tg_id)
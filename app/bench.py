@@ -0,0 +1,377 @@
+"""
+Микробенчмарки горячих функций и операций с БД. Всегда на локальной SQLite во временной папке —
+DATABASE_URL из окружения/.env игнорируется, прод-БД не трогаем.
+
+    python -m app.bench                      # прогон и сравнение с baseline
+    python -m app.bench --save               # записать результаты как новый baseline
+    python -m app.bench -k hdr -k upsert     # только выбранные (подстрока имени)
+
+Baseline лежит в репозитории рядом с модулем (app/bench_baseline.json), от текущей папки не зависит.
+Обновлять его — `python -m app.bench --save` на той же машине, что и проверка (CI), и коммитить
+вместе с изменением, которое ускорило или сознательно замедлило код; в файле записаны Python и машина.
+
+Результат — мкс на операцию (минимум из нескольких повторов). Если что-то медленнее baseline
+больше чем в --max-regress раз (--max-regress-db для замеров с БД) — код выхода 1,
+чтобы ловить регрессии до деплоя.
+"""
+import os, tempfile
+
+_DB_DIR = tempfile.mkdtemp(prefix="kvantora-bench-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(_DB_DIR, 'bench.db')}"
+os.environ["DATABASE_READ_URL"] = ""
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+
+import argparse, asyncio, itertools, json, platform, shutil, sys, time  # noqa: E402
+from datetime import datetime, timedelta  # noqa: E402
+from aiogram.types import Chat, Document, Message, PhotoSize, User as TgUser, Video, Voice  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from .antispam import check_and_hit, limiter  # noqa: E402
+from .chats import sync_channel  # noqa: E402
+from .config import config  # noqa: E402
+from .db import SessionLocal, engine, init_models  # noqa: E402
+from .models import RateLimit  # noqa: E402
+from .handlers import user as u  # noqa: E402
+from .users import ensure_user  # noqa: E402
+from .writer import writer  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _no_fsync(dbapi_conn, _):
+    # меряем SQL/ORM-накладные, а не fsync диска — иначе DB-замеры шумят в разы
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA synchronous=OFF")
+    cur.execute("PRAGMA journal_mode=MEMORY")
+    cur.close()
+
+
+# name -> (factory, is_async); factory готовит данные и возвращает функцию без аргументов
+_BENCHES: dict[str, tuple] = {}
+
+
+def bench(name: str, is_async: bool = False):
+    def deco(factory):
+        _BENCHES[name] = (factory, is_async)
+        return factory
+    return deco
+
+
+# ---------- Тестовые сообщения ----------
+def _msg(**kw) -> Message:
+    return Message(
+        message_id=kw.pop("message_id", 1),
+        date=datetime.utcnow(),
+        chat=Chat(id=1001, type="private"),
+        from_user=TgUser(id=1001, is_bot=False, first_name="Bench", username="bench"),
+        **kw,
+    )
+
+
+def _photo_msg() -> Message:
+    sizes = [PhotoSize(file_id=f"AgAC{i}" * 8, file_unique_id=f"AQAD{i}", width=90 * i, height=90 * i) for i in (1, 4, 9)]
+    return _msg(photo=sizes, caption="Подпись к фото " * 4, media_group_id="13579")
+
+
+def _video_msg() -> Message:
+    return _msg(video=Video(file_id="BAAC" * 10, file_unique_id="AgAD", width=640, height=360, duration=12))
+
+
+def _voice_msg() -> Message:
+    return _msg(voice=Voice(file_id="AwAC" * 10, file_unique_id="AgAE", duration=3))
+
+
+_ADMIN_TEXT = (
+    "🗨️ <b>Новый комментарий</b>\nОт: @someone\nПост: https://t.me/channel/4242\n\n"
+    "Текст комментария " * 10 + "\n\nUID:123456789 CID:-1001234567890 PID:4242 AMID:987654"
+)
+_LINK = "https://t.me/channel/4242"
+_CAPTION = "Текст комментария <с разметкой> & прочим " * 5
+
+
+# ---------- Чистые функции ----------
+@bench("extract_ctx.hit")
+def _():
+    return lambda: u._extract_ctx_from_text(_ADMIN_TEXT)
+
+
+@bench("extract_ctx.miss")
+def _():
+    text = "Обычный ответ без меток " * 20
+    return lambda: u._extract_ctx_from_text(text)
+
+
+@bench("hdr.admin_to_user")
+def _():
+    return lambda: u._hdr_admin_to_user(_LINK, 123456789, -1001234567890, 4242, 987654, _CAPTION)
+
+
+@bench("hdr.user_to_admin_new")
+def _():
+    return lambda: u._hdr_user_to_admin_new("@someone", _LINK, 123456789, -1001234567890, 4242, _CAPTION)
+
+
+@bench("hdr.user_to_admin_reply")
+def _():
+    return lambda: u._hdr_user_to_admin_reply("@someone", _LINK, 123456789, -1001234567890, 4242, _CAPTION)
+
+
+@bench("as_input_media.photo")
+def _():
+    m = _photo_msg()
+    return lambda: u._as_input_media(m, True)
+
+
+@bench("as_input_media.video_override")
+def _():
+    m = _video_msg()
+    return lambda: u._as_input_media(m, True, override_caption=_CAPTION)
+
+
+@bench("media_records.photo")
+def _():
+    m = _photo_msg()
+    return lambda: u._media_records_from_message(m, "13579")
+
+
+@bench("media_records.voice")
+def _():
+    m = _voice_msg()
+    return lambda: u._media_records_from_message(m, None)
+
+
+@bench("copy_batches.album10")
+def _():
+    # фото и видео вперемешку, документ в конце: две пачки copyMessages
+    parts = [(_photo_msg() if i % 2 else _video_msg()).model_copy(update={"message_id": 100 + i}) for i in range(9)]
+    parts.append(_msg(message_id=109, document=Document(file_id="BQAC" * 10, file_unique_id="AgAF")))
+    return lambda: u._copy_batches(parts, -100500)
+
+
+# ---------- Антиспам ----------
+@bench("ratelimit.model_hit")
+def _():
+    rl = RateLimit(user_tg_id=1, last_ts=None, hour_bucket_start=None, hour_count=0)
+    now = datetime.utcnow()
+    step = timedelta(seconds=config.rate_window_sec + 1)
+    clock = itertools.count()
+
+    def run():
+        # каждый вызов — «следующее» сообщение после окна, бакет периодически обнуляется
+        rl.hit(now + step * next(clock), config.rate_window_sec, config.rate_per_hour)
+    return run
+
+
+@bench("ratelimit.check_and_hit")
+def _():
+    uids = itertools.cycle(range(1, 10_001))
+    return lambda: check_and_hit(next(uids))
+
+
+# ---------- БД (SQLite) ----------
+@bench("upsert.channel_changed", is_async=True)
+def _():
+    titles = itertools.cycle(("Канал A", "Канал B"))
+    return lambda: sync_channel(-1001234567890, "channel", next(titles))
+
+
+@bench("upsert.channel_same", is_async=True)
+def _():
+    return lambda: sync_channel(-1001234567890, "channel", "Канал A")
+
+
+@bench("upsert.user_new", is_async=True)
+def _():
+    ids = itertools.count(10_000_000)
+    return lambda: ensure_user(next(ids), "bench")
+
+
+@bench("upsert.user_cached", is_async=True)
+def _():
+    return lambda: ensure_user(1001, "bench")
+
+
+@bench("upsert.user_renamed", is_async=True)
+def _():
+    names = itertools.cycle(("bench_a", "bench_b"))
+    return lambda: ensure_user(1002, next(names))
+
+
+@bench("upsert.ratelimit_flush_500", is_async=True)
+def _():
+    uids = list(range(20_000_000, 20_000_500))
+    now = datetime.utcnow()
+
+    async def run():
+        for uid in uids:
+            limiter.hit(uid, now)
+            limiter._dirty.add(uid)
+        await limiter.flush()
+    return run
+
+
+
+def _media_rows(fuids) -> list[dict]:
+    now = datetime.utcnow()
+    return [{"file_unique_id": f, "media_type": "photo", "file_id": "AgAC" * 20, "created_at": now} for f in fuids]
+
+
+@bench("media.resolve_new_10", is_async=True)
+def _():
+    ids = itertools.count()
+
+    async def run():
+        async with SessionLocal() as session:
+            await writer._resolve_media(session, _media_rows(f"new{next(ids)}" for _ in range(10)))
+            await session.commit()
+    return run
+
+
+@bench("media.resolve_seen_10", is_async=True)
+def _():
+    # повтор уже записанных файлов мимо кэша: insert-if-absent ничего не вставляет, один SELECT
+    rows = _media_rows(f"seen{i}" for i in range(10))
+
+    async def run():
+        writer._media_ids.clear()
+        async with SessionLocal() as session:
+            await writer._resolve_media(session, rows)
+            await session.commit()
+    return run
+
+
+# ---------- Замер ----------
+def _measure_sync(fn, min_time: float, repeat: int) -> tuple[float, int]:
+    n = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time:
+            break
+        n *= 2 if dt <= 0 else max(2, min(10, int(min_time / dt) + 1))
+    best = dt / n
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / n)
+    return best * 1e6, n
+
+
+async def _measure_async(fn, min_time: float, repeat: int) -> tuple[float, int]:
+    await fn()  # прогрев (соединение, кэши компиляции SQL)
+    n = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            await fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time:
+            break
+        n *= 2 if dt <= 0 else max(2, min(10, int(min_time / dt) + 1))
+    best = dt / n
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            await fn()
+        best = min(best, (time.perf_counter() - t0) / n)
+    return best * 1e6, n
+
+
+async def run(selected: list[str], min_time: float, repeat: int) -> dict[str, dict]:
+    await init_models()
+    results = {}
+    try:
+        for name in selected:
+            factory, is_async = _BENCHES[name]
+            fn = factory()
+            if is_async:
+                us, n = await _measure_async(fn, min_time, repeat)
+            else:
+                us, n = _measure_sync(fn, min_time, repeat)
+            results[name] = {"us": round(us, 3), "loops": n, "db": is_async}
+            print(f"  {name:<32} {us:>10.2f} мкс/оп")
+    finally:
+        await engine.dispose()
+    return results
+
+
+def _load_baseline(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f).get("results", {})
+    except FileNotFoundError:
+        return {}
+
+
+def _compare(results: dict, baseline: dict, max_regress: float, max_regress_db: float) -> list[str]:
+    regressions = []
+    print(f"\n{'':<34}{'сейчас':>10} {'baseline':>10} {'×':>7}")
+    for name, r in results.items():
+        b = baseline.get(name)
+        if not b:
+            print(f"  {name:<32} {r['us']:>10.2f} {'—':>10}")
+            continue
+        ratio = r["us"] / b["us"] if b["us"] else 0.0
+        mark = ""
+        if ratio > (max_regress_db if r["db"] else max_regress):
+            mark = "  ⚠️"
+            regressions.append(name)
+        print(f"  {name:<32} {r['us']:>10.2f} {b['us']:>10.2f} {ratio:>7.2f}{mark}")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-k", dest="only", action="append", default=[], help="подстрока имени бенчмарка (можно несколько)")
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE, help="файл baseline (JSON)")
+    ap.add_argument("--save", action="store_true", help="записать результаты в baseline")
+    ap.add_argument("--max-regress", type=float, default=1.25, help="допустимое замедление относительно baseline")
+    ap.add_argument("--max-regress-db", type=float, default=1.5, help="то же для бенчмарков с БД (они шумнее)")
+    ap.add_argument("--min-time", type=float, default=0.2, help="минимальная длительность одного повтора, с")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--list", action="store_true", help="только показать список бенчмарков")
+    args = ap.parse_args()
+
+    names = [n for n in _BENCHES if not args.only or any(k in n for k in args.only)]
+    if args.list:
+        print("\n".join(names))
+        return
+    if not names:
+        sys.exit("Нет бенчмарков под фильтр")
+
+    print(f"Бенчмарки ({len(names)}), БД: {os.environ['DATABASE_URL']}")
+    try:
+        results = asyncio.run(run(names, args.min_time, max(1, args.repeat)))
+    finally:
+        shutil.rmtree(_DB_DIR, ignore_errors=True)
+
+    if args.save:
+        # при частичном прогоне обновляем только выбранные записи
+        merged = {**_load_baseline(args.baseline), **results}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "saved_at": datetime.utcnow().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": merged,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n✅ Baseline сохранён: {args.baseline}")
+        return
+
+    baseline = _load_baseline(args.baseline)
+    if not baseline:
+        print(f"\nBaseline {args.baseline} не найден — запустите с --save")
+        return
+    regressions = _compare(results, baseline, args.max_regress, args.max_regress_db)
+    if regressions:
+        print(f"\n⚠️ Медленнее допустимого относительно baseline: {', '.join(regressions)}")
+        sys.exit(1)
+    print("\n✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import asyncio, time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class _LoaderCancelled(Exception):
+    """Ведущий загрузчик отменён: ждущие не отменены — повторяют загрузку сами."""
+
+
+class TTLCache:
+    """
+    Небольшой in-memory кэш: TTL на запись, ограничение размера (LRU)
+    и single-flight загрузка — параллельные промахи по одному ключу ждут один loader.
+    Значение None не кэшируется.
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = max(1, maxsize)
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._peek(key) is not None
+
+    def _peek(self, key: Hashable):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.expired += 1
+            return None
+        return value
+
+    def get(self, key: Hashable, default=None):
+        value = self._peek(key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        if value is None:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default=None):
+        item = self._data.pop(key, None)
+        return item[1] if item else default
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            try:
+                return await asyncio.shield(fut)
+            except _LoaderCancelled:
+                return await self.get_or_load(key, loader)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            # отмена — дело ведущего; ждущие получают _LoaderCancelled и один из них загрузит заново
+            fut.set_exception(_LoaderCancelled())
+            fut.exception()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # помечаем как прочитанное, если ждущих не было
+            raise
+        else:
+            self.set(key, value)
+            fut.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,94 @@
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy import select
+
+from .cache import TTLCache
+from .config import config
+from .db import session_scope, read_scope, after_commit, upsert
+from .models import Channel
+from .utils import build_post_link
+
+
+@dataclass(frozen=True, slots=True)
+class ChatInfo:
+    chat_id: int
+    username: str | None = None
+    title: str | None = None
+
+    @property
+    def display_name(self) -> str:
+        if self.title:
+            return self.title
+        if self.username:
+            return f"@{self.username}"
+        return str(self.chat_id)
+
+
+# chat_id -> ChatInfo (общий для всех хендлеров)
+chat_cache = TTLCache(ttl=config.chat_cache_ttl_sec, maxsize=config.chat_cache_size)
+
+# chat_id -> (username, title) как сейчас записано в таблице channels
+_registry: dict[int, tuple[str | None, str | None]] = {}
+
+
+async def _load_chat_info(bot, cid: int) -> ChatInfo | None:
+    # сначала реестр каналов (он же копия таблицы channels)
+    if cid in _registry:
+        return ChatInfo(cid, *_registry[cid])
+    # потом БД (реплика: каналы меняются редко, отставание не страшно)
+    async with read_scope() as session:
+        ch = (await session.execute(select(Channel).where(Channel.chat_id == cid))).scalar_one_or_none()
+    if ch:
+        _registry[cid] = (ch.username, ch.title)
+        return ChatInfo(cid, ch.username, ch.title)
+    # если в БД нет — спрашиваем у Telegram
+    try:
+        chat = await bot.get_chat(cid)
+    except Exception:
+        return None  # не кэшируем, попробуем в следующий раз
+    return ChatInfo(cid, chat.username, chat.title)
+
+
+async def get_chat_info(bot, cid: int) -> ChatInfo:
+    info = await chat_cache.get_or_load(cid, lambda: _load_chat_info(bot, cid))
+    return info or ChatInfo(cid)
+
+
+def remember_chat(chat_id: int, username: str | None, title: str | None) -> None:
+    """Кладём свежие данные канала в кэш (например, из channel_post)."""
+    chat_cache.set(chat_id, ChatInfo(chat_id, username, title))
+
+
+async def post_link(bot, cid: int, pid: int) -> str | None:
+    info = await get_chat_info(bot, cid)
+    return build_post_link(cid, info.username, pid)
+
+
+async def load_channels() -> int:
+    """Прогрев реестра и кэша из таблицы channels (на старте)."""
+    async with read_scope() as session:
+        rows = (await session.execute(select(Channel.chat_id, Channel.username, Channel.title))).all()
+    for cid, username, title in rows:
+        _registry[cid] = (username, title)
+        remember_chat(cid, username, title)
+    return len(rows)
+
+
+async def sync_channel(chat_id: int, username: str | None, title: str | None) -> bool:
+    """Обновляем channels, только если username/title реально изменились."""
+    remember_chat(chat_id, username, title)
+    if _registry.get(chat_id) == (username, title):
+        return False
+    async with session_scope() as session:
+        await session.execute(upsert(
+            Channel,
+            [{"chat_id": chat_id, "username": username, "title": title, "created_at": datetime.utcnow()}],
+            keys=["chat_id"],
+            update=["username", "title"],
+        ))
+
+    def _synced():
+        _registry[chat_id] = (username, title)
+    # реестр — только после коммита, иначе несохранённое изменение больше не попадёт в БД
+    after_commit(_synced)
+    return True
@@ -0,0 +1,242 @@
+"""
+Несколько процессов-воркеров за одним фронтом. Фронт принимает апдейты (webhook или polling)
+и пересылает каждый своему воркеру по хэшу пользователя: все сообщения одного пользователя
+(альбомы, pending после /start, буферы) всегда попадают в один процесс с его in-memory состоянием.
+
+    python -m app.cluster --workers 4
+
+Воркер — обычный `python -m app` в webhook-режиме на 127.0.0.1:CLUSTER_WORKER_BASE_PORT+i
+(без setWebhook, с внутренним секретом). Упавший воркер перезапускается.
+"""
+import argparse, asyncio, os, secrets, signal, sys, time, zlib
+from aiohttp import ClientSession, ClientTimeout, web
+
+from .config import config
+
+_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def shard_key(update: dict) -> int:
+    """Ключ шардирования: from.id, иначе media_group_id, иначе чат, иначе сам update_id."""
+    for kind, payload in update.items():
+        if kind == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user and "id" in user:
+            return int(user["id"])
+        if payload.get("media_group_id"):
+            return zlib.crc32(str(payload["media_group_id"]).encode())
+        chat = payload.get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+    return int(update.get("update_id", 0))
+
+
+def shard_of(update: dict, n: int) -> int:
+    return shard_key(update) % n
+
+
+class Worker:
+    def __init__(self, index: int, n: int, secret: str):
+        self.index = index
+        self.port = config.cluster_worker_base_port + index
+        self.url = f"http://127.0.0.1:{self.port}{config.webhook_path}"
+        self.restarts = 0
+        self._n = n
+        self._secret = secret
+        self.proc: asyncio.subprocess.Process | None = None
+
+    def _env(self) -> dict:
+        env = dict(os.environ)
+        env.update({
+            "DELIVERY_MODE": "webhook",
+            "WEBHOOK_BASE_URL": "",              # setWebhook делает только фронт
+            "WEBHOOK_HOST": "127.0.0.1",
+            "WEBHOOK_PORT": str(self.port),
+            "WEBHOOK_SECRET": self._secret,
+            "WEBHOOK_RECORD_PATH": "",
+            "CLUSTER_WORKER_INDEX": str(self.index),
+            "CLUSTER_WORKERS": str(self._n),
+        })
+        if config.metrics_port:
+            env["METRICS_PORT"] = str(config.metrics_port + 1 + self.index)
+        return env
+
+    async def spawn(self):
+        # своя группа процессов: Ctrl+C в терминале получает только супервизор, воркеров он гасит сам
+        self.proc = await asyncio.create_subprocess_exec(sys.executable, "-m", "app", env=self._env(),
+                                                         start_new_session=True)
+
+    async def wait_ready(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.returncode is not None:
+                raise RuntimeError(f"воркер {self.index} завершился при старте (код {self.proc.returncode})")
+            try:
+                _, w = await asyncio.open_connection("127.0.0.1", self.port)
+                w.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"воркер {self.index} не поднялся за {timeout:.0f}s")
+
+    async def stop(self, timeout: float = 15.0):
+        if self.proc is None or self.proc.returncode is not None:
+            return
+        self.proc.send_signal(signal.SIGINT)  # как Ctrl+C: on_shutdown допишет очереди
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.proc.kill()
+            await self.proc.wait()
+
+
+class Front:
+    """Принимает апдейты и пересылает воркеру-владельцу; 5xx воркера отдаём наружу, чтобы Telegram повторил."""
+
+    def __init__(self, workers: list[Worker], secret: str):
+        self.workers = workers
+        self._secret = secret
+        self._http: ClientSession | None = None
+        self.forwarded = [0] * len(workers)
+        self.failed = 0
+        self.dropped = 0
+
+    async def start(self):
+        self._http = ClientSession(timeout=ClientTimeout(total=10), headers={_SECRET_HEADER: self._secret})
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+
+    async def forward(self, update: dict) -> int:
+        idx = shard_of(update, len(self.workers))
+        try:
+            async with self._http.post(self.workers[idx].url, json=update) as resp:
+                await resp.read()
+                status = resp.status
+        except Exception as e:
+            print(f"⚠️ Воркер {idx} недоступен:", e)
+            status = 503
+        if status < 300:
+            self.forwarded[idx] += 1
+        elif status < 500:
+            # воркер отверг апдейт (не временная ошибка) — повторять бесполезно
+            self.dropped += 1
+            print(f"⚠️ Воркер {idx} отверг апдейт {update.get('update_id')} ({status}), апдейт потерян")
+        else:
+            self.failed += 1
+        return status
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if config.webhook_secret and request.headers.get(_SECRET_HEADER) != config.webhook_secret:
+            return web.Response(status=401)
+        status = await self.forward(await request.json())
+        return web.Response(status=200 if status < 500 else 503)
+
+    async def poll(self, bot, allowed_updates: list[str]):
+        """
+        Режим polling: getUpdates во фронте, апдейты — по воркерам. Недоставленный апдейт повторяем,
+        пока воркер не поднимется (его перезапускает супервизор), и offset за него не двигаем:
+        при остановке фронта Telegram отдаст его снова.
+        """
+        offset = None
+        while True:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            for u in updates:
+                await self._deliver(u.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = u.update_id + 1
+
+    async def _deliver(self, raw: dict):
+        attempt = 0
+        while await self.forward(raw) >= 500:
+            attempt += 1
+            if attempt % 10 == 0:
+                print(f"⚠️ Апдейт {raw.get('update_id')} не доставлен после {attempt} попыток, повторяем")
+            await asyncio.sleep(min(0.5 * attempt, 5.0))
+
+    def stats(self) -> dict:
+        return {"forwarded": sum(self.forwarded), "failed": self.failed, "dropped": self.dropped,
+                **{f"worker{i}_forwarded": n for i, n in enumerate(self.forwarded)},
+                "restarts": sum(w.restarts for w in self.workers)}
+
+
+async def _supervise(workers: list[Worker]):
+    while True:
+        await asyncio.sleep(1)
+        for w in workers:
+            if w.proc.returncode is not None:
+                print(f"⚠️ Воркер {w.index} упал (код {w.proc.returncode}), перезапуск")
+                w.restarts += 1
+                await w.spawn()
+
+
+async def run_cluster(n: int):
+    from .__main__ import build_dispatcher, make_bot
+    from .db import engine
+    from .schema import ensure_schema
+
+    # миграции — один раз здесь, а не наперегонки из N процессов (воркеры увидят актуальную версию)
+    await ensure_schema()
+    await engine.dispose()
+
+    # SIGTERM (docker stop / systemd) — тот же штатный выход, что и Ctrl+C
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    secret = secrets.token_urlsafe(24)
+    workers = [Worker(i, n, secret) for i in range(n)]
+    for w in workers:
+        await w.spawn()
+    front = Front(workers, secret)
+    bot = make_bot()
+    runner: web.AppRunner | None = None
+    supervisor: asyncio.Task | None = None
+    try:
+        await asyncio.gather(*(w.wait_ready() for w in workers))
+        await front.start()
+        supervisor = asyncio.create_task(_supervise(workers))
+        allowed = build_dispatcher(bot, with_metrics=False).resolve_used_update_types()
+        print(f"✅ Cluster: {n} воркеров на портах {workers[0].port}..{workers[-1].port}")
+
+        if config.delivery_mode == "webhook":
+            app = web.Application()
+            app.router.add_post(config.webhook_path, front.handle)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, config.webhook_host, config.webhook_port).start()
+            if config.webhook_base_url:
+                await bot.set_webhook(
+                    url=config.webhook_base_url + config.webhook_path,
+                    secret_token=config.webhook_secret or None,
+                    allowed_updates=allowed,
+                    max_connections=min(100, config.webhook_max_concurrency * n),
+                )
+            print(f"✅ Front: {config.webhook_host}:{config.webhook_port}{config.webhook_path}")
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook()
+            print("✅ Front: polling")
+            await front.poll(bot, allowed)
+    finally:
+        if supervisor is not None:
+            supervisor.cancel()
+        if runner is not None:
+            await runner.cleanup()
+        await front.close()
+        await bot.session.close()
+        await asyncio.gather(*(w.stop() for w in workers))
+        print(f"✅ Cluster остановлен: {front.stats()}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", type=int, default=config.cluster_workers)
+    args = ap.parse_args()
+    try:
+        asyncio.run(run_cluster(max(1, args.workers)))
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Сравнение пропускной способности кластера при разном числе воркеров: поднимает app.fake_api,
+запускает `python -m app.cluster --workers N` поверх общей временной SQLite и шлёт апдейты во фронт
+(пост в канале → /start от каждого пользователя → по комментарию от каждого).
+
+    python -m app.cluster_bench --workers 1,2,4 --users 500
+
+Отчёт: комментариев/с (до уведомления админу) и время фазы /start для каждого N.
+Масштабирование упирается в число ядер машины и в блокировку записи SQLite —
+на реальной нагрузке используйте PostgreSQL/MySQL в DATABASE_URL.
+"""
+import argparse, asyncio, itertools, os, re, shutil, signal, socket, sys, tempfile, time
+from collections import defaultdict
+from aiohttp import ClientSession, ClientTimeout
+
+from .fake_api import FakeBotAPI
+from .loadtest import ADMIN_CHAT_ID, CHANNEL_ID, FIRST_UID
+
+_UID_RE = re.compile(r"UID:(\d+)")
+
+
+def _free_ports(n: int) -> list[int]:
+    socks = []
+    for _ in range(n):
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        socks.append(s)
+    ports = [s.getsockname()[1] for s in socks]
+    for s in socks:
+        s.close()
+    return ports
+
+
+def _contiguous_base(n: int) -> int:
+    # воркерам нужны подряд идущие порты base..base+n-1
+    for base in range(20000, 60000, 97):
+        try:
+            for p in range(base, base + n):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", p))
+            return base
+        except OSError:
+            continue
+    raise RuntimeError("нет свободного диапазона портов")
+
+
+class Observer:
+    """Ждём «отправленные» ботом сообщения: ответы пользователю и уведомления админу."""
+
+    def __init__(self, api: FakeBotAPI):
+        self.to_user: dict[int, int] = defaultdict(int)
+        self.notified: set[int] = set()
+        self._changed = asyncio.Event()
+        api.on_message(self._on_message)
+
+    def _on_message(self, chat_id: int, msg: dict):
+        if chat_id == ADMIN_CHAT_ID:
+            m = _UID_RE.search(msg.get("text") or msg.get("caption") or "")
+            if m:
+                self.notified.add(int(m.group(1)))
+        else:
+            self.to_user[chat_id] += 1
+        self._changed.set()
+
+    async def wait(self, done, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not done():
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), min(left, 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+
+async def _wait_port(port: int, proc: asyncio.subprocess.Process, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.returncode is not None:
+            raise RuntimeError(f"кластер завершился при старте (код {proc.returncode})")
+        try:
+            _, w = await asyncio.open_connection("127.0.0.1", port)
+            w.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("фронт кластера не поднялся")
+
+
+async def _run_one(n: int, args) -> dict:
+    db_dir = tempfile.mkdtemp(prefix="cluster_bench_")
+    api = FakeBotAPI(seed=args.seed)
+    base_url = await api.start()
+    obs = Observer(api)
+    front_port, = _free_ports(1)
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": "42:fake",
+        "BOT_USERNAME": "fake_bot",
+        "TELEGRAM_API_BASE": base_url,
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(db_dir, 'cluster.db')}",
+        "DATABASE_READ_URL": "",
+        "ADMIN_CHAT_ID": str(ADMIN_CHAT_ID),
+        "ALLOWED_CHANNEL_IDS": str(CHANNEL_ID),
+        "DELIVERY_MODE": "webhook",
+        "WEBHOOK_BASE_URL": "",
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(front_port),
+        "WEBHOOK_SECRET": "",
+        "WEBHOOK_RECORD_PATH": "",
+        "CLUSTER_WORKER_BASE_PORT": str(_contiguous_base(n)),
+        "METRICS_PORT": "0",
+        "PENDING_PERSIST": "0",
+        "SEND_GLOBAL_PER_SEC": "100000",
+        "SEND_PRIVATE_PER_SEC": "100000",
+        "SEND_GROUP_PER_MIN": "6000000",
+    })
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "app.cluster", "--workers", str(n), env=env,
+        stdout=None if args.verbose else asyncio.subprocess.DEVNULL,
+    )
+    update_ids = itertools.count(1)
+    msg_ids: dict[int, itertools.count] = defaultdict(lambda: itertools.count(1))
+    url = f"http://127.0.0.1:{front_port}{env.get('WEBHOOK_PATH') or '/webhook'}"
+    sem = asyncio.Semaphore(args.concurrency)
+
+    def message(chat: dict, sender: dict | None, **body) -> dict:
+        msg = {"message_id": next(msg_ids[chat["id"]]), "date": int(time.time()), "chat": chat, **body}
+        if sender:
+            msg["from"] = sender
+        return msg
+
+    try:
+        await _wait_port(front_port, proc)
+        async with ClientSession(timeout=ClientTimeout(total=30)) as http:
+            async def post(key: str, msg: dict):
+                async with sem:
+                    async with http.post(url, json={"update_id": next(update_ids), key: msg}) as resp:
+                        await resp.read()
+
+            channel = {"id": CHANNEL_ID, "type": "channel", "title": "Нагрузочный канал", "username": "load_channel"}
+            post_msg = message(channel, None, text="Новый пост " + "текст " * 20)
+            calls_before = sum(api.calls.values())
+            await post("channel_post", post_msg)
+            await obs.wait(lambda: sum(api.calls.values()) > calls_before, 10)
+            await asyncio.sleep(0.5)  # канал зарегистрирован в БД
+
+            users = [FIRST_UID + i for i in range(args.users)]
+
+            def private(uid: int) -> tuple[dict, dict]:
+                return ({"id": uid, "type": "private", "first_name": f"u{uid}"},
+                        {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"})
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(post("message", message(*private(uid), text=f"/start {CHANNEL_ID}msg{post_msg['message_id']}"))
+                                   for uid in users))
+            started = await obs.wait(lambda: all(obs.to_user[u] >= 1 for u in users), args.timeout)
+            start_s = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(post("message", message(*private(uid), text="Комментарий " * 5)) for uid in users))
+            await obs.wait(lambda: len(obs.notified) >= len(users), args.timeout)
+            comments_s = time.perf_counter() - t0
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(proc.wait(), 30)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+        await api.stop()
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    return {
+        "workers": n,
+        "start_s": start_s,
+        "started_ok": started,
+        "comments_s": comments_s,
+        "notified": len(obs.notified),
+        "rate": len(obs.notified) / comments_s if comments_s else 0.0,
+    }
+
+
+async def _run(args):
+    results = []
+    for n in args.workers:
+        print(f"… workers={n}")
+        results.append(await _run_one(n, args))
+    print(f"\nПользователей: {args.users}, ядер: {os.cpu_count()}")
+    print(f"{'workers':>8} {'/start, s':>10} {'comments, s':>12} {'notified':>9} {'comments/s':>11}")
+    for r in results:
+        flag = "" if r["started_ok"] else "  (не все /start обработаны)"
+        print(f"{r['workers']:>8} {r['start_s']:>10.2f} {r['comments_s']:>12.2f} "
+              f"{r['notified']:>9} {r['rate']:>11.1f}{flag}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", default="1,2,4", help="список N через запятую")
+    ap.add_argument("--users", type=int, default=300)
+    ap.add_argument("--concurrency", type=int, default=100, help="одновременных запросов во фронт")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("-v", "--verbose", action="store_true", help="показывать вывод кластера")
+    args = ap.parse_args()
+    args.workers = [int(x) for x in args.workers.split(",") if x.strip()]
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
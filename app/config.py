@@ -20,6 +20,34 @@ class Config:
     # Бот
     bot_token: str = field(default_factory=lambda: os.getenv("BOT_TOKEN", ""))
     bot_username: str = field(default_factory=lambda: os.getenv("BOT_USERNAME", ""))
+    telegram_api_base: str = field(default_factory=lambda: os.getenv("TELEGRAM_API_BASE", "").rstrip("/"))
+
+    # Получение апдейтов: polling | webhook
+    delivery_mode: str = field(default_factory=lambda: os.getenv("DELIVERY_MODE", "polling").strip().lower())
+    webhook_base_url: str = field(default_factory=lambda: os.getenv("WEBHOOK_BASE_URL", "").rstrip("/"))
+    webhook_path: str = field(default_factory=lambda: os.getenv("WEBHOOK_PATH", "/webhook"))
+    webhook_host: str = field(default_factory=lambda: os.getenv("WEBHOOK_HOST", "0.0.0.0"))
+    webhook_port: int = field(default_factory=lambda: int(os.getenv("WEBHOOK_PORT", "8080")))
+    webhook_secret: str = field(default_factory=lambda: os.getenv("WEBHOOK_SECRET", ""))
+    webhook_max_concurrency: int = field(default_factory=lambda: int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64")))
+    webhook_record_path: str = field(default_factory=lambda: os.getenv("WEBHOOK_RECORD_PATH", ""))
+
+    # Кластер (python -m app.cluster): воркеры слушают base_port, base_port+1, ...
+    cluster_workers: int = field(default_factory=lambda: int(os.getenv("CLUSTER_WORKERS", "2")))
+    cluster_worker_base_port: int = field(default_factory=lambda: int(os.getenv("CLUSTER_WORKER_BASE_PORT", "8100")))
+    cluster_worker_index: int = field(default_factory=lambda: int(os.getenv("CLUSTER_WORKER_INDEX", "0")))  # задаёт app.cluster
+    # на сколько воркеров app.cluster делит апдейты этого процесса (1 — обычный `python -m app`)
+    cluster_shards: int = field(default_factory=lambda: int(os.getenv("CLUSTER_WORKERS", "1")) if os.getenv("CLUSTER_WORKER_INDEX") else 1)
+
+    # Очередь апдейтов на пользователя: строго по порядку внутри ключа, параллельно между ключами
+    mailbox_max_concurrency: int = field(default_factory=lambda: int(os.getenv("MAILBOX_MAX_CONCURRENCY", "64")))
+    mailbox_max_per_key: int = field(default_factory=lambda: int(os.getenv("MAILBOX_MAX_PER_KEY", "50")))
+
+    # Исходящие отправки (flood control)
+    send_global_per_sec: float = field(default_factory=lambda: float(os.getenv("SEND_GLOBAL_PER_SEC", "25")))
+    send_private_per_sec: float = field(default_factory=lambda: float(os.getenv("SEND_PRIVATE_PER_SEC", "1")))
+    send_group_per_min: float = field(default_factory=lambda: float(os.getenv("SEND_GROUP_PER_MIN", "20")))
+    send_max_retries: int = field(default_factory=lambda: int(os.getenv("SEND_MAX_RETRIES", "3")))
 
     # Админ и канал(ы)
     admin_chat_id: int = field(default_factory=lambda: int(os.getenv("ADMIN_CHAT_ID", "0")))
@@ -27,10 +55,77 @@ class Config:
 
     # БД
     database_url: str = field(default_factory=lambda: os.getenv("DATABASE_URL", "sqlite+aiosqlite:///bot.db"))
+    # реплика для чтений, которым не нужны свежие записи (пусто — всё на DATABASE_URL)
+    database_read_url: str = field(default_factory=lambda: os.getenv("DATABASE_READ_URL", "").strip())
+    db_pool_size: int = field(default_factory=lambda: int(os.getenv("DB_POOL_SIZE", "10")))
+    db_max_overflow: int = field(default_factory=lambda: int(os.getenv("DB_MAX_OVERFLOW", "20")))
+    db_pool_timeout: float = field(default_factory=lambda: float(os.getenv("DB_POOL_TIMEOUT", "30")))
+
+    # Кэш данных каналов (username/title для ссылок на пост)
+    chat_cache_ttl_sec: float = field(default_factory=lambda: float(os.getenv("CHAT_CACHE_TTL_SEC", "600")))
+    chat_cache_size: int = field(default_factory=lambda: int(os.getenv("CHAT_CACHE_SIZE", "1024")))
+
+    # tg_id -> users.id (регистрация по /start, FK для комментариев)
+    user_cache_size: int = field(default_factory=lambda: int(os.getenv("USER_CACHE_SIZE", "100000")))
+    user_cache_ttl_sec: float = field(default_factory=lambda: float(os.getenv("USER_CACHE_TTL_SEC", "86400")))
+    # прогрев на старте: столько недавно писавших пользователей (0 — без прогрева)
+    user_warm_limit: int = field(default_factory=lambda: int(os.getenv("USER_WARM_LIMIT", "5000")))
+    user_warm_hours: float = field(default_factory=lambda: float(os.getenv("USER_WARM_HOURS", "24")))
+
+    # file_unique_id -> media.id: повторные файлы пишутся без запроса к media
+    media_cache_size: int = field(default_factory=lambda: int(os.getenv("MEDIA_CACHE_SIZE", "50000")))
+
+    # Ожидающие комментарии (пользователь нажал кнопку, но ещё не написал)
+    pending_ttl_sec: float = field(default_factory=lambda: float(os.getenv("PENDING_TTL_SEC", "3600")))
+    pending_max: int = field(default_factory=lambda: int(os.getenv("PENDING_MAX", "10000")))
+    pending_persist: bool = field(default_factory=lambda: os.getenv("PENDING_PERSIST", "0").strip().lower() in ("1", "true", "yes"))
+
+    # Сборка альбомов: дебаунс с каждой новой частью, но не дольше max_wait
+    album_debounce_sec: float = field(default_factory=lambda: float(os.getenv("ALBUM_DEBOUNCE_SEC", "0.35")))
+    album_max_wait_sec: float = field(default_factory=lambda: float(os.getenv("ALBUM_MAX_WAIT_SEC", "2.0")))
+    album_max_open: int = field(default_factory=lambda: int(os.getenv("ALBUM_MAX_OPEN", "1000")))
+
+    # Пакетная запись комментариев (write-behind)
+    write_batch_size: int = field(default_factory=lambda: int(os.getenv("WRITE_BATCH_SIZE", "200")))
+    write_flush_sec: float = field(default_factory=lambda: float(os.getenv("WRITE_FLUSH_SEC", "0.5")))
+
+    # Outbox уведомлений о комментариях: воркеры доставки, опрос БД, аренда записи, повторы
+    outbox_workers: int = field(default_factory=lambda: int(os.getenv("OUTBOX_WORKERS", "4")))
+    outbox_poll_sec: float = field(default_factory=lambda: float(os.getenv("OUTBOX_POLL_SEC", "5")))
+    outbox_lease_sec: float = field(default_factory=lambda: float(os.getenv("OUTBOX_LEASE_SEC", "300")))
+    outbox_max_attempts: int = field(default_factory=lambda: int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10")))
+    outbox_backoff_sec: float = field(default_factory=lambda: float(os.getenv("OUTBOX_BACKOFF_SEC", "2")))
+    outbox_backoff_max_sec: float = field(default_factory=lambda: float(os.getenv("OUTBOX_BACKOFF_MAX_SEC", "600")))
+
+    # Дайджест админу: больше THRESHOLD новых комментариев к посту за RATE_WINDOW — текстовые
+    # копятся WINDOW секунд и уходят одним сообщением (не больше MAX_ITEMS); 0 в пороге — выключено.
+    # Порог — на весь бот: в кластере воркер считает только свою долю потока и сравнивает её
+    # с THRESHOLD / число воркеров (пользователи шардятся равномерно, поэтому приблизительно)
+    admin_digest_threshold: int = field(default_factory=lambda: int(os.getenv("ADMIN_DIGEST_THRESHOLD", "0")))
+    admin_digest_rate_window_sec: float = field(default_factory=lambda: float(os.getenv("ADMIN_DIGEST_RATE_WINDOW_SEC", "60")))
+    admin_digest_window_sec: float = field(default_factory=lambda: float(os.getenv("ADMIN_DIGEST_WINDOW_SEC", "30")))
+    admin_digest_max_items: int = field(default_factory=lambda: int(os.getenv("ADMIN_DIGEST_MAX_ITEMS", "20")))
+
+    # Обслуживание БД: удаление отживших строк пачками (0 в интервале — выключено)
+    maintenance_interval_sec: float = field(default_factory=lambda: float(os.getenv("MAINTENANCE_INTERVAL_SEC", "3600")))
+    maintenance_batch: int = field(default_factory=lambda: int(os.getenv("MAINTENANCE_BATCH", "500")))
+    maintenance_pause_sec: float = field(default_factory=lambda: float(os.getenv("MAINTENANCE_PAUSE_SEC", "0.2")))
+    # сроки хранения, дней; 0 — хранить всегда
+    comment_retention_days: float = field(default_factory=lambda: float(os.getenv("COMMENT_RETENTION_DAYS", "0")))
+    route_retention_days: float = field(default_factory=lambda: float(os.getenv("ROUTE_RETENTION_DAYS", "0")))
+    outbox_retention_days: float = field(default_factory=lambda: float(os.getenv("OUTBOX_RETENTION_DAYS", "7")))
+    # куда складывать удаляемые комментарии (JSONL, как у app.export); пусто — удалять без архива
+    comment_archive_dir: str = field(default_factory=lambda: os.getenv("COMMENT_ARCHIVE_DIR", ""))
+
+    # Маршруты ответов: message_id служебного сообщения -> адресат (LRU перед таблицей)
+    route_cache_size: int = field(default_factory=lambda: int(os.getenv("ROUTE_CACHE_SIZE", "50000")))
+    route_cache_ttl_sec: float = field(default_factory=lambda: float(os.getenv("ROUTE_CACHE_TTL_SEC", "86400")))
 
     # Антиспам
     rate_window_sec: int = field(default_factory=lambda: int(os.getenv("RATE_LIMIT_WINDOW_SEC", "10")))
     rate_per_hour: int = field(default_factory=lambda: int(os.getenv("RATE_LIMIT_PER_HOUR", "12")))
+    rate_flush_interval_sec: float = field(default_factory=lambda: float(os.getenv("RATE_LIMIT_FLUSH_SEC", "5")))
+    rate_cache_size: int = field(default_factory=lambda: int(os.getenv("RATE_LIMIT_CACHE_SIZE", "100000")))
 
     # Реакции
     auto_reactions: list[str] = field(default_factory=list)        # Unicode-эмодзи
@@ -39,6 +134,14 @@ class Config:
     reaction_attempts: int = field(default_factory=lambda: int(os.getenv("REACTION_ATTEMPTS", "3")))
     reaction_big_prob: float = field(default_factory=lambda: float(os.getenv("REACTION_BIG_PROB", "0.25")))
 
+    # Фоновое оформление постов (кнопка + реакции)
+    decorate_workers: int = field(default_factory=lambda: int(os.getenv("DECORATE_WORKERS", "4")))
+    decorate_queue: int = field(default_factory=lambda: int(os.getenv("DECORATE_QUEUE", "1000")))
+
+    # Метрики Prometheus (/metrics); 0 — выключено
+    metrics_host: str = field(default_factory=lambda: os.getenv("METRICS_HOST", "127.0.0.1"))
+    metrics_port: int = field(default_factory=lambda: int(os.getenv("METRICS_PORT", "0")))
+
     # (не используется больше, можно удалить позже)
     deep_link_secret: str = field(default_factory=lambda: os.getenv("DEEP_LINK_SECRET", ""))
 
@@ -53,6 +156,24 @@ class Config:
         self.custom_reaction_ids = _split_csv_env("CUSTOM_REACTION_IDS")
 
         # нормализуем границы
+        if self.delivery_mode not in ("polling", "webhook"):
+            self.delivery_mode = "polling"
+        if self.webhook_max_concurrency < 1:
+            self.webhook_max_concurrency = 1
+        if self.outbox_workers < 1:
+            self.outbox_workers = 1
+        if self.mailbox_max_concurrency < 1:
+            self.mailbox_max_concurrency = 1
+        if self.mailbox_max_per_key < 1:
+            self.mailbox_max_per_key = 1
+        if self.user_warm_limit < 0:
+            self.user_warm_limit = 0
+        if self.maintenance_batch < 1:
+            self.maintenance_batch = 1
+        if self.cluster_shards < 1:
+            self.cluster_shards = 1
+        if self.admin_digest_max_items < 1:
+            self.admin_digest_max_items = 1
         if self.reaction_max_count < 1:
             self.reaction_max_count = 1
         if self.reaction_attempts < 1:
@@ -1,19 +1,272 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable
+from sqlalchemy import event, func, insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from .config import config
 
 class Base(DeclarativeBase):
     pass
 
-engine = create_async_engine(
-    config.database_url,
-    echo=False,
-    future=True,
-    pool_pre_ping=True,   # восстанавливает отвалившиеся коннекты
-    pool_recycle=3600     # перебирает соединения раз в час (MySQL best‑practice)
-)
+def _sqlite_wal(dbapi_conn, _):
+    # WAL: читатели не блокируют запись, и апдейт, начавший транзакцию с чтения,
+    # не упирается в «database is locked» при коммите фоновой пачки writer'а
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.close()
+
+
+def _make_engine(url: str):
+    # размеры пула — только для серверных БД (у SQLite свой пул без этих параметров);
+    # у SQLite вместо ожидания соединения — ожидание блокировки записи
+    pool_kw = dict(connect_args={"timeout": config.db_pool_timeout}) if make_url(url).get_backend_name() == "sqlite" else dict(
+        pool_size=config.db_pool_size,
+        max_overflow=config.db_max_overflow,
+        pool_timeout=config.db_pool_timeout,
+    )
+    eng = create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        pool_pre_ping=True,   # восстанавливает отвалившиеся коннекты
+        pool_recycle=3600,    # перебирает соединения раз в час (MySQL best‑practice)
+        **pool_kw,
+    )
+    if eng.dialect.name == "sqlite":
+        event.listen(eng.sync_engine, "connect", _sqlite_wal)
+    return eng
+
+
+engine = _make_engine(config.database_url)
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+# реплика для чтения; без DATABASE_READ_URL — тот же primary
+read_engine = _make_engine(config.database_read_url) if config.database_read_url else engine
+ReadSessionLocal = async_sessionmaker(read_engine, expire_on_commit=False, class_=AsyncSession)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_write(state):
+    if not state.is_select:
+        state.session.info["wrote"] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_flush(session, _):
+    session.info["wrote"] = True
+
+
+class UpdateSession:
+    """Одна сессия на апдейт: открывается при первом обращении, коммит/откат — один раз в конце."""
+    __slots__ = ("_session", "_on_commit", "_wrote", "closed", "task")
+
+    def __init__(self):
+        self._session: AsyncSession | None = None
+        self._on_commit: list[Callable[[], None]] = []
+        self._wrote = False
+        self.closed = False
+        self.task = asyncio.current_task()  # задача апдейта; копии контекста в чужих задачах сессию не трогают
+
+    @property
+    def wrote(self) -> bool:
+        """Апдейт уже что-то записал (в т.ч. до промежуточного коммита)."""
+        return self._wrote or (self._session is not None and self._session.info.get("wrote", False))
+
+    @property
+    def dirty(self) -> bool:
+        """В открытой транзакции есть незакоммиченные записи."""
+        s = self._session
+        return s is not None and bool(s.info.get("wrote") or s.new or s.dirty or s.deleted)
+
+    def get(self) -> AsyncSession:
+        if self._session is None:
+            self._session = SessionLocal()
+        return self._session
+
+    async def commit(self):
+        """Промежуточный коммит: сессия остаётся апдейту, следующие запросы — в новой транзакции."""
+        if self._session is None:
+            return
+        await self._session.commit()
+        self._wrote = self.wrote
+        self._session.info["wrote"] = False
+        callbacks, self._on_commit = self._on_commit, []
+        for fn in callbacks:
+            fn()
+
+    async def finish(self, ok: bool):
+        self.closed = True
+        session, self._session = self._session, None
+        if session is None:
+            return
+        try:
+            if ok:
+                await session.commit()
+            else:
+                await session.rollback()
+        finally:
+            await session.close()
+        if ok:
+            for fn in self._on_commit:
+                fn()
+
+
+_current: ContextVar[UpdateSession | None] = ContextVar("db_update_session", default=None)
+
+
+def begin_update_session() -> tuple[UpdateSession, object]:
+    us = UpdateSession()
+    return us, _current.set(us)
+
+
+def end_update_session(token):
+    _current.reset(token)
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    Внутри апдейта — общая сессия апдейта (коммит сделает middleware),
+    вне его (фон, старт) — своя сессия с коммитом на выходе.
+    """
+    us = _current.get()
+    if us is not None and not us.closed:
+        session = us.get()
+        yield session
+        if not session.info.get("wrote") and not (session.new or session.dirty or session.deleted):
+            await session.commit()  # только чтение — сразу возвращаем соединение в пул, не держим его на время отправок
+        return
+    async with SessionLocal() as session:
+        yield session
+        await session.commit()
+
+
+class _ReadStats:
+    __slots__ = ("replica", "primary")
+
+    def __init__(self):
+        self.replica = 0
+        self.primary = 0
+
+    def stats(self) -> dict:
+        return {"replica": self.replica, "primary": self.primary, "enabled": read_engine is not engine}
+
+
+read_stats = _ReadStats()
+
+
+@asynccontextmanager
+async def read_scope(fresh: bool = False) -> AsyncIterator[AsyncSession]:
+    """
+    Сессия для чтения. С DATABASE_READ_URL — своя короткая сессия на реплике;
+    на primary (как session_scope) остаются чтения с fresh=True и все чтения апдейта,
+    который уже писал: реплика может отставать и не видеть его записей.
+    """
+    us = _current.get()
+    if read_engine is engine or fresh or (us is not None and not us.closed and us.wrote):
+        read_stats.primary += 1
+        async with session_scope() as session:
+            yield session
+        return
+    read_stats.replica += 1
+    async with ReadSessionLocal() as session:
+        yield session
+
+
+async def commit_update_session():
+    """
+    Фиксируем уже записанное апдейтом, не дожидаясь его конца: нужно перед ожиданием
+    фоновой записи, которая ссылается на эти строки (иначе она ждёт наших блокировок, а мы — её).
+    """
+    us = _current.get()
+    if us is not None and not us.closed:
+        await us.commit()
+
+
+async def commit_before_io():
+    """
+    Перед сетевым ожиданием (Bot API) фиксируем записанное апдейтом: иначе транзакция
+    и write-блокировка SQLite держатся всё время запроса к Telegram.
+    """
+    us = _current.get()
+    if us is not None and not us.closed and us.task is asyncio.current_task() and us.dirty:
+        await us.commit()
+
+
+def after_commit(fn: Callable[[], None]):
+    """fn после коммита сессии апдейта; вне апдейта (scope уже закоммичен) — сразу."""
+    us = _current.get()
+    if us is not None and not us.closed:
+        us._on_commit.append(fn)
+    else:
+        fn()
+
 async def init_models():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+
+def upsert(model, rows: list[dict], keys: list[str], update: list[str]):
+    """
+    Пакетный upsert на родном синтаксисе диалекта:
+    MySQL — ON DUPLICATE KEY UPDATE, SQLite/PostgreSQL — ON CONFLICT DO UPDATE.
+    """
+    table = model.__table__
+    if engine.dialect.name == "mysql":
+        stmt = mysql_insert(table).values(rows)
+        return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update})
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    stmt = insert(table).values(rows)
+    return stmt.on_conflict_do_update(index_elements=keys, set_={c: stmt.excluded[c] for c in update})
+
+def insert_ignore(model, rows: list[dict], keys: list[str]):
+    """
+    Пакетная вставка только отсутствующих строк (конфликт по keys — пропуск):
+    MySQL — INSERT IGNORE, SQLite/PostgreSQL — ON CONFLICT DO NOTHING.
+    """
+    table = model.__table__
+    if engine.dialect.name == "mysql":
+        return mysql_insert(table).values(rows).prefix_with("IGNORE")
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    return insert(table).values(rows).on_conflict_do_nothing(index_elements=keys)
+
+async def upsert_returning_id(session: AsyncSession, model, row: dict, keys: list[str], update: list[str]) -> int:
+    """
+    Upsert одной строки и id записи (новой или уже существующей) за один запрос:
+    MySQL — трюк id = LAST_INSERT_ID(id), SQLite/PostgreSQL — RETURNING.
+    """
+    table = model.__table__
+    if engine.dialect.name == "mysql":
+        stmt = mysql_insert(table).values(row)
+        stmt = stmt.on_duplicate_key_update({
+            **{c: stmt.inserted[c] for c in update},
+            "id": func.last_insert_id(table.c.id),
+        })
+        return (await session.execute(stmt)).lastrowid
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    stmt = insert(table).values(row)
+    stmt = stmt.on_conflict_do_update(index_elements=keys, set_={c: stmt.excluded[c] for c in update})
+    return (await session.execute(stmt.returning(table.c.id))).scalar_one()
+
+async def insert_returning_ids(session: AsyncSession, model, rows: list[dict]) -> list[int]:
+    """
+    Пакетная вставка и id новых строк в порядке rows, без запроса на строку:
+    SQLite/PostgreSQL — INSERT … RETURNING (insertmanyvalues, порядок по параметрам),
+    MySQL — один многострочный INSERT: InnoDB выдаёт ему подряд идущие id, первый — LAST_INSERT_ID()
+    (при auto_increment_increment = 1, как у нас везде).
+    """
+    if not rows:
+        return []
+    table = model.__table__
+    if engine.dialect.name == "mysql":
+        first = (await session.execute(mysql_insert(table).values(rows))).lastrowid
+        return list(range(first, first + len(rows)))
+    stmt = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+    return list((await session.execute(stmt, rows)).scalars())
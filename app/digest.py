@@ -0,0 +1,123 @@
+"""
+Дайджест уведомлений админу: когда на пост приходит больше ADMIN_DIGEST_THRESHOLD комментариев
+за ADMIN_DIGEST_RATE_WINDOW_SEC, текстовые комментарии копятся ADMIN_DIGEST_WINDOW_SEC и уходят
+одним сообщением (сборку и доставку делает app.outbox). Медиа-комментарии идут как обычно.
+
+Адресаты дайджеста записываются при отправке (routes.remember_digest): ответ админа выбирает
+комментарий по префиксу «#N» или по цитате (Telegram quote), но только среди записанных —
+метки «#N UID:…» в тексте для людей, а текст комментария пишет пользователь и может их подделать.
+"""
+import html, math, re, time
+from collections import deque
+
+from .config import config
+
+# лимит Telegram — 4096 символов; считаем по HTML-исходнику с запасом (теги в лимит не входят)
+MAX_TEXT = 3800
+ITEM_TEXT_MAX = 600
+
+_PREFIX_RE = re.compile(r"^\s*#(\d+)\b[\s:.,—-]*")
+
+
+class DigestGate:
+    """
+    Частота новых комментариев на пост: выше порога — пора собирать дайджест.
+    Счёт в памяти процесса; в кластере у воркера своя доля потока — порог делим на число воркеров.
+    """
+
+    _MAX_KEYS = 4096
+
+    def __init__(self, threshold: int, window: float, shards: int = 1):
+        self.threshold = math.ceil(threshold / max(1, shards)) if threshold > 0 else 0
+        self.window = window
+        self._hits: dict[tuple[int, int], deque] = {}
+        self.digested = 0
+
+    def hit(self, cid: int, pid: int) -> bool:
+        """Учитываем комментарий к посту; True — поток выше порога (уведомление — в дайджест)."""
+        if self.threshold <= 0:
+            return False
+        now = time.monotonic()
+        q = self._hits.get((cid, pid))
+        if q is None:
+            if len(self._hits) >= self._MAX_KEYS:
+                self._prune(now)
+            q = self._hits[(cid, pid)] = deque()
+        q.append(now)
+        while q and q[0] <= now - self.window:
+            q.popleft()
+        if len(q) > self.threshold:
+            self.digested += 1
+            return True
+        return False
+
+    def _prune(self, now: float):
+        for key in [k for k, q in self._hits.items() if not q or q[-1] <= now - self.window]:
+            del self._hits[key]
+
+    def stats(self) -> dict:
+        return {"posts": len(self._hits), "digested": self.digested, "threshold": self.threshold}
+
+
+def _utf16_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+
+def _item(n: int, who: str, text: str, route: tuple[int, int, int]) -> tuple[str, str]:
+    """Блок комментария: (HTML, тот же текст без разметки — как его покажет Telegram)."""
+    uid, cid, pid = route
+    if len(text) > ITEM_TEXT_MAX:
+        text = text[:ITEM_TEXT_MAX] + "…"
+    markers = f"#{n} UID:{uid} CID:{cid} PID:{pid}"
+    return (
+        f"<b>#{n}</b> {html.escape(who)}\n<blockquote>{html.escape(text)}</blockquote>\n"
+        f"<tg-spoiler>{markers}</tg-spoiler>\n\n",
+        f"#{n} {who}\n{text}\n{markers}\n\n",
+    )
+
+
+def item_size(who: str, text: str, route: tuple[int, int, int]) -> int:
+    return len(_item(config.admin_digest_max_items, who, text, route)[0])
+
+
+def render(link: str | None, cid: int, pid: int,
+           items: list[tuple[str, str, tuple[int, int, int]]]) -> tuple[str, list[tuple[int, int]]]:
+    """
+    items — (who, text, route) в порядке поступления; нумерация с 1.
+    Возвращает HTML и границы блоков в тексте сообщения (UTF-16) — по ним ответ с цитатой находит #N.
+    """
+    head = (
+        f"📚 <b>Новые комментарии: {len(items)}</b>\n"
+        f"Пост: {html.escape(link) if link else f'chat_id={cid}, msg_id={pid}'}\n\n"
+    )
+    pos = _utf16_len(html.unescape(re.sub(r"<[^>]+>", "", head)))
+    parts, spans = [head], []
+    for n, (who, text, route) in enumerate(items, 1):
+        h, plain = _item(n, who, text, route)
+        end = pos + _utf16_len(plain)
+        parts.append(h)
+        spans.append((pos, end))
+        pos = end
+    parts.append("Чтобы ответить, процитируйте комментарий в ответе на это сообщение или начните ответ с #N.")
+    return "".join(parts), spans
+
+
+def pick(items: list[tuple[tuple, int, int]], quote_position: int | None, body: str) -> tuple[tuple | None, str]:
+    """
+    Адресат ответа на дайджест среди записанных items (Route, начало, конец): по префиксу «#N»
+    (он же срезается из body), иначе по позиции цитаты, иначе — единственный. (None, body) — выбрать нельзя.
+    """
+    pm = _PREFIX_RE.match(body)
+    if pm and 1 <= int(pm.group(1)) <= len(items):
+        return items[int(pm.group(1)) - 1][0], body[pm.end():]
+    if quote_position is not None:
+        for route, start, end in items:
+            if start <= quote_position < end:
+                return route, body
+    if len(items) == 1:
+        return items[0][0], body
+    return None, body
+
+
+gate = DigestGate(threshold=config.admin_digest_threshold, window=config.admin_digest_rate_window_sec,
+                  shards=config.cluster_shards)
@@ -0,0 +1,149 @@
+"""
+Выгрузка комментариев (с автором и медиа) для аналитики — потоково, память не растёт с размером таблицы.
+
+    python -m app.export -o comments.jsonl
+    python -m app.export -o comments.csv --channel -1001234567890 --since 2026-01-01 --until 2026-02-01
+    python -m app.export --format jsonl -o - | gzip > comments.jsonl.gz
+
+Читает с реплики (DATABASE_READ_URL), если она задана. Комментарии идут пачками по PK
+(keyset: id > последнего выгруженного), каждая пачка — своя короткая транзакция со stream()
+(на MySQL — серверный курсор), медиа пачки — одним запросом по её id.
+"""
+import argparse, asyncio, csv, json, sys, time
+from datetime import datetime
+from sqlalchemy import select
+
+from .db import ReadSessionLocal, read_engine
+from .models import Comment, CommentMedia, Media, User
+
+CSV_FIELDS = ["id", "created_at", "channel_chat_id", "post_id", "user_tg_id", "username", "text", "media"]
+
+
+def _comments_query(after_id: int, limit: int, channels: list[int], since: datetime | None, until: datetime | None):
+    stmt = (
+        select(Comment.id, Comment.created_at, Comment.channel_chat_id, Comment.post_id,
+               User.tg_id, User.username, Comment.text)
+        .join(User, User.id == Comment.user_id)
+        .where(Comment.id > after_id)
+    )
+    if channels:
+        stmt = stmt.where(Comment.channel_chat_id.in_(channels))
+    if since:
+        stmt = stmt.where(Comment.created_at >= since)
+    if until:
+        stmt = stmt.where(Comment.created_at < until)
+    return stmt.order_by(Comment.id).limit(limit)
+
+
+async def load_chunk(session, after_id: int, limit: int, channels: list[int] = (),
+                     since: datetime | None = None, until: datetime | None = None) -> list[dict]:
+    """Следующая пачка комментариев после after_id — готовые dict'ы с медиа (их же пишет архив app.maintenance)."""
+    result = await session.stream(
+        _comments_query(after_id, limit, list(channels), since, until).execution_options(yield_per=limit)
+    )
+    rows = [row async for row in result]
+    if not rows:
+        return []
+    media: dict[int, list[dict]] = {}
+    result = await session.stream(
+        select(CommentMedia.comment_id, Media.media_type, Media.file_unique_id, Media.file_id,
+               CommentMedia.media_group_id)
+        .join(Media, Media.id == CommentMedia.media_id)
+        .where(CommentMedia.comment_id.in_([r.id for r in rows]))
+        .order_by(CommentMedia.id)
+        .execution_options(yield_per=limit)
+    )
+    async for cid, mtype, fuid, fid, mgid in result:
+        media.setdefault(cid, []).append(
+            {"type": mtype, "file_unique_id": fuid, "file_id": fid, "media_group_id": mgid})
+    return [{
+        "id": r.id,
+        "created_at": r.created_at.isoformat(),
+        "channel_chat_id": r.channel_chat_id,
+        "post_id": r.post_id,
+        "user_tg_id": r.tg_id,
+        "username": r.username,
+        "text": r.text,
+        "media": media.get(r.id, []),
+    } for r in rows]
+
+
+async def iter_comments(channels: list[int] = (), since: datetime | None = None, until: datetime | None = None,
+                        chunk: int = 1000):
+    """Комментарии по одному (dict с media), пачками по chunk; в памяти — не больше одной пачки."""
+    after_id = 0
+    while True:
+        async with ReadSessionLocal() as session:
+            items = await load_chunk(session, after_id, chunk, channels, since, until)
+        for item in items:
+            yield item
+        if len(items) < chunk:
+            return
+        after_id = items[-1]["id"]
+
+
+class JsonlWriter:
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, item: dict):
+        self.f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+
+class _CsvWriter:
+    """Строка на комментарий; медиа — «type:file_unique_id» через пробел."""
+
+    def __init__(self, f):
+        self.w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        self.w.writeheader()
+
+    def write(self, item: dict):
+        self.w.writerow({**item, "media": " ".join(f"{m['type']}:{m['file_unique_id']}" for m in item["media"])})
+
+
+async def export(out, fmt: str, channels: list[int], since: datetime | None, until: datetime | None,
+                 chunk: int) -> int:
+    writer = _CsvWriter(out) if fmt == "csv" else JsonlWriter(out)
+    n = 0
+    t0 = time.perf_counter()
+    async for item in iter_comments(channels, since, until, chunk):
+        writer.write(item)
+        n += 1
+        if n % (chunk * 10) == 0:
+            out.flush()
+            print(f"… {n} комментариев, {n / (time.perf_counter() - t0):.0f}/с", file=sys.stderr)
+    out.flush()
+    return n
+
+
+def _parse_dt(s: str) -> datetime:
+    return datetime.fromisoformat(s)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Потоковая выгрузка комментариев в JSONL/CSV")
+    ap.add_argument("-o", "--out", default="-", help="файл (- — stdout)")
+    ap.add_argument("--format", choices=("jsonl", "csv"), default=None, help="по умолчанию — по расширению файла")
+    ap.add_argument("--channel", type=int, action="append", default=[], help="chat_id канала (можно несколько)")
+    ap.add_argument("--since", type=_parse_dt, default=None, help="с даты/времени UTC включительно (ISO)")
+    ap.add_argument("--until", type=_parse_dt, default=None, help="до даты/времени UTC, не включая (ISO)")
+    ap.add_argument("--chunk", type=int, default=1000, help="комментариев в пачке")
+    args = ap.parse_args()
+    fmt = args.format or ("csv" if args.out.endswith(".csv") else "jsonl")
+
+    async def run():
+        try:
+            if args.out == "-":
+                return await export(sys.stdout, fmt, args.channel, args.since, args.until, max(1, args.chunk))
+            with open(args.out, "w", encoding="utf-8", newline="") as f:
+                return await export(f, fmt, args.channel, args.since, args.until, max(1, args.chunk))
+        finally:
+            await read_engine.dispose()
+
+    t0 = time.perf_counter()
+    n = asyncio.run(run())
+    print(f"✅ Выгружено {n} комментариев за {time.perf_counter() - t0:.1f} с ({fmt})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
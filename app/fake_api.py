@@ -0,0 +1,178 @@
+"""
+Локальная подмена Telegram Bot API (aiohttp) для нагрузочных прогонов: отвечает правдоподобными
+Message/MessageId, считает вызовы по методам и умеет подмешивать ошибки —
+429 (retry_after), VOICE_MESSAGES_FORBIDDEN для пользователей с запретом голосовых
+и отказ sendMediaGroup (проверка fallback альбомов).
+
+Бот подключается через AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)).
+"""
+import itertools, json, random, time
+from collections import Counter, defaultdict
+from typing import Callable
+from aiohttp import web
+
+# методы, которые создают сообщения (и на которые Telegram может ответить 429)
+_SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendAudio", "sendVoice",
+    "sendVideoNote", "sendMediaGroup", "copyMessage", "copyMessages", "forwardMessage",
+}
+
+
+class FakeBotAPI:
+
+    def __init__(self, p429: float = 0.0, retry_after: int = 1, seed: int | None = None,
+                 p_media_group_fail: float = 0.0):
+        self.p429 = p429
+        self.p_media_group_fail = p_media_group_fail
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.base_url = ""
+        self._rnd = random.Random(seed)
+        self._ids: dict[int, itertools.count] = defaultdict(lambda: itertools.count(1_000_000))
+        self._voice_forbidden: set[int] = set()
+        self._voices: set[tuple[int, int]] = set()
+        self._listeners: list[Callable[[int, dict], None]] = []
+        self._runner: web.AppRunner | None = None
+
+    # ---------- Настройка сценария ----------
+    def forbid_voice(self, user_id: int):
+        """Пользователь запретил голосовые/кружки: copy голосового ему вернёт 400."""
+        self._voice_forbidden.add(user_id)
+
+    def mark_voice(self, chat_id: int, message_id: int):
+        """Синтетическое входящее сообщение — голосовое (нужно, чтобы copyMessage знал тип)."""
+        self._voices.add((chat_id, message_id))
+
+    def on_message(self, fn: Callable[[int, dict], None]):
+        """fn(chat_id, message) на каждое «отправленное» ботом сообщение."""
+        self._listeners.append(fn)
+
+    # ---------- Сервер ----------
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {k: _decode(v) for k, v in (await request.post()).items()}
+        self.calls[method] += 1
+        if method in _SEND_METHODS and self.p429 and self._rnd.random() < self.p429:
+            return self._error(method, 429, f"Too Many Requests: retry after {self.retry_after}",
+                               {"retry_after": self.retry_after})
+        try:
+            result = self._result(method, params)
+        except _ApiError as e:
+            return self._error(method, 400, e.description)
+        return web.json_response({"ok": True, "result": result})
+
+    def _error(self, method: str, code: int, description: str, parameters: dict | None = None) -> web.Response:
+        self.errors[f"{method}:{code}"] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    # ---------- Ответы ----------
+    def _result(self, method: str, p: dict):
+        chat_id = int(p.get("chat_id", 0) or 0)
+
+        if method == "copyMessage":
+            if (int(p["from_chat_id"]), int(p["message_id"])) in self._voices and chat_id in self._voice_forbidden:
+                raise _ApiError("Bad Request: VOICE_MESSAGES_FORBIDDEN")
+            return {"message_id": self._emit(chat_id, {})["message_id"]}
+        if method == "copyMessages":
+            return [{"message_id": self._emit(chat_id, {})["message_id"]} for _ in p["message_ids"]]
+        if method == "sendMediaGroup":
+            if self.p_media_group_fail and self._rnd.random() < self.p_media_group_fail:
+                raise _ApiError("Bad Request: MEDIA_GROUP_INVALID")
+            return [
+                self._emit(chat_id, {item["type"]: _file(item["media"]), **_caption(item)})
+                for item in p["media"]
+            ]
+        if method == "sendMessage":
+            return self._emit(chat_id, {"text": p.get("text", "")})
+        if method in ("sendPhoto", "sendVideo", "sendDocument", "sendAudio", "sendVoice", "sendVideoNote"):
+            kind = method[4].lower() + method[5:]
+            kind = "video_note" if kind == "videoNote" else kind
+            if kind in ("voice", "video_note") and chat_id in self._voice_forbidden:
+                raise _ApiError(f"Bad Request: {'VOICE' if kind == 'voice' else 'VIDEO'}_MESSAGES_FORBIDDEN")
+            return self._emit(chat_id, {kind: _file(p.get(kind)), **_caption(p)})
+        if method == "editMessageReplyMarkup":
+            return _message(chat_id, int(p["message_id"]), {"reply_markup": p.get("reply_markup")})
+        if method == "getChat":
+            return {
+                "id": chat_id, "type": "channel" if chat_id < 0 else "private",
+                "title": f"Канал {chat_id}", "accent_color_id": 0, "max_reaction_count": 11,
+                "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                        "unique_gifts": False, "premium_subscription": False},
+            }
+        if method == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        return True  # setMessageReaction, deleteWebhook, answerCallbackQuery, ...
+
+    def _emit(self, chat_id: int, body: dict) -> dict:
+        msg = _message(chat_id, next(self._ids[chat_id]), body)
+        for fn in self._listeners:
+            fn(chat_id, msg)
+        return msg
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "errors": dict(self.errors)}
+
+
+class _ApiError(Exception):
+    def __init__(self, description: str):
+        super().__init__(description)
+        self.description = description
+
+
+def _decode(value):
+    # aiogram шлёт сложные поля JSON-строкой, простые — как есть
+    if isinstance(value, str) and value[:1] in ("[", "{"):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _caption(p: dict) -> dict:
+    return {"caption": p["caption"]} if p.get("caption") else {}
+
+
+def _file(file_id) -> dict:
+    fid = file_id if isinstance(file_id, str) else "fake"
+    return {"file_id": fid, "file_unique_id": fid[-16:]}
+
+
+def _message(chat_id: int, message_id: int, body: dict) -> dict:
+    body = {k: v for k, v in body.items() if v is not None}
+    if "photo" in body:
+        body["photo"] = [{**body["photo"], "width": 800, "height": 600}]
+    for kind in ("video", "video_note", "voice", "audio"):
+        if kind in body:
+            body[kind] = {**body[kind], "duration": 1}
+            if kind == "video":
+                body[kind].update(width=640, height=360)
+            if kind == "video_note":
+                body[kind]["length"] = 240
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        "from": {"id": 42, "is_bot": True, "first_name": "Fake"},
+        **body,
+    }
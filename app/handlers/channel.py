@@ -1,33 +1,49 @@
 from aiogram import Router
 from aiogram.types import Message, ReactionTypeEmoji, ReactionTypeCustomEmoji
 from aiogram.exceptions import TelegramBadRequest
-from sqlalchemy import select
+from collections import defaultdict
+from ..chats import sync_channel
 from ..config import config
-from ..db import SessionLocal
+from ..jobs import JobQueue
 from ..keyboards import comment_kb
-from ..models import Channel
 import asyncio, random
 
-router = Router()
+router = Router(name="channel")
 
-def _pick_random_reactions() -> list:
-    pool = []
-    # обычные Unicode
-    for e in (config.auto_reactions or []):
-        pool.append(ReactionTypeEmoji(emoji=e))
-    # кастомные (премиум) по ID
-    for cid in (config.custom_reaction_ids or []):
-        pool.append(ReactionTypeCustomEmoji(custom_emoji_id=cid))
+# Оформление поста (кнопка + реакции) — в фоне, чтобы не держать хендлер
+decorations = JobQueue("decorate", workers=config.decorate_workers, maxsize=config.decorate_queue)
+
+# Пул реакций собирается один раз
+_POOL: list = []
+for e in (config.auto_reactions or []):             # обычные Unicode
+    _POOL.append(ReactionTypeEmoji(emoji=e))
+for _id in (config.custom_reaction_ids or []):      # кастомные (премиум) по ID
+    _POOL.append(ReactionTypeCustomEmoji(custom_emoji_id=_id))
+
+# chat_id -> кастомные ID, которые канал уже принял / отклонил
+_accepted: dict[int, set[str]] = defaultdict(set)
+_rejected: dict[int, set[str]] = defaultdict(set)
+
+def _pick_random_reactions(chat_id: int) -> list:
+    bad = _rejected.get(chat_id)
+    pool = [r for r in _POOL if not (bad and isinstance(r, ReactionTypeCustomEmoji) and r.custom_emoji_id in bad)]
     if not pool:
         return []
     k = random.randint(1, min(len(pool), config.reaction_max_count))
     return random.sample(pool, k)
 
+def _blame_custom(chat_id: int, reactions: list):
+    """Запоминаем отказ канала, если виновная кастомная реакция однозначна."""
+    unknown = [r.custom_emoji_id for r in reactions
+               if isinstance(r, ReactionTypeCustomEmoji) and r.custom_emoji_id not in _accepted[chat_id]]
+    if len(unknown) == 1:
+        _rejected[chat_id].add(unknown[0])
+
 async def _try_set_reactions(bot, chat_id: int, msg_id: int):
     attempts = max(1, config.reaction_attempts)
     last_err = None
     for i in range(attempts):
-        reactions = _pick_random_reactions()
+        reactions = _pick_random_reactions(chat_id)
         if not reactions:
             return False
 
@@ -41,6 +57,7 @@ async def _try_set_reactions(bot, chat_id: int, msg_id: int):
                 reaction=reactions,
                 is_big=is_big,
             )
+            _accepted[chat_id].update(r.custom_emoji_id for r in reactions if isinstance(r, ReactionTypeCustomEmoji))
             return True
         except TelegramBadRequest as e:
             last_err = e
@@ -54,9 +71,12 @@ async def _try_set_reactions(bot, chat_id: int, msg_id: int):
                         reaction=unicode_only,
                         is_big=is_big,
                     )
+                    _blame_custom(chat_id, reactions)  # Unicode прошли — значит, виноваты кастомки
                     return True
                 except TelegramBadRequest as e2:
                     last_err = e2
+            else:
+                _blame_custom(chat_id, reactions)
             # Маленькая пауза и новая попытка с другим набором
             await asyncio.sleep(0.5 * (i + 1))
         except Exception as e:
@@ -67,31 +87,27 @@ async def _try_set_reactions(bot, chat_id: int, msg_id: int):
         print(f"⚠️ Не удалось поставить реакцию после {attempts} попыток:", last_err)
     return False
 
-@router.channel_post()
-async def on_channel_post(msg: Message):
-    if msg.chat.id not in config.allowed_channels:
-        return
-
-    # Обновляем/создаём запись канала
-    async with SessionLocal() as session:
-        ch = (await session.execute(select(Channel).where(Channel.chat_id == msg.chat.id))).scalar_one_or_none()
-        if not ch:
-            ch = Channel(chat_id=msg.chat.id, username=msg.chat.username, title=msg.chat.title)
-            session.add(ch)
-        else:
-            ch.username = msg.chat.username
-            ch.title = msg.chat.title
-        await session.commit()
-
+async def _decorate_post(bot, chat_id: int, msg_id: int):
     # Вешаем кнопку
     try:
-        await msg.bot.edit_message_reply_markup(
-            chat_id=msg.chat.id,
-            message_id=msg.message_id,
-            reply_markup=comment_kb(msg.chat.id, msg.message_id)
+        await bot.edit_message_reply_markup(
+            chat_id=chat_id,
+            message_id=msg_id,
+            reply_markup=comment_kb(chat_id, msg_id)
         )
     except TelegramBadRequest:
         pass
 
     # 🔥 Пытаемся поставить случайные реакции к новому посту
-    await _try_set_reactions(msg.bot, msg.chat.id, msg.message_id)
\ No newline at end of file
+    await _try_set_reactions(bot, chat_id, msg_id)
+
+@router.channel_post()
+async def on_channel_post(msg: Message):
+    if msg.chat.id not in config.allowed_channels:
+        return
+
+    # Обновляем/создаём запись канала (в БД — только если что-то поменялось)
+    await sync_channel(msg.chat.id, msg.chat.username, msg.chat.title)
+
+    if not decorations.submit(_decorate_post, msg.bot, msg.chat.id, msg.message_id):
+        print(f"⚠️ Очередь оформления постов переполнена, пост {msg.chat.id}/{msg.message_id} пропущен")
@@ -2,21 +2,29 @@ from aiogram import Router, F
 from aiogram.enums import ChatType
 from aiogram.types import Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument
 from aiogram.exceptions import TelegramBadRequest
-from sqlalchemy import select
-import html, re, asyncio
-from collections import defaultdict
+from aiogram.methods import (
+    SendMessage, SendPhoto, SendVideo, SendDocument, SendAudio, SendMediaGroup, CopyMessage, CopyMessages,
+)
+import html, re
 
+from .. import digest
 from ..config import config
-from ..db import SessionLocal
 from ..antispam import check_and_hit
-from ..models import User, Comment, CommentMedia, Channel
-from ..utils import build_post_link
-
-router = Router()
+from ..users import ensure_user
+from ..chats import get_chat_info, post_link
+from ..pending import pending
+from ..albums import MediaGroupAggregator
+from ..writer import writer
+from ..outbox import outbox, step
+from ..db import commit_update_session
+from ..routing import routes, message_ids
+from ..sender import send, PRIO_USER, PRIO_ADMIN
+
+router = Router(name="user")
 print("✅ handlers/user.py подключён")
 
-# user_id -> (channel_chat_id, post_id)
-_pending: dict[int, tuple[int, int]] = {}
+# медиа с подписью идут в медиа-хендлеры, а не в текстовые (иначе теряется файл)
+_MEDIA = (F.photo | F.video | F.document | F.voice | F.audio | F.video_note)
 
 BOT_SIGNATURE = f'<a href="https://t.me/{config.bot_username}">KVANTORA™</a>'
 
@@ -30,7 +38,7 @@ def _extract_ctx_from_text(text: str):
     return int(uid), int(cid), int(pid), (int(amid) if amid else None)
 
 def _try_extract_from_replied_chain(msg: Message):
-    """Пробуем достать метки из сообщения-источника или из его родителя (глубина 2)."""
+    """Старые сообщения без маршрута: метки из источника или его родителя (глубина 2)."""
     if not msg.reply_to_message:
         return None
     src = msg.reply_to_message
@@ -41,6 +49,33 @@ def _try_extract_from_replied_chain(msg: Message):
         return _extract_ctx_from_text((src.reply_to_message.text or src.reply_to_message.caption or ""))
     return None
 
+async def _resolve_ctx(msg: Message):
+    """Адресат ответа: сначала таблица маршрутов (O(1), любая глубина), потом метки в тексте."""
+    if not msg.reply_to_message:
+        return None
+    ctx = await routes.resolve(msg.chat.id, msg.reply_to_message.message_id)
+    return ctx or _try_extract_from_replied_chain(msg)
+
+_DIGEST_MARK_RE = re.compile(r"#\d+ UID:-?\d+")
+_DIGEST_AMBIGUOUS = "В дайджесте несколько комментариев: процитируйте нужный или начните ответ с #N."
+
+async def _resolve_admin_ctx(msg: Message, body: str):
+    """
+    Адресат ответа админа, текст без префикса «#N» и признак дайджеста.
+    Дайджест узнаём только по записанным адресатам (не по меткам в тексте — их может подделать комментарий).
+    """
+    chat_id, reply_id = msg.chat.id, msg.reply_to_message.message_id
+    ctx = await routes.resolve(chat_id, reply_id)
+    if ctx:
+        return ctx, body, False
+    items = await routes.resolve_digest(chat_id, reply_id)
+    if items:
+        ctx, body = digest.pick(items, msg.quote.position if msg.quote else None, body)
+        return ctx, body, True
+    if _DIGEST_MARK_RE.search(msg.reply_to_message.text or msg.reply_to_message.caption or ""):
+        return None, body, True  # дайджест без записанных адресатов: по тексту не угадываем
+    return _try_extract_from_replied_chain(msg), body, False
+
 # ---------- Форматирование служебных сообщений (HTML) ----------
 def _hdr_admin_to_user(link: str | None, uid: int, cid: int, pid: int, amid: int, caption: str | None) -> str:
     base = (
@@ -72,57 +107,80 @@ def _hdr_user_to_admin_reply(who: str, link: str | None, uid: int, cid: int, pid
     quote = f"<blockquote>{html.escape(caption)}</blockquote>\n\n" if caption else ""
     markers = f"<tg-spoiler>UID:{uid} CID:{cid} PID:{pid}</tg-spoiler>"
     return base + quote + markers
-# Имя канала
-async def _channel_display_name(bot, cid: int) -> str:
-    # сначала пробуем из БД
-    async with SessionLocal() as session:
-        ch = (await session.execute(select(Channel).where(Channel.chat_id == cid))).scalar_one_or_none()
-    if ch:
-        if ch.title:
-            return ch.title
-        if ch.username:
-            return f"@{ch.username}"
-        return str(cid)
-    # если в БД нет — пробуем спросить у Telegram
-    try:
-        chat = await bot.get_chat(cid)
-        return chat.title or (f"@{chat.username}" if chat.username else str(cid))
-    except Exception:
-        return str(cid)
 
 # ---------- Безопасная пересылка (голос/кружок -> документ при запрете) ----------
-async def _safe_copy_or_send(bot, target_chat_id: int, src_msg: Message, reply_to_message_id: int | None = None):
+def _copy_method(src_msg: Message, target_chat_id: int, reply_to_message_id: int | None = None) -> CopyMessage:
+    return CopyMessage(chat_id=target_chat_id, from_chat_id=src_msg.chat.id,
+                       message_id=src_msg.message_id, reply_to_message_id=reply_to_message_id)
+
+# типы, которые Telegram держит в одном альбоме: фото+видео, документы, аудио — каждые отдельно
+def _copy_kind(m: Message) -> str:
+    if m.photo or m.video:
+        return "visual"
+    if m.document:
+        return "document"
+    if m.audio:
+        return "audio"
+    return "other"
+
+_COPY_MESSAGES_MAX = 100  # лимит copyMessages на вызов
+
+def _copy_batches(parts: list[Message], target_chat_id: int) -> list[CopyMessages]:
+    """
+    copyMessages вместо copyMessage на каждую часть: идущие подряд (по message_id) части
+    одного чата и совместимого типа — одним вызовом; смена типа или чата начинает новый.
+    Альбом из 10 частей — один вызов вместо десяти (ответа-reply у copyMessages нет, ветку держит якорь).
+    """
+    runs: list[tuple[tuple[int, str], list[int]]] = []
+    for p in sorted(parts, key=lambda p: (p.chat.id, p.message_id)):
+        key = (p.chat.id, _copy_kind(p))
+        if runs and runs[-1][0] == key and len(runs[-1][1]) < _COPY_MESSAGES_MAX:
+            runs[-1][1].append(p.message_id)
+        else:
+            runs.append((key, [p.message_id]))
+    return [CopyMessages(chat_id=target_chat_id, from_chat_id=cid, message_ids=ids) for (cid, _), ids in runs]
+
+def _as_document(src_msg: Message, target_chat_id: int, reply_to_message_id: int | None = None) -> SendDocument | None:
+    """Голосовое/кружок как document с подписью (для чатов, где они запрещены)."""
+    f = src_msg.voice or src_msg.video_note
+    if not f:
+        return None
+    cap = (src_msg.caption or "").strip()
+    return SendDocument(
+        chat_id=target_chat_id,
+        document=f.file_id,
+        caption=(html.escape(cap) if cap else None),
+        parse_mode="HTML",
+        reply_to_message_id=reply_to_message_id
+    )
+
+async def _safe_copy_or_send(bot, target_chat_id: int, src_msg: Message, reply_to_message_id: int | None = None,
+                             prio: int = PRIO_ADMIN):
     """
     copy_message; если VOICE/VIDEO_NOTE запрещены — шлём как document с подписью.
     """
     try:
-        return await bot.copy_message(
-            chat_id=target_chat_id,
-            from_chat_id=src_msg.chat.id,
-            message_id=src_msg.message_id,
-            reply_to_message_id=reply_to_message_id
-        )
+        return await send(bot, _copy_method(src_msg, target_chat_id, reply_to_message_id), prio)
     except TelegramBadRequest as e:
         text = str(e)
-        cap = (src_msg.caption or "").strip()
-        if "VOICE_MESSAGES_FORBIDDEN" in text and src_msg.voice:
-            return await bot.send_document(
-                chat_id=target_chat_id,
-                document=src_msg.voice.file_id,
-                caption=(html.escape(cap) if cap else None),
-                parse_mode="HTML",
-                reply_to_message_id=reply_to_message_id
-            )
-        if "VIDEO_MESSAGES_FORBIDDEN" in text and src_msg.video_note:
-            return await bot.send_document(
-                chat_id=target_chat_id,
-                document=src_msg.video_note.file_id,
-                caption=(html.escape(cap) if cap else None),
-                parse_mode="HTML",
-                reply_to_message_id=reply_to_message_id
-            )
+        if ("VOICE_MESSAGES_FORBIDDEN" in text and src_msg.voice) or ("VIDEO_MESSAGES_FORBIDDEN" in text and src_msg.video_note):
+            return await send(bot, _as_document(src_msg, target_chat_id, reply_to_message_id), prio)
         raise
 
+# ---------- Одиночное медиа с подписью-заголовком ----------
+def _single_media_method(m: Message, chat_id: int, header: str, reply_to: int | None = None):
+    """sendPhoto/Video/Document/Audio с header в подписи; None — голос/кружок (копия + якорь)."""
+    kw = dict(chat_id=chat_id, caption=header, parse_mode="HTML", reply_to_message_id=reply_to)
+    if m.photo:
+        return SendPhoto(photo=m.photo[-1].file_id, **kw)
+    if m.video:
+        return SendVideo(video=m.video.file_id, **kw)
+    if m.document:
+        return SendDocument(document=m.document.file_id, **kw)
+    if m.audio:
+        return SendAudio(audio=m.audio.file_id, **kw)
+    return None
+
 # ---------- Подготовка media для sendMediaGroup ----------
 def _as_input_media(m: Message, with_caption: bool, override_caption: str | None = None):
     """
@@ -161,18 +219,21 @@ def _media_records_from_message(m: Message, mgid: str | None):
         recs.append(("audio", m.audio.file_id, m.audio.file_unique_id, mgid))
     return recs
 
+async def _copy_album(parts: list[Message], target_chat_id: int, albums: "MediaGroupAggregator", prio: int) -> list[int]:
+    """Fallback альбома: копии пачками; неудачная пачка не срывает остальные и якорь."""
+    batches = _copy_batches(parts, target_chat_id)
+    albums.count_fallback(len(batches))
+    sent = []
+    for method in batches:
+        try:
+            sent += message_ids(await send(parts[0].bot, method, prio))
+        except Exception as e:
+            print(f"⚠️ Не удалось скопировать части альбома {method.message_ids}:", e)
+    return sent
+
 # ---------- USER -> ADMIN альбомы ----------
-_u2a_buf: dict[str, list[Message]] = defaultdict(list)
-_u2a_ctx: dict[str, dict] = {}      # {mgid: {mode:'new'|'reply', who, uid, cid, pid, amid, link, mgid}}
-_u2a_task: dict[str, asyncio.Task] = {}
-_u2a_album_comment_id: dict[str, int] = {}
-
-async def _flush_u2a(mgid: str):
-    parts = _u2a_buf.pop(mgid, [])
-    ctx = _u2a_ctx.pop(mgid, None)
-    _u2a_task.pop(mgid, None)
-    if not parts or not ctx:
-        return
+# ctx: {mode:'new'|'reply', who, uid, cid, pid, amid, link, mgid, user_id, comment}
+async def _flush_u2a(parts: list[Message], ctx: dict):
 
     # Заголовок в подпись первого элемента
     cap_text = (parts[0].caption or "").strip() if parts else None
@@ -188,45 +249,48 @@ async def _flush_u2a(mgid: str):
         im = _as_input_media(p, with_caption=(i == 0), override_caption=header if i == 0 else None)
         if im:
             media.append(im)
+    if not media:
+        return
 
-    if media:
-        try:
-            await parts[0].bot.send_media_group(
-                chat_id=config.admin_chat_id,
-                media=media,
-                reply_to_message_id=reply_to
-            )
-        except Exception:
-            # fallback: по одному (потом якорь отдельным постом)
-            for p in parts:
-                try:
-                    await p.bot.copy_message(config.admin_chat_id, p.chat.id, p.message_id, reply_to_message_id=reply_to)
-                except Exception:
-                    pass
-            # отдельный якорь, если альбом не отправился подписью
-            await parts[0].bot.send_message(config.admin_chat_id, header, reply_to_message_id=reply_to)
-
-    # сброс связки для новых альбомов
-    if ctx.get("mode") == "new":
-        _u2a_album_comment_id.pop(ctx.get("mgid"), None)
-
-async def _delayed_flush_u2a(mgid: str):
-    await asyncio.sleep(0.7)
-    await _flush_u2a(mgid)
+    if ctx["mode"] == "new":
+        return await _flush_u2a_new(parts, ctx, header, media)
+
+    sent = []
+    try:
+        sent += message_ids(await send(parts[0].bot, SendMediaGroup(
+            chat_id=config.admin_chat_id,
+            media=media,
+            reply_to_message_id=reply_to
+        )))
+    except Exception as e:
+        print("⚠️ Альбом админу не отправился, копируем пачками:", e)
+        # fallback: copyMessages пачками (потом якорь отдельным постом)
+        sent += await _copy_album(parts, config.admin_chat_id, u2a_albums, PRIO_ADMIN)
+        # отдельный якорь, если альбом не отправился подписью
+        sent += message_ids(await send(parts[0].bot, SendMessage(chat_id=config.admin_chat_id, text=header, reply_to_message_id=reply_to)))
+    routes.remember(config.admin_chat_id, sent, (ctx["uid"], ctx["cid"], ctx["pid"], None))
+
+async def _flush_u2a_new(parts: list[Message], ctx: dict, header: str, media: list):
+    """Новый комментарий-альбом: Comment, медиа и уведомление — одной транзакцией, «Готово» после коммита."""
+    first = ctx.get("comment") is None
+    if first:
+        ctx["comment"] = writer.add_comment(ctx["cid"], ctx["pid"], ctx["user_id"], (parts[0].caption or "").strip())
+    ref = ctx["comment"]  # опоздавшие части дописываются к тому же комментарию
+    writer.add_media(ref, [r for p in parts for r in _media_records_from_message(p, ctx["mgid"])])
+
+    # fallback: copyMessages пачками (копии — по возможности) и якорь отдельным постом
+    fallback = [step(c, optional=True) for c in _copy_batches(parts, config.admin_chat_id)]
+    fallback.append(step(SendMessage(chat_id=config.admin_chat_id, text=header)))
+    outbox.add(ref, [step(SendMediaGroup(chat_id=config.admin_chat_id, media=media), fallback=fallback)],
+               route=(ctx["uid"], ctx["cid"], ctx["pid"]))
+    if first and await _committed(parts[0], ref):
+        await _confirm_new(parts[0], ctx["cid"], ctx["pid"], ref)
 
 # ---------- ADMIN -> USER альбомы ----------
-_a2u_buf: dict[str, list[Message]] = defaultdict(list)
-_a2u_ctx: dict[str, dict] = {}      # {mgid: {uid, cid, pid, amid, link}}
-_a2u_task: dict[str, asyncio.Task] = {}
-
-async def _flush_a2u(mgid: str):
-    parts = _a2u_buf.pop(mgid, [])
-    ctx = _a2u_ctx.pop(mgid, None)
-    _a2u_task.pop(mgid, None)
-    if not parts or not ctx:
-        return
+# ctx: {uid, cid, pid, amid, link, caption?}
+async def _flush_a2u(parts: list[Message], ctx: dict):
 
-    cap_text = (parts[0].caption or "").strip() if parts else None
+    cap_text = ctx.get("caption", (parts[0].caption or "").strip() if parts else None)
     header = _hdr_admin_to_user(ctx["link"], ctx["uid"], ctx["cid"], ctx["pid"], ctx["amid"], cap_text or None)
 
     media = []
@@ -235,20 +299,23 @@ async def _flush_a2u(mgid: str):
         if im:
             media.append(im)
 
+    sent = []
     if media:
         try:
-            await parts[0].bot.send_media_group(
+            sent += message_ids(await send(parts[0].bot, SendMediaGroup(
                 chat_id=ctx["uid"],
                 media=media
-            )
-        except Exception:
-            # fallback: по одному и отдельный текстом якорь
-            for p in parts:
-                try:
-                    await p.bot.copy_message(ctx["uid"], p.chat.id, p.message_id)
-                except Exception:
-                    pass
-            await parts[0].bot.send_message(ctx["uid"], header)
+            ), PRIO_USER))
+        except Exception as e:
+            print("⚠️ Альбом пользователю не отправился, копируем пачками:", e)
+            # fallback: copyMessages пачками и отдельный текстом якорь
+            sent += await _copy_album(parts, ctx["uid"], a2u_albums, PRIO_USER)
+            sent += message_ids(await send(parts[0].bot, SendMessage(chat_id=ctx["uid"], text=header), PRIO_USER))
+    routes.remember(ctx["uid"], sent, (ctx["uid"], ctx["cid"], ctx["pid"], ctx["amid"]))
+
+_album_kw = dict(debounce=config.album_debounce_sec, max_wait=config.album_max_wait_sec, max_groups=config.album_max_open)
+u2a_albums = MediaGroupAggregator(_flush_u2a, name="u2a", **_album_kw)
+a2u_albums = MediaGroupAggregator(_flush_a2u, name="a2u", **_album_kw)
 
 def make_intro_text() -> str:
     channel_link = '<a href="https://t.me/w2wcom">WWW.com</a>'
@@ -285,10 +352,6 @@ def make_intro_text() -> str:
         f"{BOT_SIGNATURE}"
     )
 
-async def _delayed_flush_a2u(mgid: str):
-    await asyncio.sleep(0.7)
-    await _flush_a2u(mgid)
-
 # ===================== /start (кнопка) =====================
 @router.message(F.chat.type == ChatType.PRIVATE, F.text.startswith("/start"))
 async def start_any(m: Message):
@@ -299,7 +362,7 @@ async def start_any(m: Message):
     if not payload:
         allowed = list(config.allowed_channels or [])
         if len(allowed) == 1:
-            name = await _channel_display_name(m.bot, allowed[0])
+            name = (await get_chat_info(m.bot, allowed[0])).display_name
             text = (
                 f"💬 Анонимный комментарий для админа канала <b>{html.escape(name)}</b>\n\n"
                 f"<b>Что можно отправить</b>:\n"
@@ -319,7 +382,7 @@ async def start_any(m: Message):
             )
         else:
             text = make_intro_text()
-        return await m.answer(text)
+        return await send(m.bot, m.answer(text), PRIO_USER)
 
     # С payload (кнопка под постом): конкретный канал
     try:
@@ -327,21 +390,14 @@ async def start_any(m: Message):
         channel_chat_id = int(chat_id_s)
         post_id = int(post_id_s)
     except Exception:
-        return await m.answer("Некорректная ссылка. Нажмите кнопку под постом ещё раз.")
+        return await send(m.bot, m.answer("Некорректная ссылка. Нажмите кнопку под постом ещё раз."), PRIO_USER)
 
-    _pending[m.from_user.id] = (channel_chat_id, post_id)
+    await pending.set(m.from_user.id, (channel_chat_id, post_id))
 
-    # регистрация/обновление пользователя
-    async with SessionLocal() as session:
-        user = (await session.execute(select(User).where(User.tg_id == m.from_user.id))).scalar_one_or_none()
-        if not user:
-            user = User(tg_id=m.from_user.id, username=m.from_user.username)
-            session.add(user)
-        else:
-            user.username = m.from_user.username
-        await session.commit()
+    # регистрация/обновление пользователя (известный, с тем же username — без БД)
+    await ensure_user(m.from_user.id, m.from_user.username)
 
-    channel_name = await _channel_display_name(m.bot, channel_chat_id)
+    channel_name = (await get_chat_info(m.bot, channel_chat_id)).display_name
 
     text = (
         f"📝 Комментарий для админа канала <b>{html.escape(channel_name)}</b>\n\n"
@@ -357,119 +413,149 @@ async def start_any(m: Message):
         f"Отмена - /cancel\n\n"
         f"{BOT_SIGNATURE}"
     )
-    await m.answer(text)
+    await send(m.bot, m.answer(text), PRIO_USER)
 
 # ===================== /cancel =====================
 @router.message(F.chat.type == ChatType.PRIVATE, F.text == "/cancel")
 async def cancel(m: Message):
-    _pending.pop(m.from_user.id, None)
-    await m.answer("Отменено. Нажмите кнопку под постом ещё раз.")
+    await pending.pop(m.from_user.id)
+    await send(m.bot, m.answer("Отменено. Нажмите кнопку под постом ещё раз."), PRIO_USER)
 
 # ===================== АДМИН -> ПОЛЬЗОВАТЕЛЬ (текст) =====================
-@router.message(F.chat.id == config.admin_chat_id, F.reply_to_message, (F.text | F.caption))
+@router.message(F.chat.id == config.admin_chat_id, F.reply_to_message, (F.text | F.caption), ~_MEDIA)
 async def admin_reply_text(m: Message):
-    ctx = _try_extract_from_replied_chain(m)
+    ctx, body, in_digest = await _resolve_admin_ctx(m, (m.text or m.caption or "").strip())
     if not ctx:
-        return await m.reply("Не вижу меток адресата. Ответьте именно на уведомление бота.")
+        if in_digest:
+            return await send(m.bot, m.reply(_DIGEST_AMBIGUOUS), PRIO_USER)
+        return await send(m.bot, m.reply("Не вижу меток адресата. Ответьте именно на уведомление бота."), PRIO_USER)
     uid, cid, pid, _ = ctx
+    routes.remember(m.chat.id, [m.message_id], (uid, cid, pid, None))
 
-    chat = await m.bot.get_chat(cid)
-    link = build_post_link(cid, chat.username, pid)
-    body = (m.text or m.caption or "").strip()
+    link = await post_link(m.bot, cid, pid)
+    body = body.strip()
 
     text = _hdr_admin_to_user(link, uid, cid, pid, m.message_id, caption=body or None)
-    await m.bot.send_message(uid, text)
+    sent = await send(m.bot, SendMessage(chat_id=uid, text=text), PRIO_USER)
+    routes.remember(uid, message_ids(sent), (uid, cid, pid, m.message_id))
 
 # ===================== АДМИН -> ПОЛЬЗОВАТЕЛЬ (медиа/альбом) =====================
-@router.message(F.chat.id == config.admin_chat_id, F.reply_to_message, (F.photo | F.video | F.document | F.voice | F.audio | F.video_note))
+@router.message(F.chat.id == config.admin_chat_id, F.reply_to_message, _MEDIA)
 async def admin_reply_media(m: Message):
-    ctx = _try_extract_from_replied_chain(m)
+    # следующая часть уже начатого альбома — адресат тот же (#N из дайджеста есть только в подписи первой)
+    mgid = m.media_group_id if (m.media_group_id and (m.photo or m.video or m.document)) else None
+    album = a2u_albums.ctx(mgid) if mgid else None
+    if album:
+        routes.remember(m.chat.id, [m.message_id], (album["uid"], album["cid"], album["pid"], None))
+        a2u_albums.add(mgid, m, album)
+        return
+
+    raw = (m.caption or "").strip()
+    ctx, cap, in_digest = await _resolve_admin_ctx(m, raw)
     if not ctx:
-        return await m.reply("Не вижу меток адресата. Ответьте именно на уведомление бота.")
+        if in_digest:
+            return await send(m.bot, m.reply(_DIGEST_AMBIGUOUS), PRIO_USER)
+        return await send(m.bot, m.reply("Не вижу меток адресата. Ответьте именно на уведомление бота."), PRIO_USER)
     uid, cid, pid, _ = ctx
+    routes.remember(m.chat.id, [m.message_id], (uid, cid, pid, None))
 
-    chat = await m.bot.get_chat(cid)
-    link = build_post_link(cid, chat.username, pid)
-    cap = (m.caption or "").strip()
+    link = await post_link(m.bot, cid, pid)
+    cap = cap.strip()
     header = _hdr_admin_to_user(link, uid, cid, pid, m.message_id, caption=cap or None)
 
     # альбом (photo/video/document)
-    if m.media_group_id and (m.photo or m.video or m.document):
-        mgid = m.media_group_id
-        _a2u_buf[mgid].append(m)
-        if mgid not in _a2u_ctx:
-            _a2u_ctx[mgid] = {"uid": uid, "cid": cid, "pid": pid, "amid": m.message_id, "link": link}
-        if mgid not in _a2u_task:
-            _a2u_task[mgid] = asyncio.create_task(_delayed_flush_a2u(mgid))
+    if mgid:
+        album = {"uid": uid, "cid": cid, "pid": pid, "amid": m.message_id, "link": link}
+        if cap != raw:
+            album["caption"] = cap  # подпись без «#N»
+        a2u_albums.add(mgid, m, album)
         return
 
     # одиночные
-    if m.photo:
-        await m.bot.send_photo(uid, m.photo[-1].file_id, caption=header, parse_mode="HTML")
-    elif m.video:
-        await m.bot.send_video(uid, m.video.file_id, caption=header, parse_mode="HTML")
-    elif m.document:
-        await m.bot.send_document(uid, m.document.file_id, caption=header, parse_mode="HTML")
-    elif m.audio:
-        await m.bot.send_audio(uid, m.audio.file_id, caption=header, parse_mode="HTML")
+    method = _single_media_method(m, uid, header)
+    if method:
+        sent = message_ids(await send(m.bot, method, PRIO_USER))
     else:
-        # voice / video_note → безопасная пересылка и отдельный якорь
-        await _safe_copy_or_send(m.bot, uid, m)
-        await asyncio.sleep(0.3)
-        await m.bot.send_message(uid, header)
+        # voice / video_note → безопасная пересылка и отдельный якорь (порядок держит планировщик)
+        sent = message_ids(await _safe_copy_or_send(m.bot, uid, m, prio=PRIO_USER))
+        sent += message_ids(await send(m.bot, SendMessage(chat_id=uid, text=header), PRIO_USER))
+    routes.remember(uid, sent, (uid, cid, pid, m.message_id))
+
+async def _committed(m: Message, ref) -> bool:
+    """Ждём коммита Comment (вместе с его outbox); при сбое записи — честно говорим пользователю."""
+    await commit_update_session()  # users уже записан апдейтом — иначе пачка writer'а ждёт нашу транзакцию
+    try:
+        await ref.committed
+        return True
+    except Exception:
+        await send(m.bot, m.answer("⚠️ Не удалось сохранить комментарий. Попробуйте отправить его ещё раз."), PRIO_USER)
+        return False
+
+async def _confirm_new(m: Message, cid: int, pid: int, ref):
+    """
+    «Готово» пользователю сразу после коммита, не дожидаясь Bot API; ответ на него (или на сам комментарий)
+    уйдёт в ту же ветку у админа — AMID проставится, когда outbox доставит уведомление.
+    """
+    ok = await send(m.bot, m.answer("✅ Готово! Комментарий отправлен.\nОтветьте на это сообщение, чтобы написать Администратору."), PRIO_USER)
+    ids = [m.message_id, *message_ids(ok)]
+    routes.remember(m.chat.id, ids, (m.from_user.id, cid, pid, None))
+    outbox.link(ref.outbox_id, m.chat.id, ids)
 
 # ===================== ПОЛЬЗОВАТЕЛЬ -> АДМИН (текст) =====================
-@router.message(F.chat.type == ChatType.PRIVATE, (F.text | F.caption))
+@router.message(F.chat.type == ChatType.PRIVATE, (F.text | F.caption), ~_MEDIA)
 async def user_text(m: Message):
     text = (m.text or m.caption or "").strip()
     if not text:
-        return await m.answer("Пустой комментарий. Напишите текст.")
+        return await send(m.bot, m.answer("Пустой комментарий. Напишите текст."), PRIO_USER)
 
     # переписка (reply на бота)
-    ctx = _try_extract_from_replied_chain(m) if m.reply_to_message else None
+    ctx = await _resolve_ctx(m)
     if ctx:
         uid, cid, pid, amid = ctx
-        chat = await m.bot.get_chat(cid)
-        link = build_post_link(cid, chat.username, pid)
+        link = await post_link(m.bot, cid, pid)
         who = f"@{m.from_user.username}" if m.from_user.username else f"id:{m.from_user.id}"
 
         msg_html = _hdr_user_to_admin_reply(who, link, m.from_user.id, cid, pid, caption=text or None)
-        await m.bot.send_message(config.admin_chat_id, msg_html, reply_to_message_id=amid or None)
-        return await m.answer("✅ Отправлено администратору.")
+        sent = await send(m.bot, SendMessage(chat_id=config.admin_chat_id, text=msg_html, reply_to_message_id=amid or None))
+        routes.remember(config.admin_chat_id, message_ids(sent), (m.from_user.id, cid, pid, None))
+        routes.remember(m.chat.id, [m.message_id], (m.from_user.id, cid, pid, amid))
+        return await send(m.bot, m.answer("✅ Отправлено администратору."), PRIO_USER)
 
     # новый комментарий
-    ctx2 = _pending.get(m.from_user.id)
+    ctx2 = await pending.get(m.from_user.id)
     if not ctx2:
-        return await m.answer("Чтобы оставить комментарий, нажмите кнопку под постом.")
+        return await send(m.bot, m.answer("Чтобы оставить комментарий, нажмите кнопку под постом."), PRIO_USER)
     cid, pid = ctx2
 
-    async with SessionLocal() as session:
-        ok, _ = await check_and_hit(session, m.from_user.id)
-        if not ok:
-            return await m.answer("Слишком часто. Попробуйте позже.")
-        user = (await session.execute(select(User).where(User.tg_id == m.from_user.id))).scalar_one()
-        comment = Comment(channel_chat_id=cid, post_id=pid, user_id=user.id, text=text)
-        session.add(comment); await session.commit()
+    ok, _ = check_and_hit(m.from_user.id)
+    if not ok:
+        return await send(m.bot, m.answer("Слишком часто. Попробуйте позже."), PRIO_USER)
 
-    chat = await m.bot.get_chat(cid)
-    link = build_post_link(cid, chat.username, pid)
+    user_id = await ensure_user(m.from_user.id, m.from_user.username)
+    link = await post_link(m.bot, cid, pid)
     who = f"@{m.from_user.username}" if m.from_user.username else f"id:{m.from_user.id}"
 
+    # Comment и уведомление админу — одной транзакцией; доставку делает outbox
+    # под нагрузкой на пост — в дайджест (обычное уведомление остаётся запасным вариантом)
     notify = _hdr_user_to_admin_new(who, link, m.from_user.id, cid, pid, caption=text or None)
-    await m.bot.send_message(config.admin_chat_id, notify)
+    ref = writer.add_comment(cid, pid, user_id, text)
+    batched = digest.gate.hit(cid, pid)
+    outbox.add(ref, [step(SendMessage(chat_id=config.admin_chat_id, text=notify))], route=(m.from_user.id, cid, pid),
+               digest={"who": who, "text": text, "link": link} if batched else None)
+    if not await _committed(m, ref):
+        return
 
-    _pending.pop(m.from_user.id, None)
-    await m.answer("✅ Готово! Комментарий отправлен.\nОтветьте на это сообщение, чтобы написать Администратору.")
+    await pending.pop(m.from_user.id)
+    await _confirm_new(m, cid, pid, ref)
 
 # ===================== ПОЛЬЗОВАТЕЛЬ -> АДМИН (медиа/альбом) =====================
-@router.message(F.chat.type == ChatType.PRIVATE, (F.photo | F.video | F.document | F.voice | F.audio | F.video_note))
+@router.message(F.chat.type == ChatType.PRIVATE, _MEDIA)
 async def user_media(m: Message):
     # переписка (reply на бота)
-    ctx = _try_extract_from_replied_chain(m) if m.reply_to_message else None
+    ctx = await _resolve_ctx(m)
     if ctx:
         uid, cid, pid, amid = ctx
-        chat = await m.bot.get_chat(cid)
-        link = build_post_link(cid, chat.username, pid)
+        link = await post_link(m.bot, cid, pid)
         who = f"@{m.from_user.username}" if m.from_user.username else f"id:{m.from_user.id}"
         caption = (m.caption or "").strip()
         header = _hdr_user_to_admin_reply(who, link, m.from_user.id, cid, pid, caption=caption or None)
@@ -477,117 +563,82 @@ async def user_media(m: Message):
         # альбом?
         if m.media_group_id and (m.photo or m.video or m.document):
             mgid = m.media_group_id
-            _u2a_buf[mgid].append(m)
-            if mgid not in _u2a_ctx:
-                _u2a_ctx[mgid] = {
-                    "mode": "reply", "who": who, "uid": m.from_user.id,
-                    "cid": cid, "pid": pid, "amid": amid, "link": link, "mgid": mgid
-                }
-            if mgid not in _u2a_task:
-                _u2a_task[mgid] = asyncio.create_task(_delayed_flush_u2a(mgid))
+            u2a_albums.add(mgid, m, {
+                "mode": "reply", "who": who, "uid": m.from_user.id,
+                "cid": cid, "pid": pid, "amid": amid, "link": link, "mgid": mgid
+            })
             return
 
         # одиночные: фото/видео/док/аудио — с подписью; голос/кружок — копия + якорь
-        if m.photo:
-            await m.bot.send_photo(config.admin_chat_id, m.photo[-1].file_id, caption=header, parse_mode="HTML", reply_to_message_id=amid or None)
-        elif m.video:
-            await m.bot.send_video(config.admin_chat_id, m.video.file_id, caption=header, parse_mode="HTML", reply_to_message_id=amid or None)
-        elif m.document:
-            await m.bot.send_document(config.admin_chat_id, m.document.file_id, caption=header, parse_mode="HTML", reply_to_message_id=amid or None)
-        elif m.audio:
-            await m.bot.send_audio(config.admin_chat_id, m.audio.file_id, caption=header, parse_mode="HTML", reply_to_message_id=amid or None)
+        method = _single_media_method(m, config.admin_chat_id, header, reply_to=amid or None)
+        if method:
+            sent = message_ids(await send(m.bot, method))
         else:
-            await _safe_copy_or_send(m.bot, config.admin_chat_id, m, reply_to_message_id=amid or None)
-            await asyncio.sleep(0.3)
-            await m.bot.send_message(config.admin_chat_id, header, reply_to_message_id=amid or None)
-
-        return await m.answer("✅ Отправлено администратору.")
+            sent = message_ids(await _safe_copy_or_send(m.bot, config.admin_chat_id, m, reply_to_message_id=amid or None))
+            sent += message_ids(await send(m.bot, SendMessage(chat_id=config.admin_chat_id, text=header, reply_to_message_id=amid or None)))
+        routes.remember(config.admin_chat_id, sent, (m.from_user.id, cid, pid, None))
+        routes.remember(m.chat.id, [m.message_id], (m.from_user.id, cid, pid, amid))
+
+        return await send(m.bot, m.answer("✅ Отправлено администратору."), PRIO_USER)
+
+    # следующая часть уже начатого альбома — контекст берём из альбома, а не из pending
+    mgid = m.media_group_id if (m.media_group_id and (m.photo or m.video or m.document)) else None
+    album = u2a_albums.ctx(mgid) if mgid else None
+    if album and album["mode"] == "new":
+        u2a_albums.add(mgid, m, album)
+        return
 
     # новый комментарий по /start
-    ctx2 = _pending.get(m.from_user.id)
+    ctx2 = await pending.get(m.from_user.id)
     if not ctx2:
-        return await m.answer("Чтобы оставить комментарий, нажмите кнопку под постом.")
+        return await send(m.bot, m.answer("Чтобы оставить комментарий, нажмите кнопку под постом."), PRIO_USER)
     cid, pid = ctx2
 
     caption = (m.caption or "").strip()
-    chat = await m.bot.get_chat(cid)
-    link = build_post_link(cid, chat.username, pid)
+    link = await post_link(m.bot, cid, pid)
     who = f"@{m.from_user.username}" if m.from_user.username else f"id:{m.from_user.id}"
     header = _hdr_user_to_admin_new(who, link, m.from_user.id, cid, pid, caption=caption or None)
 
-    # альбом?
-    if m.media_group_id and (m.photo or m.video or m.document):
-        mgid = m.media_group_id
-
-        # БД: Comment + CommentMedia (накапливаем все элементы альбома)
-        async with SessionLocal() as session:
-            ok, _ = await check_and_hit(session, m.from_user.id)
-            if not ok:
-                return await m.answer("Слишком часто. Попробуйте позже.")
-
-            user = (await session.execute(select(User).where(User.tg_id == m.from_user.id))).scalar_one()
-
-            if mgid not in _u2a_album_comment_id:
-                comment = Comment(channel_chat_id=cid, post_id=pid, user_id=user.id, text=caption or "")
-                session.add(comment)
-                await session.flush()
-                _u2a_album_comment_id[mgid] = comment.id
-
-            comment_id = _u2a_album_comment_id[mgid]
-            for t, fid, fuid, g in _media_records_from_message(m, mgid):
-                session.add(CommentMedia(
-                    comment_id=comment_id,
-                    media_type=t,
-                    file_id=fid,
-                    file_unique_id=fuid,
-                    media_group_id=g
-                ))
-            await session.commit()
-
-        # Буфер альбома для админа
-        _u2a_buf[mgid].append(m)
-        if mgid not in _u2a_ctx:
-            _u2a_ctx[mgid] = {
-                "mode": "new", "who": who, "uid": m.from_user.id,
-                "cid": cid, "pid": pid, "amid": None, "link": link, "mgid": mgid
-            }
-        if mgid not in _u2a_task:
-            _u2a_task[mgid] = asyncio.create_task(_delayed_flush_u2a(mgid))
+    # альбом? (первая часть: антиспам считает альбом одним комментарием)
+    if mgid:
+        ok, _ = check_and_hit(m.from_user.id)
+        if not ok:
+            return await send(m.bot, m.answer("Слишком часто. Попробуйте позже."), PRIO_USER)
+
+        # Comment, медиа и уведомление запишутся при сборке альбома, там же — «Готово»
+        digest.gate.hit(cid, pid)  # медиа идёт отдельно, но в частоту поста входит
+        user_id = await ensure_user(m.from_user.id, m.from_user.username)
+        u2a_albums.add(mgid, m, {
+            "mode": "new", "who": who, "uid": m.from_user.id,
+            "cid": cid, "pid": pid, "amid": None, "link": link, "mgid": mgid,
+            "user_id": user_id,
+        })
+        await pending.pop(m.from_user.id)
+        return
+
+    # одиночное медиа
+    ok, _ = check_and_hit(m.from_user.id)
+    if not ok:
+        return await send(m.bot, m.answer("Слишком часто. Попробуйте позже."), PRIO_USER)
 
+    digest.gate.hit(cid, pid)  # медиа идёт отдельно, но в частоту поста входит
+    user_id = await ensure_user(m.from_user.id, m.from_user.username)
+    ref = writer.add_comment(cid, pid, user_id, caption or "")
+    writer.add_media(ref, _media_records_from_message(m, None))
+
+    # Уведомление админу: фото/видео/док/аудио — с подписью; voice/кружок — копия (при запрете — документом) + якорь
+    method = _single_media_method(m, config.admin_chat_id, header)
+    if method:
+        steps = [step(method)]
     else:
-        # одиночное медиа: БД
-        async with SessionLocal() as session:
-            ok, _ = await check_and_hit(session, m.from_user.id)
-            if not ok:
-                return await m.answer("Слишком часто. Попробуйте позже.")
-            user = (await session.execute(select(User).where(User.tg_id == m.from_user.id))).scalar_one()
-            comment = Comment(channel_chat_id=cid, post_id=pid, user_id=user.id, text=caption or "")
-            session.add(comment); await session.flush()
-            for t, fid, fuid, g in _media_records_from_message(m, None):
-                session.add(CommentMedia(
-                    comment_id=comment.id,
-                    media_type=t,
-                    file_id=fid,
-                    file_unique_id=fuid,
-                    media_group_id=None
-                ))
-            await session.commit()
-
-        # Отправка админу: фото/видео/док/аудио — с подписью; voice/кружок — копия + якорь
-        if m.photo:
-            await m.bot.send_photo(config.admin_chat_id, m.photo[-1].file_id, caption=header, parse_mode="HTML")
-        elif m.video:
-            await m.bot.send_video(config.admin_chat_id, m.video.file_id, caption=header, parse_mode="HTML")
-        elif m.document:
-            await m.bot.send_document(config.admin_chat_id, m.document.file_id, caption=header, parse_mode="HTML")
-        elif m.audio:
-            await m.bot.send_audio(config.admin_chat_id, m.audio.file_id, caption=header, parse_mode="HTML")
-        else:
-            await _safe_copy_or_send(m.bot, config.admin_chat_id, m)
-            await asyncio.sleep(0.3)
-            await m.bot.send_message(config.admin_chat_id, header)
+        doc = _as_document(m, config.admin_chat_id)
+        steps = [step(_copy_method(m, config.admin_chat_id), fallback=[step(doc)] if doc else []),
+                 step(SendMessage(chat_id=config.admin_chat_id, text=header))]
+    outbox.add(ref, steps, route=(m.from_user.id, cid, pid))
+    if not await _committed(m, ref):
+        return
 
-    _pending.pop(m.from_user.id, None)
-    await m.answer("✅ Готово! Комментарий отправлен.\nОтветьте на это сообщение, чтобы написать Администратору.")
+    await pending.pop(m.from_user.id)
+    await _confirm_new(m, cid, pid, ref)
 
 __all__ = ["router"]
\ No newline at end of file
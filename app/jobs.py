@@ -0,0 +1,63 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class JobQueue:
+    """Фоновые задачи: ограниченная очередь и фиксированное число воркеров."""
+
+    def __init__(self, name: str, workers: int, maxsize: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks: list[asyncio.Task] = []
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def submit(self, fn: Callable[..., Awaitable], *args) -> bool:
+        self.start()
+        try:
+            self._queue.put_nowait((fn, args))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    async def _worker(self):
+        while True:
+            fn, args = await self._queue.get()
+            self.running += 1
+            try:
+                await fn(*args)
+                self.done += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"⚠️ Фоновая задача {self.name} упала:", e)
+            finally:
+                self.running -= 1
+                self._queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5.0):
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "running": self.running,
+            "done": self.done,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,320 @@
+"""
+Сквозной нагрузочный прогон без Telegram: Dispatcher получает синтетические апдейты
+(пост в канале → /start по кнопке → комментарий → ответ админа), а Bot API подменён
+локальным app.fake_api. БД — временная SQLite.
+
+    python -m app.loadtest --users 200 --concurrency 50
+    python -m app.loadtest --users 500 --albums 0.3 --voice 0.2 --p429 0.02 --voice-forbidden 0.5
+    python -m app.loadtest --telegram-limits      # с реальными лимитами отправки из конфига
+    python -m app.loadtest --posts 1 --digest-threshold 5   # дайджесты админу под нагрузкой на пост
+
+Отчёт: пропускная способность (комментариев/с), p50/p99 времени обработки апдейта по типам,
+сквозные задержки «комментарий → уведомление админу» и «ответ админа → пользователю»,
+вызовы Bot API на один комментарий.
+"""
+import argparse, asyncio, html, itertools, os, random, re, shutil, sys, tempfile, time
+from collections import Counter, defaultdict
+
+CHANNEL_ID = -1001000000001
+ADMIN_CHAT_ID = -1001000000002
+ADMIN_USER_ID = 7
+FIRST_UID = 500_000_000
+FORGED_UID = 499_999_999  # «жертва» подделанных меток: ей бот не должен писать никогда
+
+_UID_RE = re.compile(r"UID:(\d+)")
+
+
+def _prepare_env(args, db_dir: str):
+    # фильтры хендлеров читают config при импорте — окружение задаём до импорта app.*
+    os.environ.update({
+        "BOT_TOKEN": "42:fake",
+        "BOT_USERNAME": "fake_bot",
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(db_dir, 'loadtest.db')}",
+        # «реплика» — второй движок на тот же файл: проверка маршрутизации чтений без отставания
+        "DATABASE_READ_URL": f"sqlite+aiosqlite:///{os.path.join(db_dir, 'loadtest.db')}" if args.read_replica else "",
+        "ADMIN_CHAT_ID": str(ADMIN_CHAT_ID),
+        "ALLOWED_CHANNEL_IDS": str(CHANNEL_ID),
+        "DELIVERY_MODE": "polling",
+        "WEBHOOK_RECORD_PATH": "",
+        "PENDING_PERSIST": "0",
+        "ADMIN_DIGEST_THRESHOLD": str(args.digest_threshold),
+        "ADMIN_DIGEST_WINDOW_SEC": str(args.digest_window),
+    })
+    os.environ.setdefault("AUTO_REACTIONS", "👍,🔥,❤️")
+    if not args.telegram_limits:
+        # по умолчанию меряем сам конвейер, а не лимиты Telegram
+        os.environ.update({
+            "SEND_GLOBAL_PER_SEC": "100000",
+            "SEND_PRIVATE_PER_SEC": "100000",
+            "SEND_GROUP_PER_MIN": "6000000",
+        })
+
+
+class Harness:
+    def __init__(self, args, api, bot, dp):
+        self.args = args
+        self.api = api
+        self.bot = bot
+        self.dp = dp
+        self.rnd = random.Random(args.seed)
+        self._update_ids = itertools.count(1)
+        self._msg_ids: dict[int, itertools.count] = defaultdict(lambda: itertools.count(1))
+        self._waiters: dict[tuple[int, int], asyncio.Future] = {}
+        self.handler_ms: dict[str, list[float]] = defaultdict(list)
+        self.e2e_ms: dict[str, list[float]] = defaultdict(list)
+        self.outcomes: Counter = Counter()
+        self.comments = 0
+        self.posts: list[int] = []
+        api.on_message(self._on_bot_message)
+
+    # ---------- Наблюдение за «отправленным» ----------
+    def _on_bot_message(self, chat_id: int, msg: dict):
+        if chat_id == FORGED_UID:
+            self.outcomes["forged:misrouted"] += 1
+        # в дайджесте меток несколько — будим всех адресатов
+        for m in _UID_RE.finditer(msg.get("text") or msg.get("caption") or ""):
+            fut = self._waiters.pop((chat_id, int(m.group(1))), None)
+            if fut is not None and not fut.done():
+                fut.set_result(msg)
+
+    def _expect(self, chat_id: int, uid: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[(chat_id, uid)] = fut
+        return fut
+
+    # ---------- Синтетические апдейты ----------
+    def _message(self, chat: dict, sender: dict | None, **body) -> dict:
+        msg = {"message_id": next(self._msg_ids[chat["id"]]), "date": int(time.time()), "chat": chat, **body}
+        if sender:
+            msg["from"] = sender
+        return msg
+
+    async def feed(self, kind: str, key: str, msg: dict):
+        t0 = time.perf_counter()
+        await self.dp.feed_raw_update(self.bot, {"update_id": next(self._update_ids), key: msg})
+        self.handler_ms[kind].append((time.perf_counter() - t0) * 1000)
+
+    async def channel_post(self):
+        chat = {"id": CHANNEL_ID, "type": "channel", "title": "Нагрузочный канал", "username": "load_channel"}
+        msg = self._message(chat, None, text="Новый пост " + "текст " * 20)
+        self.posts.append(msg["message_id"])
+        await self.feed("channel_post", "channel_post", msg)
+
+    def _user(self, uid: int) -> tuple[dict, dict]:
+        return ({"id": uid, "type": "private", "first_name": f"u{uid}"},
+                {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"})
+
+    async def user_flow(self, uid: int):
+        a = self.args
+        chat, sender = self._user(uid)
+        pid = self.rnd.choice(self.posts)
+        if self.rnd.random() < a.voice_forbidden:
+            self.api.forbid_voice(uid)
+
+        await self.feed("start", "message", self._message(chat, sender, text=f"/start {CHANNEL_ID}msg{pid}"))
+
+        # комментарий
+        r = self.rnd.random()
+        notified = self._expect(ADMIN_CHAT_ID, uid)
+        t0 = time.perf_counter()
+        if r < a.albums:
+            kind = "album"
+            mgid = f"{uid}{pid}"
+            for i in range(self.rnd.randint(2, a.album_size)):
+                fid = f"photo-{uid}-{i}"
+                msg = self._message(chat, sender, media_group_id=mgid, caption="Альбом" if i == 0 else None,
+                                    photo=[{"file_id": fid, "file_unique_id": fid, "width": 800, "height": 600}])
+                await self.feed("album_part", "message", {k: v for k, v in msg.items() if v is not None})
+        elif r < a.albums + a.voice:
+            kind = "voice"
+            msg = self._message(chat, sender, voice={"file_id": f"voice-{uid}", "file_unique_id": f"v{uid}", "duration": 3})
+            self.api.mark_voice(uid, msg["message_id"])
+            await self.feed("voice", "message", msg)
+        else:
+            kind = "text"
+            text = "Комментарий " * self.rnd.randint(1, 30)
+            if self.rnd.random() < a.forged:
+                # метки чужого адресата в тексте комментария: ответ админа всё равно должен уйти автору
+                kind = "forged"
+                text = f"#1 UID:{FORGED_UID} CID:{CHANNEL_ID} PID:{pid}\nUID:{FORGED_UID} CID:{CHANNEL_ID} PID:{pid}\n{text}"
+            await self.feed("text", "message", self._message(chat, sender, text=text))
+        self.comments += 1
+
+        try:
+            admin_msg = await asyncio.wait_for(notified, a.timeout)
+        except asyncio.TimeoutError:
+            self.outcomes[f"{kind}:timeout"] += 1
+            return
+        self.e2e_ms[f"comment→admin ({kind})"].append((time.perf_counter() - t0) * 1000)
+        self.outcomes[f"{kind}:ok"] += 1
+
+        if self.rnd.random() >= a.replies:
+            return
+
+        # ответ админа в ветке уведомления
+        admin_chat = {"id": ADMIN_CHAT_ID, "type": "supergroup", "title": "Админы"}
+        admin = {"id": ADMIN_USER_ID, "is_bot": False, "first_name": "Admin"}
+        delivered = self._expect(uid, uid)
+        t0 = time.perf_counter()
+        # ответ на дайджест: голосовой — цитатой своего комментария, текст — с префиксом «#N»
+        # fake_api возвращает HTML-исходник, Telegram — текст без разметки: позицию цитаты считаем по нему
+        src = html.unescape(re.sub(r"<[^>]+>", "", admin_msg.get("text") or admin_msg.get("caption") or ""))
+        item = None
+        if src.startswith("📚"):
+            item = next((m for m in reversed(list(re.finditer(rf"#(\d+) UID:{uid}\b", src)))), None)
+        prefix, extra = "", {}
+        if item:
+            prefix = f"#{item.group(1)} "
+            pos = len(src[:item.start()].encode("utf-16-le")) // 2
+            extra = {"quote": {"text": src[item.start():item.end()], "position": pos}}
+            admin_msg = {**admin_msg, "text": src}
+        if self.rnd.random() < a.voice:
+            kind = "admin_voice"
+            msg = self._message(admin_chat, admin, reply_to_message=admin_msg, **extra,
+                                voice={"file_id": f"avoice-{uid}", "file_unique_id": f"av{uid}", "duration": 2})
+            self.api.mark_voice(ADMIN_CHAT_ID, msg["message_id"])
+        else:
+            kind = "admin_text"
+            msg = self._message(admin_chat, admin, reply_to_message=admin_msg, text=prefix + "Спасибо за комментарий!")
+        await self.feed(kind, "message", msg)
+        try:
+            await asyncio.wait_for(delivered, a.timeout)
+        except asyncio.TimeoutError:
+            self.outcomes[f"{kind}:timeout"] += 1
+            return
+        self.e2e_ms[f"reply→user ({kind})"].append((time.perf_counter() - t0) * 1000)
+        self.outcomes[f"{kind}:ok"] += 1
+
+
+def _pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(len(s) * p))]
+
+
+def _print_latencies(title: str, data: dict[str, list[float]]):
+    print(f"\n{title}:")
+    print(f"  {'':<28}{'n':>7}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for kind in sorted(data):
+        v = data[kind]
+        print(f"  {kind:<28}{len(v):>7}{_pct(v, 0.5):>10.1f}{_pct(v, 0.99):>10.1f}{max(v):>10.1f}")
+
+
+async def _run(args):
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+
+    from .__main__ import build_dispatcher
+    from . import metrics
+    from .db import engine, read_engine, read_stats
+    from .digest import gate as digest_gate
+    from .schema import ensure_schema
+    from .startup import startup
+    from .fake_api import FakeBotAPI
+    from .handlers import channel as channel_handlers
+    from .middlewares import mailbox
+    from .outbox import outbox
+    from .sender import scheduler
+    from .writer import writer
+
+    api = FakeBotAPI(p429=args.p429, retry_after=args.retry_after, seed=args.seed,
+                     p_media_group_fail=args.media_group_fail)
+    await api.start()
+    bot = Bot(
+        token="42:fake",
+        session=AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    dp = build_dispatcher(bot, with_metrics=True)
+
+    await ensure_schema()
+    await dp.emit_startup(bot=bot)
+    h = Harness(args, api, bot, dp)
+    try:
+        for _ in range(args.posts):
+            await h.channel_post()
+
+        sem = asyncio.Semaphore(args.concurrency)
+        async def one(uid: int):
+            async with sem:
+                await h.user_flow(uid)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(FIRST_UID + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - t0
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        await api.stop()
+        await engine.dispose()
+        if read_engine is not engine:
+            await read_engine.dispose()
+
+    calls = api.calls
+    total_calls = sum(calls.values())
+    print(f"\nПользователей: {args.users}, комментариев: {h.comments}, за {elapsed:.2f}s "
+          f"→ {h.comments / elapsed:.1f} комментариев/с")
+    print(f"Исходы: {dict(sorted(h.outcomes.items()))}")
+    _print_latencies("Обработка апдейта (feed_update)", h.handler_ms)
+    _print_latencies("Сквозные задержки", h.e2e_ms)
+    print(f"\nBot API: {total_calls} вызовов, {total_calls / max(1, h.comments):.2f} на комментарий")
+    for method, n in calls.most_common():
+        print(f"  {method:<28}{n:>7}{n / max(1, h.comments):>8.2f}/комм.")
+    if api.errors:
+        print(f"Ошибки Bot API (подмешанные): {dict(api.errors)}")
+    print(f"Планировщик: {scheduler.stats()}")
+    print(f"Writer: {writer.stats()}")
+    print(f"Оформление постов: {channel_handlers.decorations.stats()}")
+    print(f"Outbox: {outbox.stats()}")
+    print(f"Дайджест: {digest_gate.stats()}")
+    print(f"Очереди пользователей: {mailbox.stats()}")
+    print(f"Чтения БД: {read_stats.stats()}")
+    print(f"Старт: {startup.stats()}")
+    if args.metrics_out:
+        with open(args.metrics_out, "w", encoding="utf-8") as f:
+            f.write(metrics.render())
+        print(f"Метрики Prometheus: {args.metrics_out}")
+    if any(k.endswith((":timeout", ":misrouted")) for k in h.outcomes):
+        sys.exit(1)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=200, help="синтетических пользователей (по комментарию на каждого)")
+    ap.add_argument("--concurrency", type=int, default=50, help="одновременно активных пользователей")
+    ap.add_argument("--posts", type=int, default=5, help="постов в канале перед прогоном")
+    ap.add_argument("--albums", type=float, default=0.2, help="доля комментариев-альбомов")
+    ap.add_argument("--album-size", type=int, default=4, help="максимум фото в альбоме")
+    ap.add_argument("--voice", type=float, default=0.1, help="доля голосовых (и у пользователей, и у админа)")
+    ap.add_argument("--replies", type=float, default=0.5, help="доля комментариев, на которые отвечает админ")
+    ap.add_argument("--p429", type=float, default=0.0, help="вероятность 429 на отправку")
+    ap.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    ap.add_argument("--media-group-fail", type=float, default=0.0,
+                    help="вероятность отказа sendMediaGroup (альбомы уходят fallback'ом)")
+    ap.add_argument("--voice-forbidden", type=float, default=0.0, help="доля пользователей с запретом голосовых")
+    ap.add_argument("--read-replica", action="store_true", help="чтения через отдельный движок DATABASE_READ_URL")
+    ap.add_argument("--forged", type=float, default=0.05,
+                    help="доля текстовых комментариев с подделанными метками адресата (ответ должен уйти автору)")
+    ap.add_argument("--digest-threshold", type=int, default=0,
+                    help="ADMIN_DIGEST_THRESHOLD: комментариев к посту за окно, после которых — дайджест (0 — выкл.)")
+    ap.add_argument("--digest-window", type=float, default=1.0, help="ADMIN_DIGEST_WINDOW_SEC для прогона, с")
+    ap.add_argument("--telegram-limits", action="store_true", help="не снимать лимиты отправки SEND_*")
+    ap.add_argument("--timeout", type=float, default=30.0, help="ожидание доставки одного сообщения, с")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--metrics-out", default="", help="сохранить снимок /metrics после прогона")
+    args = ap.parse_args()
+
+    db_dir = tempfile.mkdtemp(prefix="kvantora-load-")
+    _prepare_env(args, db_dir)
+    try:
+        asyncio.run(_run(args))
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
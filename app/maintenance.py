@@ -0,0 +1,239 @@
+"""
+Обслуживание БД в фоне: раз в MAINTENANCE_INTERVAL_SEC удаляем отжившие строки —
+rate_limits без действующих лимитов, просроченные pending, доставленный outbox,
+а при заданных сроках хранения — старые комментарии (с медиа, опционально в архив) и маршруты
+(вместе с адресатами дайджестов), а за удалёнными комментариями — ставшие ничейными файлы media.
+
+Каждая пачка — своя короткая транзакция по keyset (PK > последнего), между пачками пауза:
+блокировки короткие, бот работает как обычно. В кластере чистит только воркер 0.
+
+    python -m app.maintenance          # один проход и отчёт (тот же, что в фоне)
+"""
+import argparse, asyncio, os, time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+from sqlalchemy import delete, exists, select, tuple_
+
+from .antispam import stale_clause
+from .config import config
+from .db import SessionLocal
+from .export import JsonlWriter, load_chunk
+from .models import Comment, CommentMedia, DigestItem, Media, MessageRoute, OutboxEntry, RateLimit
+from .pending import pending
+from .writer import MEDIA_CACHE_TTL
+
+# шаг пачки: (сессия, последний ключ) -> (удалено, новый последний ключ) или None — кандидатов больше нет
+Step = Callable[..., Awaitable[tuple[int, object] | None]]
+
+
+class Maintenance:
+
+    _FIRST_DELAY = 60.0  # после рестарта не мешаем прогреву и первым апдейтам
+
+    def __init__(self, interval: float, batch: int, pause: float):
+        self.interval = interval
+        self.batch = max(1, batch)
+        self.pause = pause
+        self._task: asyncio.Task | None = None
+        self._archive = None
+        self.runs = 0
+        self.errors = 0
+        self.last: dict[str, int] = {}
+        self.total: Counter = Counter()
+        self.last_run_sec = 0.0
+
+    # ---------- Проход ----------
+    async def run_once(self) -> dict[str, int]:
+        t0 = time.perf_counter()
+        now = datetime.utcnow()
+        done: dict[str, int] = {}
+        try:
+            done["rate_limits"] = await self._batches(lambda s, last: self._rate_limits(s, last, now))
+            done["pending"] = await pending.purge_expired()
+            if config.outbox_retention_days > 0:
+                cutoff = now - timedelta(days=config.outbox_retention_days)
+                done["outbox"] = await self._batches(lambda s, last: self._outbox(s, last, cutoff))
+            if config.route_retention_days > 0:
+                cutoff = now - timedelta(days=config.route_retention_days)
+                done["routes"] = await self._batches(lambda s, last: self._routes(s, last, cutoff))
+                done["digest_items"] = await self._batches(lambda s, last: self._digest_items(s, last, cutoff))
+            if config.comment_retention_days > 0:
+                cutoff = now - timedelta(days=config.comment_retention_days)
+                done["comments"] = await self._batches(lambda s, last: self._comments(s, last, cutoff))
+                # файлы без комментариев; кэш writer'а живёт меньше срока хранения — ссылок на них не осталось
+                if config.comment_retention_days * 86400 > MEDIA_CACHE_TTL:
+                    done["media"] = await self._batches(self._media)
+        finally:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+        self.runs += 1
+        self.last = done
+        self.total.update(done)
+        self.last_run_sec = round(time.perf_counter() - t0, 3)
+        print(f"✅ Обслуживание БД за {self.last_run_sec} с, удалено: {done}")
+        return done
+
+    async def _batches(self, step: Step) -> int:
+        total, last = 0, None
+        while True:
+            async with SessionLocal() as session:
+                res = await step(session, last)
+                if res is None:
+                    return total
+                n, last = res
+                await session.commit()
+            total += n
+            await asyncio.sleep(self.pause)  # отдаём БД живому трафику
+
+    # ---------- Таблицы ----------
+    async def _rate_limits(self, session, last: int | None, now: datetime):
+        # как _Bucket.is_stale: ни окно, ни часовой бакет уже ни на что не влияют
+        stale = stale_clause(now, config.rate_window_sec)
+        q = select(RateLimit.user_tg_id).where(stale)
+        if last is not None:
+            q = q.where(RateLimit.user_tg_id > last)
+        keys = (await session.execute(q.order_by(RateLimit.user_tg_id).limit(self.batch))).scalars().all()
+        if not keys:
+            return None
+        # условие повторяем: пользователь мог написать между SELECT и DELETE
+        res = await session.execute(delete(RateLimit).where(RateLimit.user_tg_id.in_(keys), stale))
+        return res.rowcount or 0, keys[-1]
+
+    async def _outbox(self, session, last: int | None, cutoff: datetime):
+        done = (OutboxEntry.status.in_(("sent", "failed")), OutboxEntry.created_at < cutoff)
+        q = select(OutboxEntry.id).where(*done)
+        if last is not None:
+            q = q.where(OutboxEntry.id > last)
+        keys = (await session.execute(q.order_by(OutboxEntry.id).limit(self.batch))).scalars().all()
+        if not keys:
+            return None
+        res = await session.execute(delete(OutboxEntry).where(OutboxEntry.id.in_(keys), *done))
+        return res.rowcount or 0, keys[-1]
+
+    async def _routes(self, session, last: tuple[int, int] | None, cutoff: datetime):
+        pk = tuple_(MessageRoute.chat_id, MessageRoute.message_id)
+        q = select(MessageRoute.chat_id, MessageRoute.message_id).where(MessageRoute.created_at < cutoff)
+        if last is not None:
+            q = q.where(pk > tuple_(*last))
+        keys = [tuple(k) for k in (await session.execute(
+            q.order_by(MessageRoute.chat_id, MessageRoute.message_id).limit(self.batch)
+        )).all()]
+        if not keys:
+            return None
+        res = await session.execute(delete(MessageRoute).where(pk.in_(keys), MessageRoute.created_at < cutoff))
+        return res.rowcount or 0, keys[-1]
+
+    async def _digest_items(self, session, last: tuple[int, int, int] | None, cutoff: datetime):
+        pk = tuple_(DigestItem.chat_id, DigestItem.message_id, DigestItem.item_no)
+        q = select(DigestItem.chat_id, DigestItem.message_id, DigestItem.item_no).where(DigestItem.created_at < cutoff)
+        if last is not None:
+            q = q.where(pk > tuple_(*last))
+        keys = [tuple(k) for k in (await session.execute(
+            q.order_by(DigestItem.chat_id, DigestItem.message_id, DigestItem.item_no).limit(self.batch)
+        )).all()]
+        if not keys:
+            return None
+        res = await session.execute(delete(DigestItem).where(pk.in_(keys), DigestItem.created_at < cutoff))
+        return res.rowcount or 0, keys[-1]
+
+    async def _comments(self, session, last: int | None, cutoff: datetime):
+        if config.comment_archive_dir:
+            items = await load_chunk(session, last or 0, self.batch, until=cutoff)
+            keys = [item["id"] for item in items]
+            if keys:
+                # архив — до коммита удаления: при сбое строка попадёт в архив повторно, но не потеряется
+                archive = self._open_archive()
+                for item in items:
+                    archive.write(item)
+                archive.f.flush()
+        else:
+            q = select(Comment.id).where(Comment.created_at < cutoff)
+            if last is not None:
+                q = q.where(Comment.id > last)
+            keys = (await session.execute(q.order_by(Comment.id).limit(self.batch))).scalars().all()
+        if not keys:
+            return None
+        # дочерние строки — явно: ON DELETE CASCADE есть не на каждой БД (SQLite без foreign_keys)
+        await session.execute(delete(CommentMedia).where(CommentMedia.comment_id.in_(keys)))
+        await session.execute(delete(OutboxEntry).where(OutboxEntry.comment_id.in_(keys)))
+        res = await session.execute(delete(Comment).where(Comment.id.in_(keys)))
+        return res.rowcount or 0, keys[-1]
+
+    async def _media(self, session, last: int | None):
+        orphan = ~exists().where(CommentMedia.media_id == Media.id)
+        q = select(Media.id)
+        if last is not None:
+            q = q.where(Media.id > last)
+        # keyset по всем id, а не только по ничейным: пачка не сканирует таблицу до конца
+        keys = (await session.execute(q.order_by(Media.id).limit(self.batch))).scalars().all()
+        if not keys:
+            return None
+        res = await session.execute(delete(Media).where(Media.id.in_(keys), orphan))
+        return res.rowcount or 0, keys[-1]
+
+    def _open_archive(self) -> JsonlWriter:
+        if self._archive is None:
+            os.makedirs(config.comment_archive_dir, exist_ok=True)
+            path = os.path.join(config.comment_archive_dir, f"comments-{datetime.utcnow():%Y%m%d-%H%M%S}.jsonl")
+            self._archive = open(path, "a", encoding="utf-8")
+        return JsonlWriter(self._archive)
+
+    # ---------- Фон ----------
+    async def _loop(self):
+        await asyncio.sleep(min(self._FIRST_DELAY, self.interval))
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.errors += 1
+                print("⚠️ Обслуживание БД не удалось:", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()  # прерванная пачка откатится целиком
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "last_run_sec": self.last_run_sec,
+            **{f"last_{k}": v for k, v in self.last.items()},
+            **{f"total_{k}": v for k, v in self.total.items()},
+        }
+
+
+maintenance = Maintenance(
+    interval=config.maintenance_interval_sec,
+    batch=config.maintenance_batch,
+    pause=config.maintenance_pause_sec,
+)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Один проход обслуживания БД")
+    ap.add_argument("--pause", type=float, default=None, help="пауза между пачками, с (по умолчанию MAINTENANCE_PAUSE_SEC)")
+    args = ap.parse_args()
+    if args.pause is not None:
+        maintenance.pause = args.pause
+
+    async def run():
+        from .db import engine
+        try:
+            await maintenance.run_once()
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей:
+время апдейтов и хендлеров, SQL-запросы и ожидание соединения из пула, вызовы Bot API,
+плюс счётчики компонентов (планировщик, writer, кэши) как gauge.
+"""
+import math, time
+from typing import Any, Awaitable, Callable
+from aiohttp import web
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _REGISTRY.append(self)
+
+    def _labelstr(self, values: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        out = super().render()
+        out += [f"{self.name}{self._labelstr(k)} {_fmt(v)}" for k, v in self._values.items()]
+        return out
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = _DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: dict[tuple, list] = {}  # labels -> [counts по бакетам..., sum, count]
+
+    def observe(self, value: float, *labels):
+        v = self._values.get(labels)
+        if v is None:
+            v = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                v[i] += 1
+                break
+        v[-2] += value
+        v[-1] += 1
+
+    def render(self) -> list[str]:
+        out = super().render()
+        n = len(self.buckets)
+        for k, v in self._values.items():
+            acc = 0
+            for i, b in enumerate(self.buckets):
+                acc += v[i]
+                le = f'le="{_fmt(b)}"'
+                out.append(f"{self.name}_bucket{self._labelstr(k, le)} {acc}")
+            out.append(f"{self.name}_sum{self._labelstr(k)} {_fmt(v[n])}")
+            out.append(f"{self.name}_count{self._labelstr(k)} {v[n + 1]}")
+        return out
+
+
+_REGISTRY: list[_Metric] = []
+# name -> функция stats() компонента; числовые поля отдаём как gauge
+_STATS: dict[str, Callable[[], dict]] = {}
+
+
+def register_stats(name: str, fn: Callable[[], dict]):
+    _STATS[name] = fn
+
+
+def render() -> str:
+    lines: list[str] = []
+    for m in _REGISTRY:
+        lines += m.render()
+    for comp, fn in _STATS.items():
+        try:
+            stats = fn()
+        except Exception:
+            continue
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"bot_{comp}_{key}"
+            lines += [f"# TYPE {name} gauge", f"{name} {_fmt(value)}"]
+    return "\n".join(lines) + "\n"
+
+
+# ---------- Метрики ----------
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Полная обработка апдейта", ("type",))
+UPDATE_ERRORS = Counter("bot_update_errors_total", "Апдейты, упавшие с исключением", ("type",))
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время хендлера", ("router", "handler"))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ("router", "handler", "error"))
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Время SQL-запроса", ("op",), _DB_BUCKETS)
+DB_ERRORS = Counter("bot_db_errors_total", "Ошибки SQL", ("op",))
+DB_POOL_WAIT_SECONDS = Histogram("bot_db_pool_wait_seconds", "Ожидание соединения из пула", (), _DB_BUCKETS)
+API_SECONDS = Histogram("bot_api_seconds", "Вызовы Bot API", ("method",))
+API_ERRORS = Counter("bot_api_errors_total", "Ошибки Bot API", ("method", "error"))
+API_RETRY_AFTER = Counter("bot_api_retry_after_total", "Ответы 429 (RetryAfter)", ("method",))
+
+
+# ---------- aiogram ----------
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: весь путь апдейта, включая фильтры всех роутеров."""
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event, data: dict[str, Any]) -> Any:
+        kind = getattr(event, "event_type", "unknown")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS.inc(kind)
+            raise
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - t0, kind)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: к этому моменту известны роутер и сработавший хендлер."""
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event, data: dict[str, Any]) -> Any:
+        router = getattr(data.get("event_router"), "name", "?")
+        h = data.get("handler")
+        name = getattr(getattr(h, "callback", None), "__name__", "?")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(router, name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, router, name)
+
+
+def instrument_dispatcher(dp: Dispatcher):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    # inner-middleware родителя применяется к хендлерам всех вложенных роутеров
+    mw = HandlerMetricsMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(mw)
+
+
+class BotApiMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            API_RETRY_AFTER.inc(api_method)
+            raise
+        except Exception as e:
+            API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - t0, api_method)
+
+
+def instrument_bot(bot):
+    bot.session.middleware(BotApiMetrics())
+
+
+# ---------- SQLAlchemy ----------
+def _statement_op(statement: str) -> str:
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+
+
+def _instrument_pool(pool):
+    connect = pool.connect
+
+    def timed_connect():
+        t0 = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - t0)
+    pool.connect = timed_connect
+
+
+def instrument_engine(engine: AsyncEngine, name: str = "db_pool"):
+    sync = engine.sync_engine
+
+    @event.listens_for(sync, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_metrics_t0", []).append(time.perf_counter())
+
+    @event.listens_for(sync, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stack = conn.info.get("_metrics_t0")
+        if stack:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - stack.pop(), _statement_op(statement))
+
+    @event.listens_for(sync, "handle_error")
+    def _error(ctx):
+        stack = ctx.connection.info.get("_metrics_t0") if ctx.connection is not None else None
+        if stack:
+            stack.pop()
+        DB_ERRORS.inc(_statement_op(ctx.statement or ""))
+
+    @event.listens_for(sync, "engine_disposed")
+    def _disposed(_):
+        _instrument_pool(sync.pool)  # dispose() создаёт новый пул
+
+    _instrument_pool(sync.pool)
+    register_stats(name, lambda: {"checked_out": sync.pool.checkedout()} if hasattr(sync.pool, "checkedout") else {})
+
+
+# ---------- HTTP ----------
+async def _handle(_: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+def add_metrics_route(app: web.Application, path: str = "/metrics"):
+    app.router.add_get(path, _handle)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"✅ Metrics: http://{host}:{port}/metrics")
+    return runner
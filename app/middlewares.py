@@ -0,0 +1,172 @@
+import asyncio, time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Hashable
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import Update
+
+from .config import config
+from .db import begin_update_session, commit_before_io, end_update_session
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Сессия БД на апдейт: хендлеры и хелперы берут её через db.session_scope(),
+    соединение берётся из пула только при первом запросе, коммит/откат — один раз в конце.
+    """
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event, data: dict[str, Any]) -> Any:
+        us, token = begin_update_session()
+        data["db"] = us
+        ok = False
+        try:
+            result = await handler(event, data)
+            ok = True
+            return result
+        finally:
+            try:
+                await us.finish(ok)
+            finally:
+                end_update_session(token)
+
+
+class CommitBeforeApiMiddleware(BaseRequestMiddleware):
+    """Прямые вызовы Bot API из апдейта (get_chat, реакции) не ждут сеть с открытой записью в БД."""
+
+    async def __call__(self, make_request, bot, method):
+        await commit_before_io()
+        return await make_request(bot, method)
+
+
+class FirstUpdateMiddleware(BaseMiddleware):
+    """Один раз, на первом апдейте после запуска, вызывает on_first (замер времени старта)."""
+
+    def __init__(self, on_first: Callable[[], None]):
+        self.on_first = on_first
+        self.seen = False
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event, data: dict[str, Any]) -> Any:
+        if not self.seen:
+            self.seen = True
+            self.on_first()
+        return await handler(event, data)
+
+
+# «апдейт принят в очередь»: вызывается до ожидания своего ключа — webhook отпускает слот (см. app.webhook)
+on_admitted: ContextVar[Callable[[], None] | None] = ContextVar("mailbox_on_admitted", default=None)
+
+
+class _Box:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class Mailbox:
+    """
+    Очереди апдейтов по ключу (пользователь / media_group_id / чат): внутри ключа — строго
+    по одному в порядке поступления, разные ключи — параллельно, но не больше max_concurrency сразу.
+    Переполненная очередь ключа (флуд одного пользователя) отбрасывает новые апдейты.
+    Ожидание в очереди ключа не держит чужих слотов: до него вызывается on_admitted.
+    """
+
+    def __init__(self, max_concurrency: int, max_per_key: int):
+        self.max_per_key = max_per_key
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._boxes: dict[Hashable, _Box] = {}
+        self.running = 0
+        self.queued = 0
+        self.max_depth = 0
+        self.processed = 0
+        self.dropped = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    async def run(self, key: Hashable | None, fn: Callable[[], Awaitable[Any]]) -> Any:
+        admitted = on_admitted.get()
+        if admitted is not None:
+            admitted()
+        if key is None:
+            self.queued += 1
+            return await self._run_capped(time.monotonic(), fn)
+        box = self._boxes.get(key)
+        if box is None:
+            box = self._boxes[key] = _Box()
+        if box.depth >= self.max_per_key:
+            self.dropped += 1
+            return None
+        box.depth += 1
+        self.queued += 1
+        self.max_depth = max(self.max_depth, box.depth)
+        t0 = time.monotonic()
+        try:
+            try:
+                await box.lock.acquire()
+            except BaseException:
+                self.queued -= 1
+                raise
+            try:
+                return await self._run_capped(t0, fn)
+            finally:
+                box.lock.release()
+        finally:
+            box.depth -= 1
+            if box.depth == 0:
+                self._boxes.pop(key, None)
+
+    async def _run_capped(self, t0: float, fn: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            await self._sem.acquire()
+        finally:
+            self.queued -= 1
+        wait = time.monotonic() - t0
+        self.wait_sum += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.processed += 1
+        self.running += 1
+        try:
+            return await fn()
+        finally:
+            self.running -= 1
+            self._sem.release()
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._boxes),
+            "running": self.running,
+            "queued": self.queued,
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "wait_avg_ms": round(self.wait_sum / self.processed * 1000, 1) if self.processed else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+        }
+
+
+def update_key(event: Update, data: dict[str, Any]) -> Hashable | None:
+    """Ключ очереди: отправитель, иначе альбом, иначе чат (посты канала); None — без очереди."""
+    user = data.get("event_from_user")
+    if user is not None:
+        return "u", user.id
+    msg = event.message or event.channel_post or event.edited_message or event.edited_channel_post
+    if msg is not None and msg.media_group_id:
+        return "g", msg.media_group_id
+    chat = data.get("event_chat")
+    if chat is not None:
+        return "c", chat.id
+    return None
+
+
+class UserMailboxMiddleware(BaseMiddleware):
+    """Апдейты одного пользователя обрабатываются по очереди: нет гонок за его RateLimit, pending и альбомы."""
+
+    def __init__(self, box: Mailbox):
+        self.box = box
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event, data: dict[str, Any]) -> Any:
+        return await self.box.run(update_key(event, data), lambda: handler(event, data))
+
+
+mailbox = Mailbox(max_concurrency=config.mailbox_max_concurrency, max_per_key=config.mailbox_max_per_key)
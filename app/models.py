@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-from sqlalchemy import BigInteger, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import BigInteger, Integer, String, DateTime, ForeignKey, Index, Text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from .db import Base
 
@@ -46,9 +46,10 @@ class RateLimit(Base):
         if self.last_ts and (now - self.last_ts).total_seconds() < window_sec:
             return False, max(0, per_hour - (self.hour_count or 0))
 
-        # (2) почасовой бакет
-        hb = self.hour_bucket_start or now
-        if (now - hb) >= timedelta(hours=1):
+        # (2) почасовой бакет; у старых строк без начала бакета считаем его от last_ts (счётчик не теряем)
+        if self.hour_bucket_start is None:
+            self.hour_bucket_start = self.last_ts or now
+        if (now - self.hour_bucket_start) >= timedelta(hours=1):
             self.hour_bucket_start = now
             self.hour_count = 0
 
@@ -59,12 +60,72 @@ class RateLimit(Base):
         self.hour_count += 1
         return True, per_hour - self.hour_count
     
+class Media(Base):
+    """Файл один раз на file_unique_id: повторно присланное фото/мем — та же строка."""
+    __tablename__ = "media"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    file_unique_id: Mapped[str] = mapped_column(String(128), unique=True, index=True)
+    media_type: Mapped[str] = mapped_column(String(16))        # photo|video|document|voice|video_note|audio
+    file_id: Mapped[str] = mapped_column(String(512))          # первый увиденный (для повторной отправки)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
 class CommentMedia(Base):
     __tablename__ = "comment_medias"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     comment_id: Mapped[int] = mapped_column(ForeignKey("comments.id", ondelete="CASCADE"), index=True)
-    media_type: Mapped[str] = mapped_column(String(16))        # photo|video|document|voice|video_note|audio
-    file_id: Mapped[str] = mapped_column(String(512))
-    file_unique_id: Mapped[str | None] = mapped_column(String(128), nullable=True)
+    media_id: Mapped[int] = mapped_column(ForeignKey("media.id"), index=True)  # какие комментарии использовали файл
     media_group_id: Mapped[str | None] = mapped_column(String(64), nullable=True)  # чтобы понимать альбом
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class PendingContext(Base):
+    __tablename__ = "pending_contexts"
+    user_tg_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    channel_chat_id: Mapped[int] = mapped_column(BigInteger)
+    post_id: Mapped[int] = mapped_column(Integer)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class MessageRoute(Base):
+    """Служебное сообщение (или ответ в переписке) -> адресат: UID/CID/PID/AMID без разбора текста."""
+    __tablename__ = "message_routes"
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    message_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(BigInteger)
+    channel_chat_id: Mapped[int] = mapped_column(BigInteger)
+    post_id: Mapped[int] = mapped_column(Integer)
+    admin_message_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class DigestItem(Base):
+    """Комментарий в дайджесте админу: (сообщение, #N) -> адресат и границы его блока в тексте (UTF-16)."""
+    __tablename__ = "digest_items"
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    message_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    item_no: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_tg_id: Mapped[int] = mapped_column(BigInteger)
+    channel_chat_id: Mapped[int] = mapped_column(BigInteger)
+    post_id: Mapped[int] = mapped_column(Integer)
+    text_start: Mapped[int] = mapped_column(Integer)
+    text_end: Mapped[int] = mapped_column(Integer)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class SchemaVersion(Base):
+    """Одна строка: версия схемы, до которой доведена БД (см. app.schema.MIGRATIONS)."""
+    __tablename__ = "schema_version"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class OutboxEntry(Base):
+    """Уведомление, записанное в одной транзакции с Comment; доставляет app.outbox (повторы, backoff)."""
+    __tablename__ = "outbox"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    comment_id: Mapped[int | None] = mapped_column(ForeignKey("comments.id", ondelete="CASCADE"), nullable=True)
+    payload: Mapped[str] = mapped_column(Text)                  # JSON: шаги (методы Bot API) и маршрут
+    status: Mapped[str] = mapped_column(String(8), default="pending")   # pending|sent|failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_at: Mapped[datetime] = mapped_column(DateTime)          # не раньше; для взятого в работу — срок аренды
+    last_error: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_outbox_due", "status", "next_at"),)
@@ -0,0 +1,380 @@
+"""
+Транзакционный outbox уведомлений о комментариях. Запись (шаги — сериализованные методы Bot API
+и маршрут ответа) пишется writer'ом в одной транзакции с Comment, поэтому сбой отправки
+после коммита не теряет комментарий: запись остаётся pending и доставляется повторно.
+
+Свежие записи своего процесса воркеры получают сразу после коммита; опрос БД подбирает
+повторы по backoff и записи, чья аренда истекла (процесс упал посреди доставки).
+Доставка «хотя бы один раз»: после падения посреди альбома возможен дубль.
+
+Записи с digest (текстовые комментарии к посту под нагрузкой, см. app.digest) копятся
+ADMIN_DIGEST_WINDOW_SEC и уходят одним сообщением; если Telegram его отверг — каждая по отдельности.
+"""
+import asyncio, json, random, time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pydantic import BaseModel
+from sqlalchemy import select, update
+from aiogram import methods as tg_methods
+from aiogram.client.default import Default
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage, TelegramMethod
+
+from . import digest
+from .config import config
+from .db import SessionLocal
+from .models import OutboxEntry
+from .routing import routes, message_ids
+from .sender import send, PRIO_ADMIN
+from .writer import CommentRef, writer
+
+# ошибки, которые повтор не исправит: сразу fallback шага (или отказ)
+_PERMANENT = (TelegramBadRequest, TelegramForbiddenError)
+
+
+def _defaults(obj) -> dict:
+    """exclude для полей Default(...) (в т.ч. вложенных InputMedia): при загрузке вернутся умолчания бота."""
+    if isinstance(obj, BaseModel):
+        ex = {}
+        for k, v in obj:
+            if isinstance(v, Default):
+                ex[k] = True
+            elif sub := _defaults(v):
+                ex[k] = sub
+        return ex
+    if isinstance(obj, (list, tuple)):
+        return {i: sub for i, v in enumerate(obj) if (sub := _defaults(v))}
+    return {}
+
+
+def step(method: TelegramMethod, fallback: list[dict] = (), optional: bool = False) -> dict:
+    """
+    Шаг доставки. fallback — шаги вместо этого, если Telegram отверг метод (400/403);
+    optional — отказ шага не срывает доставку (копии частей альбома перед якорем).
+    """
+    return {
+        "method": type(method).__name__,
+        "json": method.model_dump_json(exclude_none=True, exclude=_defaults(method)),
+        "fallback": list(fallback),
+        "optional": optional,
+    }
+
+
+def _load(s: dict) -> TelegramMethod:
+    return getattr(tg_methods, s["method"]).model_validate_json(s["json"])
+
+
+class Outbox:
+
+    _DELIVERED_KEEP = 4096
+
+    def __init__(self, workers: int, poll_interval: float, lease: float, max_attempts: int,
+                 backoff: float, backoff_max: float):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.bot = None
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._active: set[int] = set()
+        # прогресс недоставленной записи в этом процессе: повтор продолжает с упавшего шага
+        self._progress: dict[int, tuple[int, list[int]]] = {}
+        # доп. сообщения пользователя, которым после доставки нужен AMID (подтверждение «Готово»)
+        self._links: dict[int, list[tuple[int, list[int]]]] = {}
+        self._delivered: OrderedDict[int, tuple] = OrderedDict()
+        self.delivered = 0
+        self.retries = 0
+        self.failed = 0
+        self.fallbacks = 0
+        self.fallback_calls = 0
+        self.step_errors = 0
+        self.claimed = 0
+        # дайджесты: (cid, pid) -> [(outbox_id, payload, attempts)], таймер окна и размер HTML
+        self.digest_window = config.admin_digest_window_sec
+        self.digest_max_items = config.admin_digest_max_items
+        self._digests: dict[tuple[int, int], list[tuple[int, dict, int]]] = {}
+        self._digest_size: dict[tuple[int, int], int] = {}
+        self._digest_timers: dict[tuple[int, int], asyncio.TimerHandle] = {}
+        self.digests = 0
+        self.digest_items = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    # ---------- Запись ----------
+    def add(self, ref: CommentRef, steps: list[dict], route: tuple[int, int, int], prio: int = PRIO_ADMIN,
+            digest: dict | None = None):
+        """
+        Кладём уведомление в ту же пачку writer'а, что и Comment; доставка — после коммита.
+        digest — {who, text, link}: собрать в дайджест по посту (steps — если дайджест не ушёл).
+        """
+        data = {"steps": steps, "route": list(route), "prio": prio, "ts": time.time()}
+        if digest:
+            data["digest"] = digest
+        payload = json.dumps(data, ensure_ascii=False)
+        writer.add_outbox(ref, payload, self.lease)
+
+    def link(self, outbox_id: int | None, chat_id: int, ids: list[int]):
+        """Сообщениям ids в chat_id проставить AMID уведомления, когда оно будет доставлено."""
+        if outbox_id is None or not ids:
+            return
+        ctx = self._delivered.get(outbox_id)
+        if ctx is not None:
+            routes.remember(chat_id, ids, ctx)
+        else:
+            self._links.setdefault(outbox_id, []).append((chat_id, ids))
+
+    # ---------- Доставка ----------
+    def _kick(self, outbox_id: int, payload: str):
+        if self._queue is not None:
+            self._dispatch((outbox_id, json.loads(payload), 0))
+
+    def _dispatch(self, item: tuple[int, dict, int]):
+        outbox_id, payload, _ = item
+        d = payload.get("digest")
+        if d is None:
+            self._queue.put_nowait(item)
+            return
+        _, cid, pid = payload["route"]
+        key = (cid, pid)
+        size = digest.item_size(d["who"], d["text"], tuple(payload["route"]))
+        if key in self._digests and self._digest_size[key] + size > digest.MAX_TEXT:
+            self._flush_digest(key)
+        self._active.add(outbox_id)  # опрос не заберёт запись, пока она ждёт в буфере
+        if key not in self._digests:
+            self._digests[key] = []
+            self._digest_size[key] = 0
+            self._digest_timers[key] = asyncio.get_running_loop().call_later(
+                self.digest_window, self._flush_digest, key)
+        self._digests[key].append(item)
+        self._digest_size[key] += size
+        if len(self._digests[key]) >= self.digest_max_items:
+            self._flush_digest(key)
+
+    def _flush_digest(self, key: tuple[int, int]):
+        items = self._digests.pop(key, None)
+        self._digest_size.pop(key, None)
+        timer = self._digest_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if not items:
+            return
+        if len(items) == 1:
+            self._active.discard(items[0][0])
+            self._queue.put_nowait(items[0])  # один комментарий — обычным уведомлением
+        else:
+            self._queue.put_nowait((None, items, 0))
+
+    async def _run_step(self, s: dict, prio: int) -> list[int]:
+        try:
+            return message_ids(await send(self.bot, _load(s), prio))
+        except _PERMANENT as e:
+            if s["optional"]:
+                self.step_errors += 1
+                print(f"⚠️ Outbox: шаг {s['method']} пропущен:", e)
+                return []
+            if not s["fallback"]:
+                raise
+            self.fallbacks += 1
+            self.fallback_calls += len(s["fallback"])
+            ids = []
+            for fb in s["fallback"]:
+                ids += await self._run_step(fb, prio)
+            return ids
+
+    async def _deliver(self, outbox_id: int, payload: dict, attempts: int):
+        steps = payload["steps"]
+        done, sent = self._progress.pop(outbox_id, (0, []))
+        self._active.add(outbox_id)
+        try:
+            while done < len(steps):
+                sent += await self._run_step(steps[done], payload["prio"])
+                done += 1
+        except asyncio.CancelledError:
+            self._progress[outbox_id] = (done, sent)
+            writer.mark_outbox(outbox_id, next_at=datetime.utcnow())  # после рестарта — сразу, без ожидания аренды
+            raise
+        except Exception as e:
+            self._fail(outbox_id, attempts + 1, e, permanent=isinstance(e, _PERMANENT), progress=(done, sent))
+            return
+        finally:
+            self._active.discard(outbox_id)
+        self._done(outbox_id, payload, sent)
+
+    async def _deliver_digest(self, items: list[tuple[int, dict, int]]):
+        first = items[0][1]
+        _, cid, pid = first["route"]
+        text, spans = digest.render(first["digest"].get("link"), cid, pid,
+                             [(p["digest"]["who"], p["digest"]["text"], tuple(p["route"])) for _, p, _ in items])
+        try:
+            sent = message_ids(await send(self.bot, SendMessage(chat_id=config.admin_chat_id, text=text),
+                                          first["prio"]))
+        except asyncio.CancelledError:
+            for outbox_id, _, _ in items:
+                writer.mark_outbox(outbox_id, next_at=datetime.utcnow())
+            raise
+        except _PERMANENT as e:
+            print(f"⚠️ Outbox: дайджест из {len(items)} не принят, шлём по одному:", e)
+            for item in items:
+                self._active.discard(item[0])
+                self._queue.put_nowait(item)
+            return
+        except Exception as e:
+            for outbox_id, _, attempts in items:
+                self._fail(outbox_id, attempts + 1, e, permanent=False, progress=(0, []))
+            return
+        finally:
+            for outbox_id, _, _ in items:
+                self._active.discard(outbox_id)
+        self.digests += 1
+        self.digest_items += len(items)
+        # адресаты дайджеста — по номерам: ответ выбирает #N из записанного, а не из текста сообщения
+        if sent:
+            routes.remember_digest(config.admin_chat_id, sent[-1], [
+                ((p["route"][0], p["route"][1], p["route"][2], None), start, end)
+                for (_, p, _), (start, end) in zip(items, spans)
+            ])
+        for outbox_id, payload, _ in items:
+            self._done(outbox_id, payload, sent, remember_admin=False)
+
+    def _done(self, outbox_id: int, payload: dict, sent: list[int], remember_admin: bool = True):
+        writer.mark_outbox(outbox_id, status="sent", sent_at=datetime.utcnow(), last_error=None)
+        uid, cid, pid = payload["route"]
+        amid = sent[-1] if sent else None  # якорь (или само уведомление) — на него отвечает админ
+        if remember_admin:
+            routes.remember(config.admin_chat_id, sent, (uid, cid, pid, None))
+        ctx = (uid, cid, pid, amid)
+        for chat_id, ids in self._links.pop(outbox_id, []):
+            routes.remember(chat_id, ids, ctx)
+        self._delivered[outbox_id] = ctx
+        if len(self._delivered) > self._DELIVERED_KEEP:
+            self._delivered.popitem(last=False)
+        self.delivered += 1
+        latency = max(0.0, time.time() - payload.get("ts", time.time()))
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def _fail(self, outbox_id: int, attempts: int, e: Exception, permanent: bool, progress: tuple[int, list[int]]):
+        error = f"{type(e).__name__}: {e}"[:255]
+        if permanent or attempts >= self.max_attempts:
+            self.failed += 1
+            self._links.pop(outbox_id, None)
+            writer.mark_outbox(outbox_id, status="failed", attempts=attempts, last_error=error)
+            print(f"⚠️ Outbox: уведомление {outbox_id} не доставлено ({attempts} попыток):", error)
+            return
+        self.retries += 1
+        self._progress[outbox_id] = progress
+        delay = min(self.backoff_max, self.backoff * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+        if isinstance(e, TelegramRetryAfter):
+            delay = max(delay, e.retry_after)
+        writer.mark_outbox(outbox_id, attempts=attempts, last_error=error,
+                           next_at=datetime.utcnow() + timedelta(seconds=delay))
+
+    async def _worker(self):
+        while True:
+            outbox_id, payload, attempts = await self._queue.get()
+            try:
+                if outbox_id is None:
+                    await self._deliver_digest(payload)
+                else:
+                    await self._deliver(outbox_id, payload, attempts)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("⚠️ Outbox: ошибка доставки:", e)
+            finally:
+                self._queue.task_done()
+
+    async def poll_once(self, limit: int = 100) -> int:
+        """Забираем созревшие записи (повторы, чужие просроченные аренды): условный UPDATE — аренда."""
+        now = datetime.utcnow()
+        async with SessionLocal() as session:
+            rows = (await session.execute(
+                select(OutboxEntry.id, OutboxEntry.payload, OutboxEntry.attempts)
+                .where(OutboxEntry.status == "pending", OutboxEntry.next_at <= now)
+                .order_by(OutboxEntry.id).limit(limit)
+            )).all()
+            claimed = []
+            for oid, payload, attempts in rows:
+                if oid in self._active:
+                    continue
+                res = await session.execute(
+                    update(OutboxEntry)
+                    .where(OutboxEntry.id == oid, OutboxEntry.status == "pending", OutboxEntry.next_at <= now)
+                    .values(next_at=now + timedelta(seconds=self.lease))
+                )
+                if res.rowcount:
+                    claimed.append((oid, json.loads(payload), attempts))
+            await session.commit()
+        for item in claimed:
+            self._dispatch(item)
+        self.claimed += len(claimed)
+        return len(claimed)
+
+    async def _poller(self):
+        while True:
+            try:
+                await self.poll_once()
+            except Exception as e:
+                print("⚠️ Outbox: не удалось прочитать очередь:", e)
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self, bot):
+        if self._tasks:
+            return
+        self.bot = bot
+        self._queue = asyncio.Queue()
+        writer.on_outbox = self._kick
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._poller()))
+
+    async def stop(self, timeout: float = 10.0):
+        """Даём дослать очередь (не дольше timeout), остальное подберёт следующий запуск."""
+        if not self._tasks:
+            return
+        writer.on_outbox = None
+        for key in list(self._digests):
+            self._flush_digest(key)
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            outbox_id, payload, _ = self._queue.get_nowait()
+            for oid in ([i[0] for i in payload] if outbox_id is None else [outbox_id]):
+                writer.mark_outbox(oid, next_at=datetime.utcnow())
+        self._queue = None
+
+    def stats(self) -> dict:
+        return {
+            "queue": self._queue.qsize() if self._queue is not None else 0,
+            "active": len(self._active),
+            "delivered": self.delivered,
+            "retries": self.retries,
+            "failed": self.failed,
+            "fallbacks": self.fallbacks,
+            "fallback_calls": self.fallback_calls,
+            "step_errors": self.step_errors,
+            "claimed": self.claimed,
+            "digest_open": len(self._digests),
+            "digests": self.digests,
+            "digest_items": self.digest_items,
+            "latency_avg_ms": round(self.latency_sum / self.delivered * 1000, 1) if self.delivered else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 1),
+        }
+
+
+outbox = Outbox(
+    workers=config.outbox_workers,
+    poll_interval=config.outbox_poll_sec,
+    lease=config.outbox_lease_sec,
+    max_attempts=config.outbox_max_attempts,
+    backoff=config.outbox_backoff_sec,
+    backoff_max=config.outbox_backoff_max_sec,
+)
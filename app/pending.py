@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete
+
+from .cache import TTLCache
+from .config import config
+from .db import session_scope, upsert
+from .models import PendingContext
+
+
+class PendingStore:
+    """
+    user_tg_id -> (channel_chat_id, post_id) для тех, кто нажал кнопку под постом.
+    Горячий набор — в памяти (TTL + LRU), опционально дублируется в pending_contexts,
+    чтобы переживать рестарт и быть видимым другим воркерам.
+    """
+
+    def __init__(self, ttl: float, maxsize: int, persist: bool):
+        self.ttl = ttl
+        self.persist = persist
+        self._cache = TTLCache(ttl=ttl, maxsize=maxsize)
+        self.db_loads = 0
+
+    async def set(self, user_tg_id: int, ctx: tuple[int, int]):
+        self._cache.set(user_tg_id, ctx)
+        if self.persist:
+            async with session_scope() as session:
+                await session.execute(upsert(
+                    PendingContext,
+                    [{"user_tg_id": user_tg_id, "channel_chat_id": ctx[0], "post_id": ctx[1],
+                      "created_at": datetime.utcnow()}],
+                    keys=["user_tg_id"],
+                    update=["channel_chat_id", "post_id", "created_at"],
+                ))
+
+    async def get(self, user_tg_id: int) -> tuple[int, int] | None:
+        ctx = self._cache.get(user_tg_id)
+        if ctx is None and self.persist:
+            ctx = await self._load(user_tg_id)
+        return ctx
+
+    async def pop(self, user_tg_id: int) -> tuple[int, int] | None:
+        ctx = self._cache.pop(user_tg_id)
+        if self.persist:
+            async with session_scope() as session:
+                await session.execute(delete(PendingContext).where(PendingContext.user_tg_id == user_tg_id))
+        return ctx
+
+    async def _load(self, user_tg_id: int) -> tuple[int, int] | None:
+        # только primary: на отстающей реплике может быть ещё не записанный или уже снятый контекст
+        self.db_loads += 1
+        async with session_scope() as session:
+            row = (await session.execute(
+                select(PendingContext).where(PendingContext.user_tg_id == user_tg_id)
+            )).scalar_one_or_none()
+        return self._remember(row, datetime.utcnow()) if row else None
+
+    def _remember(self, row: PendingContext, now: datetime) -> tuple[int, int] | None:
+        left = self.ttl - (now - row.created_at).total_seconds()
+        if left <= 0:
+            return None
+        ctx = (row.channel_chat_id, row.post_id)
+        self._cache.set(row.user_tg_id, ctx, ttl=left)
+        return ctx
+
+    async def warm(self) -> int:
+        """Живые контексты из БД — в кэш на старте (свежие первыми, не больше размера кэша)."""
+        if not self.persist:
+            return 0
+        now = datetime.utcnow()
+        async with session_scope() as session:
+            rows = (await session.execute(
+                select(PendingContext)
+                .where(PendingContext.created_at >= now - timedelta(seconds=self.ttl))
+                .order_by(PendingContext.created_at.desc())
+                .limit(self._cache.maxsize)
+            )).scalars().all()
+        # старые первыми: в LRU свежие окажутся «горячее»
+        return sum(self._remember(row, now) is not None for row in reversed(rows))
+
+    async def purge_expired(self) -> int:
+        """Удаляем из БД просроченные контексты."""
+        if not self.persist:
+            return 0
+        async with session_scope() as session:
+            res = await session.execute(delete(PendingContext).where(
+                PendingContext.created_at < datetime.utcnow() - timedelta(seconds=self.ttl)
+            ))
+        return res.rowcount or 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def stats(self) -> dict:
+        return {**self._cache.stats(), "db_loads": self.db_loads, "persist": self.persist}
+
+
+pending = PendingStore(ttl=config.pending_ttl_sec, maxsize=config.pending_max, persist=config.pending_persist)
@@ -0,0 +1,107 @@
+from datetime import datetime
+from typing import Iterable
+from sqlalchemy import select
+
+from .cache import TTLCache
+from .config import config
+from .db import engine, read_engine, read_scope
+from .models import DigestItem, MessageRoute
+from .writer import writer
+
+# (uid, cid, pid, amid) — тот же кортеж, что даёт разбор меток из текста
+Route = tuple[int, int, int, int | None]
+# комментарий дайджеста: адресат и границы его блока в тексте сообщения (UTF-16, как quote.position)
+DigestEntry = tuple[Route, int, int]
+
+
+class RouteTable:
+    """
+    (chat_id, message_id) -> Route. Горячие маршруты в LRU, все — в message_routes
+    (пишутся пачкой через writer). Ответ на любое записанное сообщение резолвится
+    за один lookup, на любой глубине переписки.
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self._cache = TTLCache(ttl=ttl, maxsize=maxsize)
+        self._digests = TTLCache(ttl=ttl, maxsize=max(1, maxsize // 10))
+        self.db_hits = 0
+
+    def remember(self, chat_id: int, message_ids: Iterable[int], route: Route):
+        uid, cid, pid, amid = route
+        now = datetime.utcnow()
+        rows = []
+        for mid in message_ids:
+            self._cache.set((chat_id, mid), route)
+            rows.append({
+                "chat_id": chat_id, "message_id": mid, "user_tg_id": uid,
+                "channel_chat_id": cid, "post_id": pid, "admin_message_id": amid,
+                "created_at": now,
+            })
+        if rows:
+            writer.add_routes(rows)
+
+    def remember_digest(self, chat_id: int, message_id: int, items: list[DigestEntry]):
+        """Дайджест: адресатов несколько, ответ выбирает одного из них по #N или цитате (app.digest.pick)."""
+        self._digests.set((chat_id, message_id), items)
+        now = datetime.utcnow()
+        writer.add_digest_items([{
+            "chat_id": chat_id, "message_id": message_id, "item_no": n,
+            "user_tg_id": uid, "channel_chat_id": cid, "post_id": pid,
+            "text_start": start, "text_end": end, "created_at": now,
+        } for n, ((uid, cid, pid, _), start, end) in enumerate(items, 1)])
+
+    async def resolve_digest(self, chat_id: int, message_id: int) -> list[DigestEntry] | None:
+        return await self._digests.get_or_load(
+            (chat_id, message_id), lambda: self._load_digest(chat_id, message_id))
+
+    async def _load_digest(self, chat_id: int, message_id: int) -> list[DigestEntry] | None:
+        rows = await self._select_digest(chat_id, message_id, fresh=False)
+        if not rows and read_engine is not engine:
+            rows = await self._select_digest(chat_id, message_id, fresh=True)
+        if not rows:
+            return None
+        self.db_hits += 1
+        return [((r.user_tg_id, r.channel_chat_id, r.post_id, None), r.text_start, r.text_end) for r in rows]
+
+    @staticmethod
+    async def _select_digest(chat_id: int, message_id: int, fresh: bool) -> list[DigestItem]:
+        async with read_scope(fresh=fresh) as session:
+            return list((await session.execute(
+                select(DigestItem).where(DigestItem.chat_id == chat_id, DigestItem.message_id == message_id)
+                .order_by(DigestItem.item_no)
+            )).scalars())
+
+    async def resolve(self, chat_id: int, message_id: int) -> Route | None:
+        return await self._cache.get_or_load((chat_id, message_id), lambda: self._load(chat_id, message_id))
+
+    async def _load(self, chat_id: int, message_id: int) -> Route | None:
+        r = await self._select(chat_id, message_id, fresh=False)
+        if r is None and read_engine is not engine:
+            # маршрут мог записаться только что и ещё не доехать до реплики
+            r = await self._select(chat_id, message_id, fresh=True)
+        if r is None:
+            return None
+        self.db_hits += 1
+        return r.user_tg_id, r.channel_chat_id, r.post_id, r.admin_message_id
+
+    @staticmethod
+    async def _select(chat_id: int, message_id: int, fresh: bool) -> MessageRoute | None:
+        async with read_scope(fresh=fresh) as session:
+            return (await session.execute(
+                select(MessageRoute).where(MessageRoute.chat_id == chat_id, MessageRoute.message_id == message_id)
+            )).scalar_one_or_none()
+
+    def stats(self) -> dict:
+        return {**self._cache.stats(), "digests": len(self._digests), "db_hits": self.db_hits}
+
+
+routes = RouteTable(ttl=config.route_cache_ttl_sec, maxsize=config.route_cache_size)
+
+
+def message_ids(result) -> list[int]:
+    """message_id из ответа Bot API: Message, MessageId или список сообщений альбома."""
+    if result is None:
+        return []
+    if isinstance(result, list):
+        return [r.message_id for r in result]
+    return [result.message_id]
@@ -0,0 +1,147 @@
+"""
+Версия схемы БД. На старте — один SELECT из schema_version; create_all и миграции
+выполняются, только если версия в БД отстаёт от MIGRATIONS (или таблицы ещё нет).
+
+Миграции только дописываются в конец списка и должны быть идемпотентными: БД без
+schema_version (созданная до её появления) проходит их все, в т.ч. уже применённые руками.
+"""
+from datetime import datetime
+from sqlalchemy import MetaData, Table, bindparam, inspect, null, select, text, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateTable
+
+from .db import Base, engine, upsert, insert_ignore
+from .models import CommentMedia, DigestItem, Media, SchemaVersion
+
+_BATCH = 1000
+
+
+def _create_all(conn):
+    Base.metadata.create_all(conn)  # checkfirst: существующие таблицы не трогает
+
+
+_LEGACY_MEDIA_COLUMNS = ("file_id", "media_type", "file_unique_id")
+
+
+def _media_store(conn):
+    """
+    comment_medias.file_id/media_type/file_unique_id -> таблица media (одна строка на file_unique_id).
+    Каждый шаг проверяет, сделан ли он: на MySQL DDL коммитится сразу, и после сбоя миграция
+    запускается заново с того места, где остановилась.
+    """
+    Media.__table__.create(conn, checkfirst=True)
+    cols = {c["name"] for c in inspect(conn).get_columns("comment_medias")}
+    mysql = conn.dialect.name == "mysql"
+    if "media_id" not in cols:
+        # MySQL молча игнорирует REFERENCES в определении колонки — ключ ему добавляем отдельно
+        ref = "" if mysql else " REFERENCES media(id)"
+        conn.execute(text(f"ALTER TABLE comment_medias ADD COLUMN media_id INTEGER{ref}"))
+    if mysql and not any(fk["referred_table"] == "media" and fk["constrained_columns"] == ["media_id"]
+                         for fk in inspect(conn).get_foreign_keys("comment_medias")):
+        conn.execute(text("ALTER TABLE comment_medias ADD CONSTRAINT fk_comment_medias_media_id "
+                          "FOREIGN KEY (media_id) REFERENCES media(id)"))
+    for ix in CommentMedia.__table__.indexes:
+        ix.create(conn, checkfirst=True)
+    legacy = [c for c in _LEGACY_MEDIA_COLUMNS if c in cols]
+    if not legacy:
+        return  # уже новая схема
+    table = CommentMedia.__table__
+    if "file_id" in cols and "media_type" in cols:
+        _backfill_media(conn)  # после него колонки удаляются, начиная с file_id
+    _drop_legacy_media_columns(conn, legacy)
+    for ix in table.indexes:
+        ix.create(conn, checkfirst=True)
+
+
+def _backfill_media(conn):
+    table = CommentMedia.__table__
+    old = Table("comment_medias", MetaData(), autoload_with=conn)  # старые колонки — с типами из БД
+    fuid = old.c.get("file_unique_id")
+    # переносим пачками по PK только ещё не перенесённые; у старых строк без file_unique_id — свой ключ на строку
+    last = 0
+    while True:
+        rows = conn.execute(
+            select(old.c.id, old.c.media_type, old.c.file_id, old.c.created_at,
+                   (fuid if fuid is not None else null()).label("file_unique_id"))
+            .where(old.c.id > last, old.c.media_id.is_(None)).order_by(old.c.id).limit(_BATCH)
+        ).all()
+        if not rows:
+            break
+        keys = {r.id: r.file_unique_id or f"legacy:{r.id}" for r in rows}
+        new = {}
+        for r in rows:
+            new.setdefault(keys[r.id], {"file_unique_id": keys[r.id], "media_type": r.media_type,
+                                        "file_id": r.file_id, "created_at": r.created_at})
+        conn.execute(insert_ignore(Media, list(new.values()), keys=["file_unique_id"]))
+        ids = dict(conn.execute(
+            select(Media.file_unique_id, Media.id).where(Media.file_unique_id.in_(new))
+        ).all())
+        conn.execute(update(table).where(table.c.id == bindparam("cm_id")).values(media_id=bindparam("m_id")),
+                     [{"cm_id": cm_id, "m_id": ids[k]} for cm_id, k in keys.items()])
+        last = rows[-1].id
+
+
+def _drop_legacy_media_columns(conn, legacy: list[str]):
+    """Убираем оставшиеся старые колонки и делаем media_id NOT NULL, как в модели."""
+    if conn.dialect.name == "sqlite":
+        # DROP COLUMN есть только с SQLite 3.35, NOT NULL колонке не добавить вовсе — пересобираем таблицу
+        new = CommentMedia.__table__.to_metadata(Base.metadata, name="comment_medias_new")
+        try:
+            conn.execute(CreateTable(new))  # без индексов: их имена пока заняты старой таблицей
+        finally:
+            Base.metadata.remove(new)
+        cols = ", ".join(c.name for c in CommentMedia.__table__.columns)
+        conn.execute(text(f"INSERT INTO comment_medias_new ({cols}) SELECT {cols} FROM comment_medias"))
+        conn.execute(text("DROP TABLE comment_medias"))
+        conn.execute(text("ALTER TABLE comment_medias_new RENAME TO comment_medias"))
+        return
+    if conn.dialect.name == "mysql":
+        conn.execute(text("ALTER TABLE comment_medias MODIFY media_id INTEGER NOT NULL"))
+    else:
+        conn.execute(text("ALTER TABLE comment_medias ALTER COLUMN media_id SET NOT NULL"))
+    # по одной: после сбоя посреди DDL (MySQL) повтор удалит то, что осталось
+    for col in legacy:
+        conn.execute(text(f"ALTER TABLE comment_medias DROP COLUMN {col}"))
+
+
+def _digest_items(conn):
+    DigestItem.__table__.create(conn, checkfirst=True)
+
+
+# (версия, описание, fn(sync_conn))
+MIGRATIONS = [
+    (1, "базовая схема", _create_all),
+    (2, "медиа по file_unique_id", _media_store),
+    (3, "маршруты дайджестов", _digest_items),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def current_version() -> int:
+    """Версия схемы в БД; 0 — таблицы schema_version ещё нет."""
+    try:
+        async with engine.connect() as conn:
+            return (await conn.execute(select(SchemaVersion.version).where(SchemaVersion.id == 1))).scalar() or 0
+    except DBAPIError:
+        return 0
+
+
+async def ensure_schema() -> int:
+    """Доводим схему до SCHEMA_VERSION; число применённых миграций (0 — схема актуальна)."""
+    version = await current_version()
+    if version > SCHEMA_VERSION:
+        print(f"⚠️ Схема БД v{version} новее кода (v{SCHEMA_VERSION}): миграции не запускаем")
+    if version >= SCHEMA_VERSION:
+        return 0
+    todo = [m for m in MIGRATIONS if m[0] > version]
+    async with engine.begin() as conn:
+        for v, title, fn in todo:
+            await conn.run_sync(fn)
+            print(f"✅ Миграция v{v}: {title}")
+        await conn.execute(upsert(
+            SchemaVersion,
+            [{"id": 1, "version": SCHEMA_VERSION, "updated_at": datetime.utcnow()}],
+            keys=["id"],
+            update=["version", "updated_at"],
+        ))
+    return len(todo)
@@ -0,0 +1,202 @@
+import asyncio, bisect, itertools, time
+from dataclasses import dataclass, field
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMediaGroup, TelegramMethod
+
+from .config import config
+from .db import commit_before_io
+
+# Приоритеты: меньше — раньше
+PRIO_USER = 0    # ответы пользователю (подтверждения, сообщения от админа)
+PRIO_ADMIN = 1   # уведомления в админ-чат
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "ts")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.ts = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def delay(self, now: float, cost: float = 1) -> float:
+        """Сколько секунд ждать, пока хватит токенов (0 — можно сейчас)."""
+        self._refill(now)
+        need = min(cost, self.capacity) - self.tokens
+        return need / self.rate if need > 0 else 0.0
+
+    def take(self, now: float, cost: float = 1):
+        self._refill(now)
+        self.tokens -= cost  # может уйти в минус: альбом «в долг» тормозит следующие отправки
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass(order=True)
+class _Job:
+    prio: int
+    seq: int
+    chat_id: int = field(compare=False)
+    cost: int = field(compare=False)
+    bot: object = field(compare=False)
+    method: TelegramMethod = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+class SendScheduler:
+    """
+    Единая очередь исходящих запросов к Bot API.
+    Токен-бакет на каждый чат + общий бакет, RetryAfter ставит чат на паузу,
+    внутри чата — строгий порядок (одна отправка в полёте).
+    """
+
+    _GC_THRESHOLD = 4096
+
+    def __init__(self, global_per_sec: float, private_per_sec: float, group_per_min: float, max_retries: int):
+        self.private_per_sec = private_per_sec
+        self.group_per_sec = group_per_min / 60
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_per_sec, global_per_sec)
+        self._buckets: dict[int, TokenBucket] = {}
+        self._paused_until: dict[int, float] = {}
+        self._busy: set[int] = set()
+        self._jobs: list[_Job] = []
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self._buckets.get(chat_id)
+        if b is None:
+            if chat_id < 0:  # группы/каналы: ~20 сообщений в минуту
+                b = TokenBucket(self.group_per_sec, 5)
+            else:
+                b = TokenBucket(self.private_per_sec, 3)
+            self._buckets[chat_id] = b
+        return b
+
+    async def send(self, bot, method: TelegramMethod, prio: int = PRIO_ADMIN):
+        self.start()
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        job = _Job(prio, next(self._seq), int(method.chat_id), cost, bot, method,
+                   asyncio.get_running_loop().create_future())
+        bisect.insort(self._jobs, job)
+        self._wakeup.set()
+        return await job.future
+
+    def _pick(self) -> tuple[_Job | None, float | None]:
+        now = time.monotonic()
+        wait = self._global.delay(now)
+        if wait > 0:
+            return None, wait
+        seen: set[int] = set()
+        for job in self._jobs:
+            if job.future.done():  # отправитель уже не ждёт (отмена)
+                self._jobs.remove(job)
+                return None, 0
+            if job.chat_id in seen:
+                continue
+            seen.add(job.chat_id)
+            if job.chat_id in self._busy:
+                continue
+            d = max(self._paused_until.get(job.chat_id, 0) - now, self._bucket(job.chat_id).delay(now, job.cost))
+            if d <= 0:
+                self._jobs.remove(job)
+                return job, None
+            wait = d if wait == 0 else min(wait, d)
+        return None, (wait or None)
+
+    async def _run(self):
+        while True:
+            job, wait = self._pick()
+            if job is None:
+                if wait == 0:
+                    continue
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.monotonic()
+            self._global.take(now, job.cost)
+            self._bucket(job.chat_id).take(now, job.cost)
+            self._busy.add(job.chat_id)
+            asyncio.create_task(self._execute(job))
+            if len(self._buckets) > self._GC_THRESHOLD:
+                self._gc(now)
+
+    async def _execute(self, job: _Job):
+        try:
+            result = await job.bot(job.method)
+        except TelegramRetryAfter as e:
+            self.retry_after += 1
+            self._paused_until[job.chat_id] = time.monotonic() + e.retry_after
+            if job.attempts < self.max_retries and not job.future.done():
+                job.attempts += 1
+                bisect.insort(self._jobs, job)  # тот же seq — встаёт на своё место в очереди
+            elif not job.future.done():
+                self.failed += 1
+                job.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._busy.discard(job.chat_id)
+            self._wakeup.set()
+
+    def _gc(self, now: float):
+        active = {j.chat_id for j in self._jobs} | self._busy
+        for cid in [c for c, b in self._buckets.items() if c not in active and b.is_full(now)]:
+            del self._buckets[cid]
+        for cid in [c for c, t in self._paused_until.items() if t < now]:
+            del self._paused_until[cid]
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._jobs),
+            "in_flight": len(self._busy),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+        }
+
+
+scheduler = SendScheduler(
+    global_per_sec=config.send_global_per_sec,
+    private_per_sec=config.send_private_per_sec,
+    group_per_min=config.send_group_per_min,
+    max_retries=config.send_max_retries,
+)
+
+
+async def send(bot, method: TelegramMethod, prio: int = PRIO_ADMIN):
+    """Отправка через планировщик; ждём результат (future), а не спим."""
+    await commit_before_io()
+    return await scheduler.send(bot, method, prio)
@@ -0,0 +1,65 @@
+"""
+Старт процесса: прогрев кэшей (каналы, недавние пользователи, pending, лимиты) параллельно
+с созданием Bot-сессии и время от запуска до первого апдейта — видно, насколько быстр rolling restart.
+"""
+import asyncio, time
+
+T0 = time.perf_counter()
+
+from .antispam import limiter  # noqa: E402
+from .chats import load_channels  # noqa: E402
+from .config import config  # noqa: E402
+from .pending import pending  # noqa: E402
+from .users import warm_users  # noqa: E402
+
+
+class Startup:
+
+    def __init__(self, t0: float):
+        self.t0 = t0
+        self.phases: dict[str, float] = {}   # фаза -> секунд от запуска
+        self.warmed: dict[str, int] = {}
+        self.first_update_sec: float | None = None
+        self._warmup: asyncio.Task | None = None
+
+    def mark(self, phase: str):
+        self.phases[phase] = round(time.perf_counter() - self.t0, 3)
+
+    def start_warmup(self):
+        if self._warmup is None:
+            self._warmup = asyncio.create_task(self._warm())
+
+    async def wait_warmup(self):
+        """Ждём прогрева (запускаем, если ещё не запущен) — до приёма апдейтов."""
+        self.start_warmup()
+        await self._warmup
+
+    async def _warm(self):
+        loaders = {
+            "channels": load_channels(),
+            "users": warm_users(config.user_warm_limit, config.user_warm_hours),
+            "pending": pending.warm(),
+            "rate_limits": limiter.load(),
+        }
+        results = await asyncio.gather(*loaders.values(), return_exceptions=True)
+        for name, r in zip(loaders, results):
+            if isinstance(r, Exception):
+                print(f"⚠️ Прогрев {name} не удался:", r)  # не фатально: кэш наполнится по ходу
+            else:
+                self.warmed[name] = r
+        self.mark("warm")
+        print(f"✅ Прогрев за {self.phases['warm']} с: {self.warmed}")
+
+    def first_update(self):
+        if self.first_update_sec is None:
+            self.first_update_sec = round(time.perf_counter() - self.t0, 3)
+            print(f"✅ Первый апдейт через {self.first_update_sec} с после запуска {self.phases}")
+
+    def stats(self) -> dict:
+        return {
+            **{f"{phase}_sec": sec for phase, sec in self.phases.items()},
+            "first_update_sec": self.first_update_sec or 0.0,
+        }
+
+
+startup = Startup(T0)
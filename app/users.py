@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select
+
+from .cache import TTLCache
+from .config import config
+from .db import session_scope, read_scope, after_commit, upsert_returning_id
+from .models import Comment, User
+
+# tg_id -> (users.id, username)
+user_cache = TTLCache(ttl=config.user_cache_ttl_sec, maxsize=config.user_cache_size)
+
+
+async def ensure_user(tg_id: int, username: str | None) -> int:
+    """
+    users.id по tg_id. Известный пользователь с тем же username — без БД;
+    иначе один upsert (регистрация или смена username), id кладём в кэш после коммита.
+    """
+    cached = user_cache.get(tg_id)
+    if cached is not None and cached[1] == username:
+        return cached[0]
+    async with session_scope() as session:
+        user_id = await upsert_returning_id(
+            session, User,
+            {"tg_id": tg_id, "username": username, "created_at": datetime.utcnow()},
+            keys=["tg_id"],
+            update=["username"],
+        )
+
+    def _cache():
+        user_cache.set(tg_id, (user_id, username))
+    after_commit(_cache)
+    return user_id
+
+
+async def warm_users(limit: int, hours: float) -> int:
+    """
+    Недавно писавшие пользователи — в кэш на старте, чтобы их первые апдейты после рестарта
+    шли без upsert. Смотрим только последние комментарии по PK, без скана всей таблицы.
+    """
+    if limit <= 0:
+        return 0
+    recent = select(Comment.user_id, Comment.created_at).order_by(Comment.id.desc()).limit(limit * 4).subquery()
+    async with read_scope() as session:
+        rows = (await session.execute(
+            select(User.tg_id, User.id, User.username)
+            .join(recent, recent.c.user_id == User.id)
+            .where(recent.c.created_at >= datetime.utcnow() - timedelta(hours=hours))
+            .distinct()
+            .limit(limit)
+        )).all()
+    for tg_id, user_id, username in rows:
+        user_cache.set(tg_id, (user_id, username))
+    return len(rows)
@@ -0,0 +1,89 @@
+import asyncio, json
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from .config import config
+from .middlewares import on_admitted
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Telegram получает 200 сразу, а апдейты обрабатываются в фоне —
+    одновременно не больше max_concurrency штук, остальные ждут очереди.
+    Слот держится до Mailbox: ждать своего ключа апдейт будет уже без него,
+    иначе флуд пары пользователей занял бы все слоты очередью к своим ключам.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int, record_path: str = "", **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._record = open(record_path, "a", encoding="utf-8") if record_path else None
+        self.waiting = 0
+        self.in_flight = 0
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        if self._record is not None:
+            # сырые апдейты для локального воспроизведения (app.webhook_replay)
+            self._record.write(json.dumps(update, ensure_ascii=False) + "\n")
+            self._record.flush()
+        self.waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        held = True
+
+        def release():
+            nonlocal held
+            if held:
+                held = False
+                self.in_flight -= 1
+                self._sem.release()
+
+        token = on_admitted.set(release)
+        try:
+            await super()._background_feed_update(bot, update)
+        finally:
+            on_admitted.reset(token)
+            release()
+
+    async def close(self) -> None:
+        if self._record is not None:
+            self._record.close()
+            self._record = None
+        await super().close()
+
+
+def build_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    app = web.Application()
+    BoundedRequestHandler(
+        dp, bot,
+        max_concurrency=config.webhook_max_concurrency,
+        record_path=config.webhook_record_path,
+        secret_token=config.webhook_secret or None,
+    ).register(app, path=config.webhook_path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    runner = web.AppRunner(build_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, config.webhook_host, config.webhook_port)
+    await site.start()
+    try:
+        # без WEBHOOK_BASE_URL сервер слушает локально (например, под app.webhook_replay)
+        if config.webhook_base_url:
+            await bot.set_webhook(
+                url=config.webhook_base_url + config.webhook_path,
+                secret_token=config.webhook_secret or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(100, config.webhook_max_concurrency),
+            )
+        print(f"✅ Webhook: {config.webhook_host}:{config.webhook_port}{config.webhook_path}, "
+              f"max_concurrency={config.webhook_max_concurrency}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,71 @@
+"""
+Локальная замена Telegram для webhook-режима: POST-им записанные апдейты в наш сервер.
+
+    python -m app.webhook_replay updates.jsonl --url http://127.0.0.1:8080/webhook --concurrency 20
+
+Файл — JSONL с сырыми Update (например, из WEBHOOK_RECORD_PATH).
+"""
+import argparse, asyncio, json, time
+from collections import Counter
+from aiohttp import ClientSession
+
+from .config import config
+
+
+def _load_updates(path: str, repeat: int) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    out = []
+    next_id = max((u.get("update_id", 0) for u in updates), default=0) + 1
+    for r in range(repeat):
+        for u in updates:
+            u = dict(u)
+            if r:
+                u["update_id"] = next_id
+                next_id += 1
+            out.append(u)
+    return out
+
+
+async def replay(path: str, url: str, secret: str, concurrency: int, repeat: int = 1):
+    updates = _load_updates(path, repeat)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    statuses: Counter = Counter()
+    latencies: list[float] = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async with ClientSession(headers=headers) as http:
+        async def post(u: dict):
+            async with sem:
+                t0 = time.perf_counter()
+                async with http.post(url, json=u) as resp:
+                    await resp.read()
+                    statuses[resp.status] += 1
+                latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post(u) for u in updates))
+        elapsed = time.perf_counter() - t0
+
+    latencies.sort()
+    def pct(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+
+    print(f"updates: {len(updates)} за {elapsed:.2f}s ({len(updates) / elapsed:.0f}/s)")
+    print(f"статусы: {dict(statuses)}")
+    print(f"ack p50={pct(0.5):.1f}ms p99={pct(0.99):.1f}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("path")
+    ap.add_argument("--url", default=f"http://127.0.0.1:{config.webhook_port}{config.webhook_path}")
+    ap.add_argument("--secret", default=config.webhook_secret)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--repeat", type=int, default=1)
+    args = ap.parse_args()
+    asyncio.run(replay(args.path, args.url, args.secret, args.concurrency, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import asyncio, time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Callable
+from sqlalchemy import insert, select, update
+
+from .cache import TTLCache
+from .config import config
+from .db import SessionLocal, insert_ignore, insert_returning_ids, upsert
+from .models import Comment, CommentMedia, DigestItem, Media, MessageRoute, OutboxEntry
+
+
+class CommentRef:
+    """Ссылка на ещё не записанный Comment: id появляется после flush пачки."""
+    __slots__ = ("id", "outbox_id", "committed")
+
+    def __init__(self):
+        self.id: int | None = None
+        self.outbox_id: int | None = None
+        self.committed: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+# сколько живёт file_unique_id -> media.id в памяти; app.maintenance удаляет ничейные media,
+# только если комментарии хранятся дольше (иначе кэш мог бы сослаться на удалённую строку)
+MEDIA_CACHE_TTL = 86400
+
+
+class CommentWriter:
+    """
+    Write-behind для Comment/CommentMedia (и маршрутов сообщений): записи копятся в очереди и пишутся
+    одной транзакцией раз в flush_interval или по набору batch_size.
+    Порядок сохраняется: Comment альбома всегда попадает в БД раньше своих медиа,
+    запись outbox — в той же транзакции, что и её Comment.
+
+    Очередь — из единиц: Comment с медиа и outbox, добавленными, пока он ждёт записи, — одна единица;
+    пачка режется только между единицами (batch_size — ориентир по числу строк, единицу не делим).
+    """
+
+    _MAX_RETRIES = 5
+    _URGENT_DELAY = 0.02  # срочные записи (outbox) чуть ждут попутчиков: одна транзакция на несколько
+
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue: deque[list[tuple]] = deque()
+        self._queued = 0  # строк в очереди
+        self._units: dict[CommentRef, list[tuple]] = {}  # единица ещё не взятого в пачку Comment
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._failures = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        # единицы, которые не записались даже поодиночке: (когда, ошибка, строки) — для разбора руками
+        self.dead_letter: deque[tuple[datetime, str, list[tuple]]] = deque(maxlen=100)
+        self.dead_units = 0
+        self.last_flush_ms = 0.0
+        self.flush_ms_sum = 0.0
+        # (outbox_id, payload) после коммита — доставщик берёт запись сразу, без опроса БД
+        self.on_outbox: Callable[[int, str], None] | None = None
+        self._urgent: asyncio.TimerHandle | None = None
+        # file_unique_id -> media.id (строки media не меняются — TTL только чтобы не копить вечно)
+        self._media_ids = TTLCache(ttl=MEDIA_CACHE_TTL, maxsize=config.media_cache_size)
+        self.media_db = 0
+        self.media_cached = 0
+
+    def add_comment(self, channel_chat_id: int, post_id: int, user_id: int, text: str) -> CommentRef:
+        ref = CommentRef()
+        unit = [("comment", ref, {
+            "channel_chat_id": channel_chat_id, "post_id": post_id,
+            "user_id": user_id, "text": text, "created_at": datetime.utcnow(),
+        })]
+        self._units[ref] = unit
+        self._put(unit)
+        return ref
+
+    def add_media(self, ref: CommentRef, records: list[tuple]):
+        """records — кортежи из _media_records_from_message: (type, file_id, file_unique_id, mgid)."""
+        now = datetime.utcnow()
+        self._attach(ref, [("media", ref, {
+            "media_type": t, "file_id": fid, "file_unique_id": fuid,
+            "media_group_id": g, "created_at": now,
+        }) for t, fid, fuid, g in records])
+
+    def add_outbox(self, ref: CommentRef, payload: str, lease_sec: float):
+        """Уведомление о комментарии; до lease_sec запись «арендована» этим процессом."""
+        now = datetime.utcnow()
+        self._attach(ref, [("outbox", ref, {
+            "payload": payload, "status": "pending", "attempts": 0,
+            "next_at": now + timedelta(seconds=lease_sec), "created_at": now,
+        })])
+        # уведомление ждут — пишем почти сразу, не дожидаясь flush_interval
+        if self._urgent is None:
+            self._urgent = asyncio.get_running_loop().call_later(self._URGENT_DELAY, self._wake)
+
+    def _wake(self):
+        self._urgent = None
+        self._wakeup.set()
+
+    def mark_outbox(self, outbox_id: int, **values):
+        self._put([("outbox_mark", None, {"id": outbox_id, **values})])
+
+    def add_routes(self, rows: list[dict]):
+        if rows:
+            self._put([("route", None, row) for row in rows])
+
+    def add_digest_items(self, rows: list[dict]):
+        if rows:
+            self._put([("digest_item", None, row) for row in rows])
+
+    def _attach(self, ref: CommentRef, items: list[tuple]):
+        """Строки Comment'а — в его единицу, пока она в очереди; иначе (уже пишется/записан) — своей единицей."""
+        if not items:
+            return
+        unit = self._units.get(ref)
+        if unit is None:
+            return self._put(items)
+        unit.extend(items)
+        self._queued += len(items)
+        if self._queued >= self.batch_size:
+            self._wakeup.set()
+
+    def _put(self, unit: list[tuple]):
+        self.start()
+        self._queue.append(unit)
+        self._queued += len(unit)
+        if self._queued >= self.batch_size:
+            self._wakeup.set()
+
+    def _take(self) -> list[list[tuple]]:
+        """Единицы на одну пачку: не больше batch_size строк, но хотя бы одна единица целиком."""
+        units, n = [], 0
+        while self._queue and (not units or n + len(self._queue[0]) <= self.batch_size):
+            unit = self._queue.popleft()
+            units.append(unit)
+            n += len(unit)
+            kind, ref, _ = unit[0]
+            if kind == "comment":
+                self._units.pop(ref, None)  # дальше строки этого Comment'а — новой единицей
+        self._queued -= n
+        return units
+
+    def _requeue(self, units: list[list[tuple]]):
+        self._queue.extendleft(reversed(units))  # в голову очереди, порядок тот же
+        self._queued += sum(len(u) for u in units)
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._queue:
+                return 0
+            units = self._take()
+            t0 = time.perf_counter()
+            try:
+                await self._write(units)
+            except asyncio.CancelledError:
+                self._requeue(units)
+                raise
+            except Exception:
+                self.errors += 1
+                self._failures += 1
+                if self._failures <= self._MAX_RETRIES:
+                    self._requeue(units)
+                    raise
+                # пачка раз за разом не пишется — ищем виноватую единицу: остальные пишем по одной
+                self._failures = 0
+                await self._write_each(units)
+            self._failures = 0
+
+            n = sum(len(u) for u in units)
+            ms = (time.perf_counter() - t0) * 1000
+            self.flushes += 1
+            self.rows_written += n
+            self.last_flush_ms = ms
+            self.flush_ms_sum += ms
+            return n
+
+    async def _write_each(self, units: list[list[tuple]]):
+        """Каждая единица — своей транзакцией; не записавшаяся уходит в dead_letter, остальные не теряются."""
+        for i, unit in enumerate(units):
+            try:
+                await self._write([unit])
+            except asyncio.CancelledError:
+                self._requeue(units[i:])
+                raise
+            except Exception as e:
+                self.dead_units += 1
+                self.dead_letter.append((datetime.utcnow(), f"{type(e).__name__}: {e}"[:255], unit))
+                for kind, ref, _ in unit:
+                    if kind == "comment" and not ref.committed.done():
+                        ref.committed.set_exception(e)
+                        ref.committed.exception()
+                print(f"⚠️ Запись отброшена ({len(unit)} строк, {unit[0][0]}):", e)
+
+    async def _write(self, units: list[list[tuple]]):
+        """Одна транзакция на units; id и колбэки — только после коммита."""
+        batch = [item for unit in units for item in unit]
+        comments = [(ref, row) for kind, ref, row in batch if kind == "comment"]
+        async with SessionLocal() as session:
+            # id нужны медиа и outbox: один многострочный INSERT на таблицу, не по строке
+            comment_ids = await insert_returning_ids(session, Comment, [row for _, row in comments])
+            by_ref = {id(r): cid for (r, _), cid in zip(comments, comment_ids)}
+            media = []
+            for kind, ref, row in batch:
+                if kind != "media":
+                    continue
+                comment_id = ref.id if ref.id is not None else by_ref.get(id(ref))
+                if comment_id is None:
+                    continue  # Comment потерян вместе с прошлой пачкой
+                media.append({**row, "comment_id": comment_id})
+            known = {}
+            if media:
+                known = await self._resolve_media(session, media)
+                await session.execute(insert(CommentMedia), [{
+                    "comment_id": r["comment_id"], "media_id": known[r["file_unique_id"]],
+                    "media_group_id": r["media_group_id"], "created_at": r["created_at"],
+                } for r in media])
+            rows = []
+            for kind, ref, row in batch:
+                if kind != "outbox":
+                    continue
+                comment_id = ref.id if ref.id is not None else by_ref.get(id(ref))
+                if comment_id is None:
+                    continue
+                rows.append((ref, {**row, "comment_id": comment_id}))
+            outbox_ids = await insert_returning_ids(session, OutboxEntry, [row for _, row in rows])
+            outbox = [(ref, oid, row["payload"]) for (ref, row), oid in zip(rows, outbox_ids)]
+            marks = [row for kind, _, row in batch if kind == "outbox_mark"]
+            if marks:
+                await session.execute(update(OutboxEntry), marks)
+            routes = [row for kind, _, row in batch if kind == "route"]
+            if routes:
+                await session.execute(upsert(
+                    MessageRoute, routes,
+                    keys=["chat_id", "message_id"],
+                    update=["user_tg_id", "channel_chat_id", "post_id", "admin_message_id"],
+                ))
+            items = [row for kind, _, row in batch if kind == "digest_item"]
+            if items:
+                await session.execute(insert_ignore(DigestItem, items, keys=["chat_id", "message_id", "item_no"]))
+            await session.commit()
+
+        for fuid, media_id in known.items():
+            self._media_ids.set(fuid, media_id)  # только после коммита: откат не оставит чужих id
+        for ref, oid, _ in outbox:
+            ref.outbox_id = oid
+        for (ref, _), cid in zip(comments, comment_ids):
+            ref.id = cid
+            if not ref.committed.done():
+                ref.committed.set_result(cid)
+        if self.on_outbox is not None:
+            for _, oid, payload in outbox:
+                self.on_outbox(oid, payload)
+
+    async def _resolve_media(self, session, rows: list[dict]) -> dict[str, int]:
+        """file_unique_id -> media.id: известные — из кэша, новые — пакетный insert-if-absent и один SELECT."""
+        ids, missing = {}, {}
+        for r in rows:
+            fuid = r["file_unique_id"]
+            media_id = self._media_ids.get(fuid)
+            if media_id is not None:
+                ids[fuid] = media_id
+            elif fuid not in missing:
+                missing[fuid] = {"file_unique_id": fuid, "media_type": r["media_type"],
+                                 "file_id": r["file_id"], "created_at": r["created_at"]}
+        self.media_cached += len(rows) - len(missing)
+        if missing:
+            await session.execute(insert_ignore(Media, list(missing.values()), keys=["file_unique_id"]))
+            ids.update((await session.execute(
+                select(Media.file_unique_id, Media.id).where(Media.file_unique_id.in_(missing))
+            )).all())
+            self.media_db += len(missing)
+        return ids
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while self._queue:
+                    await self.flush()
+            except Exception as e:
+                print("⚠️ Не удалось записать комментарии:", e)
+                await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._urgent is not None:
+            self._urgent.cancel()
+            self._urgent = None
+        if self._task is not None:
+            async with self._lock:  # не рвём пачку посреди записи
+                self._task.cancel()
+            self._task = None
+        while self._queue:
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "queue": self._queued,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+            "dead_units": self.dead_units,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self.flush_ms_sum / self.flushes, 2) if self.flushes else 0.0,
+            "media_db": self.media_db,
+            "media_cached": self.media_cached,
+        }
+
+
+writer = CommentWriter(batch_size=config.write_batch_size, flush_interval=config.write_flush_sec)
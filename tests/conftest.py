@@ -0,0 +1,8 @@
+import os, sys, tempfile
+
+# app.config читает окружение при импорте: временная SQLite и фиктивный токен — до импорта app.*
+_DB_DIR = tempfile.mkdtemp(prefix="kvantora-tests-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(_DB_DIR, 'tests.db')}"
+os.environ["DATABASE_READ_URL"] = ""
+os.environ.setdefault("BOT_TOKEN", "1:tests")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
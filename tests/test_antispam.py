@@ -0,0 +1,25 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from app.antispam import RateLimiter
+from app.schema import ensure_schema
+
+
+def test_hourly_quota_survives_flush_eviction_and_restart():
+    async def run():
+        await ensure_schema()
+        uid = 700_000_001
+        lim = RateLimiter(window_sec=10, per_hour=3, maxsize=1, flush_interval=60)
+        t0 = datetime.utcnow() - timedelta(seconds=200)
+        for i in range(3):
+            assert lim.hit(uid, t0 + timedelta(seconds=20 * i))[0]
+        # окно в 10 с давно прошло, но часовой лимит исчерпан
+        await lim.flush()
+        lim.hit(uid + 1)  # таблица переполнена: действующую запись вытеснять нельзя
+        assert lim.hit(uid) == (False, 0)
+
+        restarted = RateLimiter(window_sec=10, per_hour=3, maxsize=100, flush_interval=60)
+        await restarted.load()
+        assert restarted.hit(uid) == (False, 0)
+
+    asyncio.run(run())
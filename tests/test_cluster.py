@@ -0,0 +1,41 @@
+import asyncio
+import pytest
+from aiogram.types import Update
+
+from app.cluster import Front
+
+
+class _Bot:
+    def __init__(self, updates):
+        self.updates = updates
+        self.offsets = []
+
+    async def get_updates(self, offset=None, **_):
+        self.offsets.append(offset)
+        if len(self.offsets) > 1:
+            raise asyncio.CancelledError
+        return self.updates
+
+
+def test_poll_retries_until_worker_accepts_before_advancing_offset(monkeypatch):
+    async def no_sleep(_):
+        pass
+    monkeypatch.setattr("app.cluster.asyncio.sleep", no_sleep)
+
+    async def run():
+        front = Front([], secret="s")
+        statuses = iter([503] * 12 + [200])
+        sent = []
+
+        async def forward(update):
+            sent.append(update["update_id"])
+            return next(statuses)
+        front.forward = forward
+
+        bot = _Bot([Update(update_id=41)])
+        with pytest.raises(asyncio.CancelledError):
+            await front.poll(bot, [])
+        assert sent == [41] * 13
+        assert bot.offsets == [None, 42]
+
+    asyncio.run(run())
@@ -0,0 +1,33 @@
+import asyncio
+from sqlalchemy import select
+
+from app.db import SessionLocal, begin_update_session, commit_before_io, end_update_session
+from app.models import User
+from app.schema import ensure_schema
+from app.users import ensure_user
+
+
+def test_update_writes_are_committed_before_bot_api_calls():
+    async def visible(tg_id: int) -> bool:
+        async with SessionLocal() as session:
+            return (await session.execute(select(User.id).where(User.tg_id == tg_id))).first() is not None
+
+    async def run():
+        await ensure_schema()
+        us, token = begin_update_session()
+        try:
+            await ensure_user(700_000_201, "a")
+            assert us.dirty
+
+            # копия контекста в чужой задаче (например, планировщик отправок) сессию апдейта не коммитит
+            await asyncio.create_task(commit_before_io())
+            assert us.dirty
+
+            await commit_before_io()
+            assert not us.dirty
+            assert await visible(700_000_201)
+            await us.finish(True)
+        finally:
+            end_update_session(token)
+
+    asyncio.run(run())
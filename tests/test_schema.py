@@ -0,0 +1,37 @@
+from sqlalchemy import create_engine, inspect, text
+
+from app.models import CommentMedia
+from app.schema import _media_store
+
+_LEGACY = """CREATE TABLE comment_medias (
+    id INTEGER PRIMARY KEY, comment_id INTEGER NOT NULL, media_type VARCHAR(16) NOT NULL,
+    file_id VARCHAR(512) NOT NULL, file_unique_id VARCHAR(128), media_group_id VARCHAR(64),
+    created_at DATETIME)"""
+
+
+def _columns(conn) -> set[str]:
+    return {c["name"] for c in inspect(conn).get_columns("comment_medias")}
+
+
+def test_media_store_moves_legacy_rows(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with eng.begin() as conn:
+        conn.execute(text(_LEGACY))
+        conn.execute(text("INSERT INTO comment_medias (id, comment_id, media_type, file_id, file_unique_id, created_at) "
+                          "VALUES (1, 1, 'photo', 'f1', 'u1', '2024-01-01'), (2, 2, 'photo', 'f1b', 'u1', '2024-01-01'), "
+                          "(3, 3, 'voice', 'f3', NULL, '2024-01-01')"))
+        _media_store(conn)
+        assert _columns(conn) == {c.name for c in CommentMedia.__table__.columns}
+        rows = conn.execute(text("SELECT cm.id, m.file_unique_id FROM comment_medias cm "
+                                 "JOIN media m ON m.id = cm.media_id ORDER BY cm.id")).all()
+        assert rows == [(1, "u1"), (2, "u1"), (3, "legacy:3")]
+
+
+def test_media_store_finishes_after_partial_column_drop(tmp_path):
+    # сбой посреди DDL (MySQL): media_id заполнен, file_id уже удалён, media_type NOT NULL остался
+    eng = create_engine(f"sqlite:///{tmp_path / 'partial.db'}")
+    with eng.begin() as conn:
+        conn.execute(text(_LEGACY.replace("file_id VARCHAR(512) NOT NULL, ", "")
+                          .replace("created_at DATETIME", "created_at DATETIME, media_id INTEGER")))
+        _media_store(conn)
+        assert _columns(conn) == {c.name for c in CommentMedia.__table__.columns}
@@ -0,0 +1,47 @@
+import asyncio
+from aiogram import Bot, Dispatcher
+
+from app.middlewares import Mailbox, UserMailboxMiddleware
+from app.webhook import BoundedRequestHandler
+
+
+def _update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "x",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+        },
+    }
+
+
+def test_flooding_users_do_not_hold_webhook_slots():
+    async def run():
+        dp = Dispatcher()
+        dp.update.outer_middleware(UserMailboxMiddleware(Mailbox(max_concurrency=8, max_per_key=50)))
+        gate = asyncio.Event()
+        served = []
+
+        @dp.message()
+        async def on_message(message):
+            served.append(message.from_user.id)
+            if message.from_user.id in (1, 2):
+                await gate.wait()
+
+        bot = Bot("1:tests")
+        handler = BoundedRequestHandler(dp, bot, max_concurrency=2)
+        # два пользователя флудят: их апдейты ждут своих ключей, но не слотов webhook
+        tasks = [asyncio.create_task(handler._background_feed_update(bot, _update(n, 1 + n % 2)))
+                 for n in range(10)]
+        await asyncio.sleep(0.05)
+        tasks.append(asyncio.create_task(handler._background_feed_update(bot, _update(100, 3))))
+        await asyncio.sleep(0.05)
+        assert 3 in served
+        assert handler.in_flight == 0 and handler.waiting == 0
+        gate.set()
+        await asyncio.gather(*tasks)
+        assert len(served) == 11
+        await bot.session.close()
+
+    asyncio.run(run())
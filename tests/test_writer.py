@@ -0,0 +1,68 @@
+import asyncio
+from sqlalchemy import select
+
+from app.db import SessionLocal
+from app.models import CommentMedia, OutboxEntry, User
+from app.schema import ensure_schema
+from app.writer import CommentWriter
+
+
+def test_small_batch_keeps_comment_media_and_outbox_together():
+    async def run():
+        await ensure_schema()
+        async with SessionLocal() as session:
+            session.add(User(tg_id=700_000_101))
+            await session.commit()
+            user_id = (await session.execute(select(User.id).where(User.tg_id == 700_000_101))).scalar_one()
+
+        w = CommentWriter(batch_size=3, flush_interval=60)
+        refs = []
+        for i in range(3):
+            ref = w.add_comment(-1001, 1, user_id, f"c{i}")
+            w.add_media(ref, [("photo", f"f{i}a", f"wu{i}a", None), ("photo", f"f{i}b", f"wu{i}b", None)])
+            w.add_outbox(ref, f'{{"n": {i}}}', 300)
+            refs.append(ref)
+
+        # единица (Comment + 2 медиа + outbox) больше batch_size: пишется одной пачкой целиком
+        assert await w.flush() == 4
+        assert refs[0].id is not None and refs[0].outbox_id is not None
+        assert refs[1].id is None
+        await w.stop()
+
+        async with SessionLocal() as session:
+            for ref in refs:
+                assert ref.outbox_id is not None
+                media = (await session.execute(
+                    select(CommentMedia.id).where(CommentMedia.comment_id == ref.id))).scalars().all()
+                assert len(media) == 2
+                entry = await session.get(OutboxEntry, ref.outbox_id)
+                assert entry.comment_id == ref.id
+
+    asyncio.run(run())
+
+
+def test_failing_unit_is_dead_lettered_without_losing_the_rest():
+    async def run():
+        await ensure_schema()
+        async with SessionLocal() as session:
+            session.add(User(tg_id=700_000_102))
+            await session.commit()
+            user_id = (await session.execute(select(User.id).where(User.tg_id == 700_000_102))).scalar_one()
+
+        w = CommentWriter(batch_size=100, flush_interval=60)
+        w._MAX_RETRIES = 0  # сразу к записи по одной
+        good1 = w.add_comment(-1001, 2, user_id, "ok1")
+        w.add_outbox(good1, "{}", 300)
+        bad = w.add_comment(-1001, 2, None, "broken")  # user_id NOT NULL
+        good2 = w.add_comment(-1001, 2, user_id, "ok2")
+        w.add_routes([{"chat_id": 1, "message_id": 700_000_102, "user_tg_id": 1, "channel_chat_id": -1001,
+                       "post_id": 2, "admin_message_id": None}])
+
+        await w.flush()
+        await w.stop()
+        assert good1.id is not None and good1.outbox_id is not None
+        assert good2.id is not None
+        assert bad.committed.done() and bad.committed.exception() is not None
+        assert w.dead_units == 1 and len(w.dead_letter) == 1
+
+    asyncio.run(run())